@@ -0,0 +1,370 @@
+"""
+Benchmarks of the wrapper overhead
+
+Runs against a fake FSLDIR (see stub_fsl.py) whose binaries return at
+once, so the timings are what the Python side costs: resolving the FSL
+environment, staging in-memory inputs, spawning the binary, reading the
+outputs back. Where a computation has both a native and a binary path
+(fslstats), both are timed; the binary timing is then the wrapper overhead
+around a stub that computes nothing, i.e. the break-even point the
+native path has to beat.
+
+Usage
+-----
+    python benchmarks/bench.py                 # run, compare with baseline.json
+    python benchmarks/bench.py --save          # run and store as the baseline
+    python benchmarks/bench.py --filter checkimg --repeat 50
+
+Each benchmark reports the median time per call. Benchmarks slower than
+the stored baseline by more than --threshold (default 25%) are flagged,
+and the script then exits with status 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fsl
+from fsl import config
+from fsl.environment import reset_fsl_env
+from fsl.fslhd import checkimg, remove_tempfile, system_cmd
+from fsl.staging import clear_staged
+from stub_fsl import make_fsldir
+
+
+SIZES = {'small': (32, 32, 32),
+         'medium': (96, 96, 64),
+         'large': (192, 192, 128)}
+
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+
+_benchmarks = []
+
+
+def benchmark(func):
+    """
+    Register a generator of (name, callable[, repeat]) benchmarks
+    """
+    _benchmarks.append(func)
+    return func
+
+
+def backends():
+    """
+    Python image packages that are installed
+    """
+    found = []
+    for package in ('nibabel', 'ants'):
+        try:
+            __import__(package)
+        except ImportError:
+            continue
+        found.append(package)
+    return found
+
+
+def make_image(backend, shape, seed=0):
+    import numpy as np
+    data = np.random.RandomState(seed).rand(*shape).astype('float32') * 100
+    if backend == 'ants':
+        import ants
+        return ants.from_numpy(data)
+    import nibabel
+    return nibabel.Nifti1Image(data, np.eye(4))
+
+
+def save_image(img, filename):
+    if hasattr(img, 'to_filename'):
+        img.to_filename(filename)
+    else:
+        img.to_file(filename)
+    return filename
+
+
+@contextmanager
+def settings(pypackage=None, fsloutput=None, staging=False, stage_cache=None):
+    """
+    Temporarily change the package configuration
+    """
+    saved = (config.PYPACKAGE, config.FSL_OUTPUTTYPE, config.FSL_STAGING,
+             config.FSL_STAGING_BUDGET, config.FSL_STAGE_CACHE)
+    try:
+        if pypackage is not None:
+            config.set_pypackage(pypackage)
+        if fsloutput is not None:
+            config.set_fsloutput(fsloutput)
+        config.set_fslstaging('/dev/shm' if staging and os.path.isdir('/dev/shm') else None)
+        if stage_cache is not None:
+            config.set_fslstagecache(stage_cache)
+        yield
+    finally:
+        clear_staged()
+        (config.PYPACKAGE, config.FSL_OUTPUTTYPE, config.FSL_STAGING,
+         config.FSL_STAGING_BUDGET, config.FSL_STAGE_CACHE) = saved
+
+
+def timeit(func, repeat):
+    """
+    Median wall time of `func` over `repeat` calls, after one warm-up call
+    """
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+##################################
+# benchmarks
+##################################
+
+@benchmark
+def bench_env(ctx):
+    yield 'env/get_fsl', fsl.get_fsl
+    yield 'env/get_fsl_env[cached]', fsl.get_fsl_env
+
+    def cold():
+        reset_fsl_env()
+        fsl.get_fsl_env()
+    yield 'env/get_fsl_env[cold]', cold, 5
+
+
+@benchmark
+def bench_system_cmd(ctx):
+    if not ctx['files']:
+        return
+    fslstats = fsl.get_fsl_env().which('fslstats')
+    argv = [fslstats, ctx['files']['nibabel/small/.nii'], '-m']
+    yield 'system_cmd/argv', lambda: system_cmd(argv)
+    shell = '%s%s %s -m' % (fsl.get_fsl(), 'fslstats', ctx['files']['nibabel/small/.nii'])
+    yield 'system_cmd/shell', lambda: system_cmd(shell)
+
+
+@benchmark
+def bench_checkimg(ctx):
+    for backend in backends():
+        for size in SIZES:
+            img = ctx['images'][backend, size]
+            for staging, outtype in ((False, 'NIFTI_GZ'), (True, 'NIFTI')):
+                def stage(img=img, staging=staging, backend=backend):
+                    with settings(backend, staging=staging, stage_cache=0):
+                        path, remove = checkimg(img)
+                        if remove:
+                            remove_tempfile(path)
+                yield 'checkimg/%s/%s/%s' % (backend, size, outtype), stage
+
+            def reuse(img=img, backend=backend):
+                with settings(backend, staging=True):
+                    checkimg(img)
+                    path, remove = checkimg(img)
+                    remove_tempfile(path)
+            yield 'checkimg/%s/%s/reuse' % (backend, size), reuse
+
+
+@benchmark
+def bench_readnii(ctx):
+    if not ctx['files']:
+        return
+    for backend in backends():
+        for size in SIZES:
+            for ext in ('.nii', '.nii.gz'):
+                filename = ctx['files']['%s/%s/%s' % ('nibabel', size, ext)]
+
+                def read(filename=filename, backend=backend):
+                    with settings(backend):
+                        img = fsl.readnii(filename)
+                        if hasattr(img, 'get_fdata'):
+                            img.get_fdata()
+                yield 'readnii/%s/%s/%s' % (backend, size, ext), read
+
+                def lazy(filename=filename, backend=backend):
+                    with settings(backend):
+                        fsl.readnii(filename, lazy=True).shape
+                yield 'readnii/%s/%s/%s/lazy' % (backend, size, ext), lazy
+
+
+@benchmark
+def bench_fslstats(ctx):
+    for size in SIZES:
+        img = ctx['images'].get(('nibabel', size))
+        if img is None:
+            continue
+        for opts in ('-M', '-R -S', '-p 50'):
+            for native in (True, False):
+                def stats(img=img, opts=opts, native=native):
+                    with settings('nibabel', staging=True, stage_cache=0):
+                        fsl.fslstats(img, opts, native=native)
+                yield 'fslstats/%s/%s/%s' % (size, opts.replace(' ', ''),
+                                              'native' if native else 'binary'), stats
+
+
+@benchmark
+def bench_gzip(ctx):
+    import gzip
+    from fsl.compress import gzip_file
+
+    if not ctx['files']:
+        return
+    tmpdir = ctx['tmpdir']
+    for size in ('medium', 'large'):
+        src = ctx['files']['nibabel/%s/.nii' % size]
+        dst = os.path.join(tmpdir, 'gzip_%s.nii.gz' % size)
+
+        def stdlib(src=src, dst=dst):
+            with open(src, 'rb') as fin, gzip.open(dst, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+        yield 'gzip/%s/stdlib' % size, stdlib, 5
+
+        for threads in sorted({1, os.cpu_count() or 1}):
+            def blocks(src=src, dst=dst, threads=threads):
+                gzip_file(src, dst, threads=threads)
+            yield 'gzip/%s/blocks/%d' % (size, threads), blocks, 5
+
+
+@benchmark
+def bench_wrappers(ctx):
+    if not ctx['files']:
+        return
+    ref = ctx['files']['nibabel/small/.nii.gz']
+    for backend in backends():
+        img = ctx['images'][backend, 'small']
+        for fsloutput in ('NIFTI_GZ', 'NIFTI'):
+            calls = {
+                'flirt': lambda: fsl.flirt(img, ref, verbose=False),
+                'fnirt': lambda: fsl.fnirt(img, ref, verbose=False),
+                'fslbet': lambda: fsl.fslbet(img, verbose=False),
+                'fsl_biascorrect': lambda: fsl.fsl_biascorrect(img, verbose=False),
+            }
+            for name, call in calls.items():
+                for staging in (False, True):
+                    def run(call=call, backend=backend, fsloutput=fsloutput,
+                            staging=staging):
+                        with settings(backend, fsloutput, staging=staging):
+                            call()
+                    yield 'wrapper/%s/%s/%s%s' % (name, backend, fsloutput,
+                                                  '/staged' if staging else ''), run
+
+
+##################################
+# running
+##################################
+
+def setup(tmpdir):
+    """
+    Fake FSLDIR plus test images in memory and on disk
+    """
+    for var in ('FSLDIR', 'FSLOUTPUTTYPE'):
+        os.environ.pop(var, None)
+    config.set_fslpath(make_fsldir(os.path.join(tmpdir, 'fsl')))
+    reset_fsl_env()
+
+    ctx = {'images': {}, 'files': {}, 'tmpdir': tmpdir}
+    for backend in backends():
+        for size, shape in SIZES.items():
+            ctx['images'][backend, size] = make_image(backend, shape)
+    if 'nibabel' in backends():
+        for size in SIZES:
+            img = ctx['images']['nibabel', size]
+            for ext in ('.nii', '.nii.gz'):
+                ctx['files']['nibabel/%s/%s' % (size, ext)] = save_image(
+                    img, os.path.join(tmpdir, '%s%s' % (size, ext)))
+    return ctx
+
+
+def run(repeat, name_filter=None):
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix='fslbench')
+    try:
+        ctx = setup(tmpdir)
+        for bench in _benchmarks:
+            for item in bench(ctx):
+                name, func = item[:2]
+                if name_filter and name_filter not in name:
+                    continue
+                n = item[2] if len(item) > 2 else repeat
+                results[name] = timeit(func, n)
+                print('%-52s %10.3f ms' % (name, results[name] * 1e3))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        clear_staged()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print results against the baseline, gives back the names of regressions
+    """
+    regressions = []
+    print('\n%-52s %10s %10s %8s' % ('benchmark', 'ms', 'base ms', 'ratio'))
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print('%-52s %10.3f %10s %8s' % (name, value * 1e3, '-', '-'))
+            continue
+        ratio = value / base if base > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-52s %10.3f %10.3f %8.2f%s' % (name, value * 1e3, base * 1e3, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the fsl wrappers against stub FSL binaries')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline JSON file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown flagged as a regression (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='calls timed per benchmark (default: %(default)s)')
+    parser.add_argument('--filter', default=None,
+                        help='only run benchmarks whose name contains this')
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat, args.filter)
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('machine') != platform.node():
+            print('\nnote: baseline was recorded on %s' % baseline.get('machine'))
+        regressions = compare(results, baseline['results'], args.threshold)
+
+    if args.save:
+        stored = {}
+        if os.path.exists(args.baseline) and args.filter:
+            # keep the benchmarks that were not run this time
+            with open(args.baseline) as f:
+                stored = json.load(f)['results']
+        stored.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.node(),
+                       'python': platform.python_version(),
+                       'results': stored}, f, indent=1, sort_keys=True)
+        print('\nbaseline saved to %s' % args.baseline)
+
+    if regressions:
+        print('\n%d regression(s) past %.0f%%' % (len(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
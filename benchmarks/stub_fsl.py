@@ -0,0 +1,190 @@
+"""
+A fake FSL installation for benchmarks
+
+`make_fsldir(root)` lays out an FSLDIR whose `fslstats`, `bet2`, `bet`,
+`flirt`, `fnirt`, `fast` and `fslorient` are small Python scripts that
+write plausible outputs (copies of the input or reference image, an
+identity matrix, one number per statistic) straight away, so that timings
+measure the wrapper and not FSL.
+"""
+
+import os
+import stat
+import sys
+
+
+STUB_COMMON = r'''
+import gzip
+import os
+import sys
+
+EXTS = {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz', 'NIFTI_PAIR': '.hdr',
+        'NIFTI_PAIR_GZ': '.hdr.gz', 'ANALYZE': '.hdr', 'ANALYZE_GZ': '.hdr.gz'}
+EXT = EXTS.get(os.environ.get('FSLOUTPUTTYPE', 'NIFTI_GZ'), '.nii.gz')
+
+
+def find(path):
+    for ext in ('', '.nii.gz', '.nii'):
+        if os.path.exists(path + ext):
+            return path + ext
+    sys.exit('stub: cannot find image %s' % path)
+
+
+def stub(path):
+    for ext in ('.nii.gz', '.nii'):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def copy_image(src, dst_stub):
+    src = find(src)
+    opener = gzip.open if src.endswith('.gz') else open
+    with opener(src, 'rb') as f:
+        data = f.read()
+    dst = stub(dst_stub) + ('.nii.gz' if EXT.endswith('.gz') else '.nii')
+    opener = gzip.open if dst.endswith('.gz') else open
+    # fast compression: the stubs should not dominate the timings
+    kwargs = {'compresslevel': 1} if dst.endswith('.gz') else {}
+    with opener(dst, 'wb', **kwargs) as f:
+        f.write(data)
+
+
+def value(args, flag, default=None):
+    for i, arg in enumerate(args):
+        if arg == flag and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith(flag + '='):
+            return arg.split('=', 1)[1]
+    return default
+'''
+
+STUBS = {}
+
+STUBS['fslstats'] = r'''
+args = sys.argv[1:]
+if args and args[0] == '-t':
+    args = args[1:]
+if not args or args[0] in ('-h', '--help'):
+    print('Usage: fslstats [preoptions] <input> [options]')
+    sys.exit(1)
+find(args[0])
+# number of values each option prints, options taking an argument
+counts = {'-r': 2, '-R': 2, '-v': 2, '-V': 2, '-c': 3, '-C': 3,
+          '-x': 3, '-X': 3, '-w': 6}
+with_arg = ('-l', '-u', '-k', '-p', '-P', '-h', '-H', '-d', '-D')
+out, i = [], 1
+while i < len(args):
+    flag = args[i]
+    if flag in with_arg:
+        i += 1
+        if flag in ('-p', '-P'):
+            out.append('1.000000')
+        elif flag in ('-h', '-H'):
+            out.extend(['1.000000'] * int(args[i]))
+            if flag == '-H':
+                i += 2
+    elif flag.startswith('-'):
+        out.extend(['1.000000'] * counts.get(flag, 1))
+    i += 1
+print(' '.join(out) + ' ')
+'''
+
+STUBS['bet2'] = r'''
+args = sys.argv[1:]
+if len(args) < 2 or args[0] in ('-h', '--help'):
+    print('Usage: bet2 <input> <output> [options]')
+    sys.exit(1)
+copy_image(args[0], args[1])
+if '-m' in args:
+    copy_image(args[0], stub(args[1]) + '_mask')
+'''
+STUBS['bet'] = STUBS['bet2']
+
+STUBS['flirt'] = r'''
+args = sys.argv[1:]
+if not args or args[0] in ('-h', '-help', '--help'):
+    print('Usage: flirt [options] -in <inputvol> -ref <refvol> -out <outputvol>')
+    sys.exit(1)
+out = value(args, '-out') or value(args, '-o')
+if out:
+    copy_image(value(args, '-ref'), out)
+omat = value(args, '-omat')
+if omat:
+    with open(omat, 'w') as f:
+        f.write('1 0 0 0\n0 1 0 0\n0 0 1 0\n0 0 0 1\n')
+'''
+
+STUBS['fnirt'] = r'''
+args = sys.argv[1:]
+if not args or args[0] in ('-h', '--help'):
+    print('Usage: fnirt --in=<filename> --ref=<filename> [options]')
+    sys.exit(1)
+iout = value(args, '--iout')
+if iout:
+    copy_image(value(args, '--ref'), iout)
+cout = value(args, '--cout')
+if cout:
+    copy_image(value(args, '--ref'), cout)
+'''
+
+STUBS['fast'] = r'''
+args = sys.argv[1:]
+if not args or args[0] in ('-h', '--help'):
+    print('Usage: fast [options] file(s)')
+    sys.exit(1)
+src = args[-1]
+out = value(args, '--out') or value(args, '-o') or stub(src)
+nclass = int(value(args, '-n', value(args, '--class', 3)))
+outputs = ['_seg']
+if '-B' in args:
+    outputs.append('_restore')
+if '-b' in args:
+    outputs.append('_bias')
+if '--nopve' not in args:
+    outputs += ['_pveseg', '_mixeltype'] + ['_pve_%d' % i for i in range(nclass)]
+if '-g' in args:
+    outputs += ['_seg_%d' % i for i in range(nclass)]
+if '-p' in args:
+    outputs += ['_prob_%d' % i for i in range(nclass)]
+for suffix in outputs:
+    copy_image(src, out + suffix)
+'''
+
+STUBS['fslorient'] = r'''
+args = sys.argv[1:]
+if not args or args[0] in ('-h', '--help'):
+    print('Usage: fslorient <main option> <filename>')
+    sys.exit(1)
+find(args[-1])
+identity = '1 0 0 0 0 1 0 0 0 0 1 0 0 0 0 1 '
+replies = {'-getorient': 'NEUROLOGICAL', '-getsform': identity,
+           '-getqform': identity, '-getsformcode': '1', '-getqformcode': '1'}
+if args[0] in replies:
+    print(replies[args[0]])
+'''
+
+
+def make_fsldir(root, version='6.0.7.4'):
+    """
+    Lay out a fake FSLDIR at `root`, gives back its path
+    """
+    root = os.path.abspath(root)
+    bindir = os.path.join(root, 'bin')
+    confdir = os.path.join(root, 'etc', 'fslconf')
+    os.makedirs(bindir, exist_ok=True)
+    os.makedirs(confdir, exist_ok=True)
+
+    with open(os.path.join(root, 'etc', 'fslversion'), 'w') as f:
+        f.write('%s:stub\n' % version)
+    with open(os.path.join(confdir, 'fsl.sh'), 'w') as f:
+        f.write('FSLOUTPUTTYPE=${FSLOUTPUTTYPE:-NIFTI_GZ}\nexport FSLOUTPUTTYPE\n')
+
+    for tool, body in STUBS.items():
+        path = os.path.join(bindir, tool)
+        with open(path, 'w') as f:
+            f.write('#!%s -S\n' % sys.executable)
+            f.write(STUB_COMMON)
+            f.write(body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return root
@@ -4,4 +4,19 @@ from .config import *
 
 from .fast import *
 from .fnirt import *
-from .fslhd import *
\ No newline at end of file
+from .environment import *
+from .fslhd import *
+from .cache import *
+from .stats import *
+from .lazy import *
+from .pipeline import *
+from .profiling import *
+from .header import *
+from .compress import *
+from .supervisor import *
+from .scheduler import *
+from .executors import *
+from .journal import *
+from .resample import *
+from .batch import *
+from .aio import *
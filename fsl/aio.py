@@ -0,0 +1,244 @@
+"""
+asyncio versions of the FSL wrapper functions
+
+Every `a<name>` coroutine takes the same arguments as its blocking
+counterpart, but runs the FSL binary with `asyncio.create_subprocess_exec`
+so that a single event loop can drive many FSL jobs at once. The
+wrapper's own work between commands (staging in-memory inputs, reading
+outputs back, cache lookups) runs in worker threads, so a large image
+does not stall the other jobs on the loop. Cancelling the awaiting task
+kills the child process (and its process group).
+The number of FSL processes running at once on each event loop is
+bounded by a semaphore, see `set_max_concurrency`.
+"""
+
+__all__ = ['aflirt',
+           'afnirt',
+           'afnirt_with_affine',
+           'afslbet',
+           'afslstats',
+           'afslcog',
+           'afslorient',
+           'afsl_biascorrect',
+           'afast',
+           'arun_cmd',
+           'arun_steps',
+           'set_max_concurrency']
+
+import asyncio
+import contextvars
+import os
+import signal
+import threading
+import weakref
+
+from .environment import format_cmd
+from .profiling import span
+from .fslhd import (cmd_env, split_step, step_tool, _fslstats, _fslbet,
+                    _fslcog, _fslorient, _flirt)
+from .fnirt import _fnirt, _fnirt_with_affine
+from .fast import _fsl_biascorrect, _fast
+
+
+MAX_CONCURRENCY = 2 * (os.cpu_count() or 1)
+
+# one semaphore per event loop, since asyncio primitives are bound to a loop
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def set_max_concurrency(n):
+    """
+    Set the maximum number of FSL processes run at once on an event loop
+    """
+    global MAX_CONCURRENCY
+    if n < 1:
+        raise ValueError('max concurrency must be at least 1')
+    MAX_CONCURRENCY = int(n)
+    _semaphores.clear()
+
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    sem = _semaphores.get(loop)
+    if sem is None:
+        sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        _semaphores[loop] = sem
+    return sem
+
+
+def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+async def arun_cmd(cmd, env=None):
+    """
+    Asynchronously run a command and give back return code and std out
+
+    An argument list is executed directly in the resolved FSL environment,
+    a string is run by the shell, with the extra environment variables
+    in `env`. The command runs in its own process
+    group, which is killed if the awaiting task is cancelled.
+    """
+    argv = ['/bin/sh', '-c', cmd] if isinstance(cmd, str) else cmd
+
+    async with _semaphore():
+        with span('subprocess', cmd=format_cmd(cmd)) as s:
+            proc = await asyncio.create_subprocess_exec(
+                *argv, stdout=asyncio.subprocess.PIPE,
+                env=cmd_env(cmd, env), start_new_session=True)
+            try:
+                stdout, _ = await proc.communicate()
+            except BaseException:
+                _kill(proc)
+                await asyncio.shield(proc.wait())
+                raise
+            if s is not None:
+                s.attrs['returncode'] = proc.returncode
+
+    return proc.returncode, stdout.decode('unicode_escape')
+
+
+def _in_thread(func, *args):
+    """
+    Run func(*args) in a thread of its own, gives back a future for its
+    result. Not the loop's default executor: a wrapper waiting there for
+    an identical cached call (see `fsl.cache`) could hold the thread the
+    running call needs to finish.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    context = contextvars.copy_context()
+
+    def settle(ok, value):
+        if future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def run():
+        try:
+            value = context.run(func, *args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(settle, False, e)
+        else:
+            loop.call_soon_threadsafe(settle, True, value)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def _advance(steps, result=None, first=False):
+    """
+    Run a step generator up to its next command: gives back
+    (True, command), or (False, return value) once it is done
+    """
+    try:
+        return True, next(steps) if first else steps.send(result)
+    except StopIteration as stop:
+        return False, stop.value
+
+
+async def arun_steps(steps):
+    """
+    Drive a wrapper's step generator on the event loop (see `run_steps`)
+
+    The generator is advanced in a worker thread, only the commands it
+    yields are awaited on the loop.
+    """
+    with span('call', tool=step_tool(steps)):
+        advance = _in_thread(_advance, steps, None, True)
+        try:
+            while True:
+                more, value = await asyncio.shield(advance)
+                if not more:
+                    return value
+                result = await arun_cmd(*split_step(value))
+                advance = _in_thread(_advance, steps, result)
+        finally:
+            if not advance.done():
+                # cancelled while the generator runs: let it get to its
+                # next command before closing it
+                try:
+                    await asyncio.shield(advance)
+                except Exception:
+                    pass
+            steps.close()
+
+
+async def afslstats(*args, **kwargs):
+    """
+    Asynchronous version of `fslstats`
+    """
+    return await arun_steps(_fslstats(*args, **kwargs))
+
+
+async def afslcog(*args, **kwargs):
+    """
+    Asynchronous version of `fslcog`
+    """
+    return await arun_steps(_fslcog(*args, **kwargs))
+
+
+async def afslbet(*args, **kwargs):
+    """
+    Asynchronous version of `fslbet`
+    """
+    return await arun_steps(_fslbet(*args, **kwargs))
+
+
+async def afslorient(*args, **kwargs):
+    """
+    Asynchronous version of `fslorient`
+    """
+    return await arun_steps(_fslorient(*args, **kwargs))
+
+
+async def aflirt(*args, **kwargs):
+    """
+    Asynchronous version of `flirt`
+
+    Example
+    -------
+    >>> import asyncio, fsl
+    >>> async def main(files):
+    ...     return await asyncio.gather(*[fsl.aflirt(f, '~/desktop/template.nii.gz')
+    ...                                   for f in files])
+    >>> imgs = asyncio.run(main(['~/desktop/img1.nii.gz', '~/desktop/img2.nii.gz']))
+    """
+    return await arun_steps(_flirt(*args, **kwargs))
+
+
+async def afnirt(*args, **kwargs):
+    """
+    Asynchronous version of `fnirt`
+    """
+    return await arun_steps(_fnirt(*args, **kwargs))
+
+
+async def afnirt_with_affine(*args, **kwargs):
+    """
+    Asynchronous version of `fnirt_with_affine`
+    """
+    return await arun_steps(_fnirt_with_affine(*args, **kwargs))
+
+
+async def afsl_biascorrect(*args, **kwargs):
+    """
+    Asynchronous version of `fsl_biascorrect`
+    """
+    return await arun_steps(_fsl_biascorrect(*args, **kwargs))
+
+
+async def afast(*args, **kwargs):
+    """
+    Asynchronous version of `fast`
+    """
+    return await arun_steps(_fast(*args, **kwargs))
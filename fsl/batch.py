@@ -0,0 +1,210 @@
+"""
+Run many FSL wrapper calls at once on a thread or process pool
+"""
+
+__all__ = ['batch', 'BatchResult']
+
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from .fslhd import get_job_env, set_job_env
+from .journal import Journal
+from .scheduler import Scheduler, get_scheduler
+from .supervisor import set_job_cpus, job_usage
+
+
+BatchResult = namedtuple('BatchResult', ['value', 'error'])
+
+# variables read by FSL, BLAS and ITK to size their thread pools
+THREAD_ENV_VARS = ('OMP_NUM_THREADS',
+                   'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS',
+                   'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS')
+
+
+def thread_env(threads):
+    """
+    Environment variables that limit a job to `threads` threads
+    """
+    return {var: str(threads) for var in THREAD_ENV_VARS}
+
+
+def _split_job(job):
+    """
+    Turn a job description into positional and keyword arguments.
+    A dict is keyword arguments, an (args, kwargs) pair is both,
+    any other tuple/list is positional arguments and anything else
+    is a single positional argument (e.g. a filename).
+    """
+    if isinstance(job, dict):
+        return (), job
+    if isinstance(job, (tuple, list)):
+        if len(job) == 2 and isinstance(job[0], (tuple, list)) and isinstance(job[1], dict):
+            return tuple(job[0]), job[1]
+        return tuple(job), {}
+    return (job,), {}
+
+
+def _run_job(func, job, env, scheduler=None, threads=None):
+    args, kwargs = _split_job(job)
+    if scheduler is None:
+        return _call(func, args, kwargs, env)
+
+    estimate = scheduler.estimate(func, args, kwargs, threads=threads)
+    with scheduler.admit(estimate) as cpus:
+        set_job_cpus(cpus)
+        job_usage(reset=True)
+        try:
+            result = _call(func, args, kwargs,
+                           dict(env or {}, **thread_env(len(cpus))))
+        finally:
+            set_job_cpus(None)
+        maxrss, cpu = job_usage()
+    if result.error is None:
+        scheduler.record(estimate, maxrss)
+    return result
+
+
+def _resolve_scheduler(scheduler):
+    if scheduler is True:
+        return get_scheduler()
+    if scheduler is not None and scheduler is not False and not isinstance(scheduler, Scheduler):
+        raise ValueError('scheduler must be a Scheduler, True or None')
+    return scheduler or None
+
+
+def _call(func, args, kwargs, env):
+    previous = get_job_env()
+    set_job_env(env)
+    try:
+        return BatchResult(func(*args, **kwargs), None)
+    except Exception as e:
+        return BatchResult(None, e)
+    finally:
+        set_job_env(previous)
+
+
+def _init_process(env):
+    os.environ.update(env)
+
+
+def batch(func, jobs, max_workers=None, threads_per_job=None,
+          processes=False, raise_errors=False, scheduler=None, journal=None):
+    """
+    Run a wrapper function over many jobs in parallel
+
+    Each job runs `func` on a pool worker, with OMP_NUM_THREADS (and
+    friends) set for its FSL subprocesses so that concurrent jobs do
+    not oversubscribe the cores.
+
+    Arguments
+    ---------
+    func : callable
+        wrapper to run, e.g. `fsl.flirt` or `fsl.fslbet`
+
+    jobs : iterable
+        one entry per call. A dict is passed as keyword arguments, an
+        (args, kwargs) pair as both, a tuple/list as positional arguments
+        and anything else as the single positional argument
+
+    max_workers : integer
+        number of concurrent jobs (default: number of cores)
+
+    threads_per_job : integer
+        threads each job may use (default: cores / max_workers, at least 1)
+
+    processes : boolean
+        use a process pool instead of a thread pool. `func` and its
+        results must then be picklable
+
+    raise_errors : boolean
+        re-raise the first job error (in job order) instead of returning it
+
+    scheduler : Scheduler | True
+        admit each job against the scheduler's RAM and core budget, with
+        the memory and threads estimated for it, and pin it to its own
+        CPUs (see fsl.scheduler). True uses the node-wide scheduler.
+        max_workers then defaults to the scheduler's cores and
+        threads_per_job, if given, overrides the estimated threads
+
+    journal : string | Journal
+        record every job in this journal file (see fsl.journal) and skip
+        the jobs it has as done with their outputs unchanged, so that a
+        batch that was interrupted can be run again and only does what is
+        missing, failed or stale
+
+    Returns
+    -------
+    list of BatchResult(value, error), in the same order as `jobs`
+
+    Example
+    -------
+    >>> import fsl
+    >>> jobs = [dict(infile=f, reffile='~/desktop/template.nii.gz', dof=12)
+    ...         for f in ['~/desktop/img1.nii.gz', '~/desktop/img2.nii.gz']]
+    >>> results = fsl.batch(fsl.flirt, jobs, max_workers=2)
+    >>> imgs = [r.value for r in results if r.error is None]
+    """
+    jobs = list(jobs)
+    scheduler = _resolve_scheduler(scheduler)
+    if journal is not None and not isinstance(journal, Journal):
+        journal = Journal(journal)
+
+    results = [None] * len(jobs)
+    entries = {}
+    if journal is not None:
+        for i, job in enumerate(jobs):
+            entries[i] = journal.job(func, *_split_job(job))
+            restored = journal.restore(entries[i])
+            if restored is not None:
+                results[i] = BatchResult(restored[0], None)
+    todo = [i for i in range(len(jobs)) if results[i] is None]
+
+    if scheduler is not None:
+        if processes:
+            raise ValueError('a scheduler needs processes=False')
+        if max_workers is None:
+            max_workers = len(scheduler.cores)
+        max_workers = max(1, min(max_workers, len(todo) or 1))
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        args = (None, scheduler, threads_per_job)
+    else:
+        ncores = os.cpu_count() or 1
+        if max_workers is None:
+            max_workers = ncores
+        max_workers = max(1, min(max_workers, len(todo) or 1))
+        if threads_per_job is None:
+            threads_per_job = max(1, ncores // max_workers)
+
+        env = thread_env(threads_per_job)
+        args = (env,)
+
+        if processes:
+            pool = ProcessPoolExecutor(max_workers=max_workers,
+                                       initializer=_init_process,
+                                       initargs=(env,))
+        else:
+            pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    with pool:
+        futures = {}
+        for i in todo:
+            if journal is not None:
+                journal.start(entries[i])
+            futures[pool.submit(_run_job, func, jobs[i], *args)] = i
+        # recorded as they finish, so an interrupted batch keeps them
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if journal is not None:
+                journal.finish(entries[i], *results[i])
+    return _check(results, raise_errors)
+
+
+def _check(results, raise_errors):
+    if raise_errors:
+        for result in results:
+            if result.error is not None:
+                raise result.error
+    return results
@@ -0,0 +1,387 @@
+"""
+Content-addressed on-disk cache of FSL results
+
+When enabled with `set_fslcache`, `flirt`, `fnirt`, `fslbet` and
+`fsl_biascorrect` first look up their outputs in the cache, keyed by a
+fingerprint of the input images, the tool, the normalised options and
+the FSL version. On a hit the stored outputs are copied into place and
+the binary is not run.
+
+Entries are evicted least-recently-used once the cache grows past its
+size bound. A lock file per key marks a call that is being looked up or
+run. An identical call made meanwhile (in another thread, process or
+task) waits for it and then restores what it stored, so the binary runs
+once. The wait blocks the thread the wrapper runs in, a worker thread
+for the `fsl.aio` coroutines, never the event loop.
+"""
+
+__all__ = ['fingerprint',
+           'result_cache',
+           'clear_fslcache']
+
+import glob
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from tempfile import mkdtemp
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - no cross-process locking on Windows
+    fcntl = None
+
+from . import config
+
+
+IMG_EXTS = ('.nii.gz', '.nii', '.hdr.gz', '.img.gz', '.hdr', '.img')
+
+# extensions of the files an output stub stands for: the stub itself,
+# images, matrices and surfaces (bet's meshes)
+OUTPUT_EXTS = ('',) + IMG_EXTS + ('.mat', '.vtk', '.off')
+
+# options of each tool that name output files (their values are outputs,
+# not inputs, and do not go into the cache key)
+OUTPUT_FLAGS = {
+    'flirt': ('-out', '-o', '-omat'),
+    'fnirt': ('--cout', '--fout', '--jout', '--refout', '--intout',
+              '--logout', '--iout'),
+    'fast': ('-o', '--out'),
+    'bet': (),
+    'bet2': (),
+}
+
+_CHUNK = 1 << 20
+
+# fingerprints of files on disk, keyed by (path, size, mtime)
+_file_digests = {}
+_file_digests_lock = threading.Lock()
+
+
+def _stub(path):
+    for ext in IMG_EXTS:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def _stub_files(stub, suffixes=(), exts=OUTPUT_EXTS):
+    """
+    Existing files an output stub stands for: <stub><ext> and, for the
+    outputs FSL writes next to it, <stub>_<suffix><ext>
+    """
+    files = []
+    for name in [stub] + ['%s_%s' % (stub, suffix) for suffix in suffixes]:
+        files.extend(name + ext for ext in exts if os.path.isfile(name + ext))
+    return files
+
+
+def _hash_file(path):
+    path = os.path.realpath(os.path.expanduser(path))
+    st = os.stat(path)
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    with _file_digests_lock:
+        digest = _file_digests.get(memo_key)
+    if digest is None:
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_CHUNK), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with _file_digests_lock:
+            _file_digests[memo_key] = digest
+    return digest
+
+
+def fingerprint(img):
+    """
+    Fast content fingerprint of an image
+
+    Arguments
+    ---------
+    img : string | nibabel image | ants image
+        filename (hashed on its bytes) or in-memory image (hashed on its
+        voxel data and header/geometry)
+
+    Returns
+    -------
+    string
+    """
+    if isinstance(img, str):
+        return _hash_file(img)
+
+    import numpy as np
+
+    h = hashlib.blake2b(digest_size=20)
+    if hasattr(img, 'dataobj'):
+        # nibabel
+        h.update(img.header.binaryblock)
+        h.update(np.asarray(img.affine, dtype='float64').tobytes())
+        data = np.asanyarray(img.dataobj)
+    else:
+        # ants
+        for attr in (img.spacing, img.origin, img.direction):
+            h.update(np.asarray(attr, dtype='float64').tobytes())
+        h.update(str(img.pixeltype).encode())
+        data = img.numpy()
+    h.update(str((data.dtype.str, data.shape)).encode())
+    h.update(np.ascontiguousarray(data).data)
+    return h.hexdigest()
+
+
+def _normalise_opts(tool, opts):
+    """
+    Split an options string into the part that goes into the cache key
+    (input files replaced by their fingerprint) and the output files it
+    names, as {flag: path}
+    """
+    out_flags = OUTPUT_FLAGS.get(tool, ())
+    tokens = shlex.split(opts or '')
+    keyed, outputs = [], {}
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        flag, sep, value = token.partition('=')
+        if token.startswith('-') and flag in out_flags:
+            if not sep and i + 1 < len(tokens):
+                i += 1
+                value = tokens[i]
+            outputs[flag.lstrip('-')] = os.path.expanduser(value)
+            keyed.append(flag)
+        elif token.startswith('-') and sep:
+            keyed.append('%s=%s' % (flag, _keyed_value(value)))
+        else:
+            keyed.append(_keyed_value(token))
+        i += 1
+    return ' '.join(keyed), outputs
+
+
+def _keyed_value(value):
+    path = os.path.expanduser(value)
+    if os.path.isfile(path):
+        return 'file:%s' % _hash_file(path)
+    return value
+
+
+class CacheEntry(object):
+    """
+    One cached call. `hit` tells whether the outputs were restored from
+    the cache; otherwise run the tool and call `store`.
+    """
+    def __init__(self, root=None, key=None, stubs=None, files=None,
+                 suffixes=()):
+        self.root = root
+        self.key = key
+        self.stubs = stubs or {}
+        self.files = files or {}
+        self.suffixes = tuple(suffixes)
+        self.hit = False
+        self.started = time.time()
+
+    @property
+    def path(self):
+        return os.path.join(self.root, self.key[:2], self.key)
+
+    def restore(self):
+        """
+        Copy the stored outputs into place, returns True on success
+        """
+        if self.key is None:
+            return False
+        manifest_file = os.path.join(self.path, 'manifest.json')
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            for role, suffixes in manifest['stubs'].items():
+                for suffix in suffixes:
+                    shutil.copyfile(os.path.join(self.path, role + suffix),
+                                    self.stubs[role] + suffix)
+            for role in manifest['files']:
+                shutil.copyfile(os.path.join(self.path, role), self.files[role])
+            os.utime(manifest_file)
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        self.hit = True
+        return True
+
+    def store(self, retval=0):
+        """
+        Store the outputs of a successful run
+        """
+        if self.key is None or retval != 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmpdir = mkdtemp(prefix='.tmp-', dir=os.path.dirname(self.path))
+        try:
+            manifest = {'stubs': {}, 'files': [], 'size': 0}
+            for role, stub in self.stubs.items():
+                manifest['stubs'][role] = []
+                for fname in _stub_files(stub, self.suffixes):
+                    # only files written by this run
+                    if os.path.getmtime(fname) < self.started - 1:
+                        continue
+                    suffix = fname[len(stub):]
+                    shutil.copyfile(fname, os.path.join(tmpdir, role + suffix))
+                    manifest['stubs'][role].append(suffix)
+                    manifest['size'] += os.path.getsize(fname)
+            for role, fname in self.files.items():
+                if os.path.exists(fname):
+                    shutil.copyfile(fname, os.path.join(tmpdir, role))
+                    manifest['files'].append(role)
+                    manifest['size'] += os.path.getsize(fname)
+            with open(os.path.join(tmpdir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path, ignore_errors=True)
+            os.rename(tmpdir, self.path)
+        except (IOError, OSError):
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        _evict(self.root, config.FSL_CACHE_SIZE)
+
+
+@contextmanager
+def _flock(path, blocking=True):
+    """
+    Exclusive lock on a lock file, yields whether it was acquired
+    """
+    if fcntl is None:
+        yield True
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except (IOError, OSError):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _lockfile(root, key):
+    lockdir = os.path.join(root, 'locks')
+    os.makedirs(lockdir, exist_ok=True)
+    return os.path.join(lockdir, '%s.lock' % key)
+
+
+def _evict(root, max_size):
+    """
+    Remove least-recently-used entries until the cache fits in max_size
+    """
+    if max_size is None:
+        return
+    with _flock(os.path.join(root, '.evict.lock'), blocking=False) as locked:
+        if not locked:
+            # another process is already evicting
+            return
+        entries = []
+        for manifest_file in glob.glob(os.path.join(root, '??', '*', 'manifest.json')):
+            try:
+                with open(manifest_file) as f:
+                    size = json.load(f)['size']
+                entries.append((os.path.getmtime(manifest_file), size,
+                                os.path.dirname(manifest_file)))
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        total = sum(e[1] for e in entries)
+        for atime, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            key = os.path.basename(path)
+            # skip entries that are being read or written right now
+            with _flock(_lockfile(root, key), blocking=False) as locked:
+                if locked:
+                    shutil.rmtree(path, ignore_errors=True)
+                    total -= size
+
+
+@contextmanager
+def result_cache(tool, inputs, opts='', stubs=None, files=None, suffixes=(),
+                 **params):
+    """
+    Look up the outputs of an FSL call in the cache
+
+    While the block runs, identical calls in other threads and processes
+    wait for it to finish, then get the outputs it stored.
+
+    Arguments
+    ---------
+    tool : string
+        FSL binary name
+
+    inputs : sequence
+        input images (filenames or in-memory images)
+
+    opts : string
+        options passed to the tool
+
+    stubs : dict
+        output image stubs (paths without extension), by role. The files
+        <stub><ext> and <stub>_<suffix><ext> written by the run are cached
+
+    suffixes : sequence of strings
+        outputs the tool writes next to each stub (e.g. 'mask' for bet -m)
+
+    files : dict
+        other output files (e.g. matrices), by role
+
+    params : keywords
+        other parameters that change the result (e.g. dof)
+
+    Example
+    -------
+    >>> with result_cache('flirt', (infile, reffile), opts,
+    ...                   stubs={'out': outfile}, files={'omat': omat}) as cache:
+    ...     if not cache.hit:
+    ...         retval, stdout = system_cmd(cmd)
+    ...         cache.store(retval)
+    """
+    root = config.FSL_CACHE
+    stubs = {role: _stub(os.path.expanduser(p)) for role, p in (stubs or {}).items()}
+    files = {role: os.path.expanduser(p) for role, p in (files or {}).items()}
+    if root is None:
+        yield CacheEntry(stubs=stubs, files=files, suffixes=suffixes)
+        return
+
+    from .environment import get_fsl_env
+    from .fslhd import get_fsloutput
+
+    keyed_opts, opt_outputs = _normalise_opts(tool, opts)
+    stubs.update((role, _stub(p)) for role, p in opt_outputs.items())
+    key_data = [tool, get_fsl_env().version, get_fsloutput(), keyed_opts,
+                sorted((k, repr(v)) for k, v in params.items()),
+                [fingerprint(img) for img in inputs]]
+    key = hashlib.blake2b(json.dumps(key_data).encode(),
+                          digest_size=20).hexdigest()
+
+    entry = CacheEntry(root, key, stubs, files, suffixes)
+    if entry.restore():
+        yield entry
+        return
+    # a miss: run the call, or wait for an identical one that is running
+    # and restore what it stored
+    with _flock(_lockfile(root, key)):
+        entry.started = time.time()
+        entry.restore()
+        yield entry
+
+
+def clear_fslcache():
+    """
+    Remove every entry of the result cache
+    """
+    root = config.FSL_CACHE
+    if root is None or not os.path.isdir(root):
+        return
+    for path in glob.glob(os.path.join(root, '??')):
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,351 @@
+"""
+Compression of final outputs
+
+FSL compresses .nii.gz outputs itself, on one thread, including outputs
+that are thrown away right after (FAST's seg file) and every file the
+wrapper reads straight back. The wrappers instead run FSL with
+FSLOUTPUTTYPE=NIFTI and gzip the final outputs here, on a thread pool.
+With `set_fslcompress(background=True)` a wrapper returns once its
+outputs are queued, so compression overlaps with the next job.
+
+Functions of this package wait for a file that is still being compressed
+before opening it or writing it again; other readers should call
+`wait_outputs` first.
+
+Compression itself is done by `GzipWriter`, which, like pigz, deflates
+independent blocks on several threads and writes each as its own gzip
+member. A file of concatenated members is a valid .gz file for gzip,
+zlib (FSL), nibabel and ITK. `save_image_gz` writes in-memory images
+through it, for staging inputs on disk.
+"""
+
+__all__ = ['wait_outputs',
+           'pending_outputs',
+           'GzipWriter',
+           'gzip_file',
+           'save_image_gz']
+
+import os
+import shutil
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mktemp
+
+from . import config
+
+
+# output flags whose files FSL names itself: their type is left to FSL
+NAMED_OUTPUTS = {
+    'flirt': ('-out', '-o'),
+    'fnirt': ('--cout', '--fout', '--jout', '--refout', '--intout', '--iout'),
+    'fast': ('-o', '--out'),
+}
+
+_CHUNK = 1 << 20
+
+# uncompressed bytes per gzip member written by GzipWriter
+GZIP_BLOCK = 1 << 20
+
+_lock = threading.Lock()
+_pool = None
+_pool_workers = None
+_pending = {}  # .nii.gz path -> Future
+
+# deflate threads shared by every GzipWriter
+_deflate_pool = None
+_deflate_threads = None
+
+
+def _executor():
+    global _pool, _pool_workers
+    with _lock:
+        if _pool is None or _pool_workers != config.FSL_COMPRESS_WORKERS:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool_workers = config.FSL_COMPRESS_WORKERS
+            _pool = ThreadPoolExecutor(max_workers=_pool_workers,
+                                       thread_name_prefix='fsl-gzip')
+        return _pool
+
+
+def _deflate_executor():
+    """
+    The deflate pool of every GzipWriter: FSL_GZIP_THREADS threads (by
+    default one per core), however many files are compressed at once
+    """
+    global _deflate_pool, _deflate_threads
+    threads = config.FSL_GZIP_THREADS or os.cpu_count() or 1
+    with _lock:
+        if _deflate_pool is None or _deflate_threads != threads:
+            # not shut down: writers using the old pool finish with it
+            _deflate_pool = ThreadPoolExecutor(max_workers=threads,
+                                               thread_name_prefix='fsl-deflate')
+            _deflate_threads = threads
+        return _deflate_pool
+
+
+def write_type(outtype, temporary=False, tool=None, opts=''):
+    """
+    FSLOUTPUTTYPE to run FSL with for outputs meant to be `outtype`:
+    NIFTI for final NIFTI_GZ outputs (gzipped afterwards by
+    `compress_outputs`), `outtype` otherwise
+    """
+    if outtype != 'NIFTI_GZ' or temporary:
+        return outtype
+    flags = NAMED_OUTPUTS.get(tool, ())
+    for token in opts.split() if isinstance(opts, str) else opts:
+        if token.split('=', 1)[0] in flags:
+            # an output we do not know the name of would stay uncompressed
+            return outtype
+    return 'NIFTI'
+
+
+def _deflate(block, level):
+    # one complete gzip member (wbits 31: gzip header and trailer)
+    deflate = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return deflate.compress(block) + deflate.flush()
+
+
+class GzipWriter(object):
+    """
+    Write-only gzip file that compresses blocks in parallel
+
+    Data is cut into blocks of `block_size` bytes that are deflated
+    independently (zlib releases the GIL) and written in order, each as
+    a gzip member. The blocks are deflated on a thread pool shared by all
+    writers, sized by `set_fslgzip`, so that files compressed at once do
+    not each start a thread per core. At most two blocks per thread are
+    held in memory. Seeking forward (as nibabel does to the voxel offset)
+    writes zeros.
+
+    Arguments
+    ---------
+    filename : string
+        .gz file to write
+
+    level : integer
+        compression level 1-9 (default: set_fslgzip, 6)
+
+    threads : integer
+        blocks of this file deflated at once on the shared pool; 1
+        deflates on the writing thread (default: set_fslgzip, every core)
+
+    Example
+    -------
+    >>> from fsl.compress import GzipWriter
+    >>> with GzipWriter('~/desktop/img.nii.gz', level=4) as f:
+    ...     img.to_file_map(img.make_file_map({'image': f}))
+    """
+    def __init__(self, filename, level=None, threads=None,
+                 block_size=GZIP_BLOCK):
+        self.name = os.path.expanduser(filename)
+        self.mode = 'wb'
+        self.level = config.FSL_GZIP_LEVEL if level is None else int(level)
+        if threads is None:
+            threads = config.FSL_GZIP_THREADS or os.cpu_count() or 1
+        self.threads = max(1, int(threads))
+        self.block_size = int(block_size)
+        self._file = open(self.name, 'wb')
+        self._pool = _deflate_executor() if self.threads > 1 else None
+        self._blocks = deque()
+        self._buffer = bytearray()
+        self._pos = 0
+        self._members = 0
+        self.closed = False
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        raise IOError('GzipWriter is write-only')
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence != 0:
+            raise IOError('GzipWriter can only seek from the start')
+        if offset < self._pos:
+            raise IOError('GzipWriter cannot seek backwards')
+        if offset > self._pos:
+            self.write(bytes(offset - self._pos))
+        return self._pos
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed GzipWriter')
+        data = memoryview(data)
+        if not data.c_contiguous:
+            data = memoryview(data.tobytes())
+        data = data.cast('B')
+        self._buffer += data
+        self._pos += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        if self._pool is None:
+            self._file.write(_deflate(block, self.level))
+        else:
+            self._blocks.append(self._pool.submit(_deflate, block, self.level))
+            # keep every thread busy without holding the whole file
+            while len(self._blocks) > 2 * self.threads:
+                self._file.write(self._blocks.popleft().result())
+        self._members += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._buffer or not self._members:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._blocks:
+                self._file.write(self._blocks.popleft().result())
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def gzip_file(src, dst, level=None, threads=None):
+    """
+    Compress the file `src` to `dst` with `GzipWriter`
+    """
+    with open(os.path.expanduser(src), 'rb') as fin, \
+            GzipWriter(dst, level=level, threads=threads) as fout:
+        shutil.copyfileobj(fin, fout, GZIP_BLOCK)
+
+
+def save_image_gz(img, filename, level=None, threads=None):
+    """
+    Write an in-memory image to a .nii.gz file with `GzipWriter`:
+    nibabel images stream into it, others (ants) are written to an
+    uncompressed file first
+    """
+    filename = os.path.expanduser(filename)
+    if hasattr(img, 'make_file_map'):
+        if len(img.files_types) > 1:
+            # header / image pairs: nibabel names and compresses the files
+            img.to_filename(filename)
+            return filename
+        with GzipWriter(filename, level=level, threads=threads) as f:
+            img.to_file_map(img.make_file_map({'image': f}))
+        return filename
+    tmpfile = mktemp(suffix='.nii')
+    try:
+        img.to_file(tmpfile)
+        gzip_file(tmpfile, filename, level=level, threads=threads)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    return filename
+
+
+def _gzip_file(src, dst):
+    tmpfile = dst + '.part'
+    try:
+        gzip_file(src, tmpfile)
+        os.replace(tmpfile, dst)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    os.remove(src)
+
+
+def _finished(dst, future):
+    with _lock:
+        if _pending.get(dst) is future and future.exception() is None:
+            del _pending[dst]
+
+
+def compress(src):
+    """
+    Gzip an uncompressed output to `src + '.gz'` and remove it, in the
+    background if enabled. Gives back the compressed filename.
+    """
+    dst = src + '.gz'
+    wait_output(dst)
+    future = _executor().submit(_gzip_file, src, dst)
+    with _lock:
+        _pending[dst] = future
+    future.add_done_callback(lambda f: _finished(dst, f))
+    if not config.FSL_COMPRESS_BACKGROUND:
+        wait_output(dst)
+    return dst
+
+
+def compress_outputs(files):
+    """
+    Gzip the .nii outputs a run wrote (those of `files` that exist),
+    see `compress`
+
+    Returns
+    -------
+    list of the compressed filenames
+    """
+    return [compress(src) for src in files
+            if src.endswith('.nii') and os.path.exists(src)]
+
+
+def wait_output(path):
+    """
+    Wait until `path` (a filename or stub) is no longer being compressed;
+    raises the error of a failed compression
+    """
+    if not _pending:
+        return
+    path = os.path.expanduser(path)
+    for candidate in (path, path + '.nii.gz'):
+        with _lock:
+            future = _pending.get(candidate)
+        if future is None:
+            continue
+        try:
+            future.result()
+        finally:
+            # a failure is raised once
+            with _lock:
+                if _pending.get(candidate) is future:
+                    del _pending[candidate]
+
+
+def pending_outputs():
+    """
+    Outputs still being compressed in the background
+    """
+    with _lock:
+        return [path for path, future in _pending.items() if not future.done()]
+
+
+def wait_outputs():
+    """
+    Wait for every background compression to finish; raises the first
+    error among them
+    """
+    with _lock:
+        pending = list(_pending)
+    for path in pending:
+        wait_output(path)
@@ -4,13 +4,34 @@ Configuration file for FSL
 __all__ = ['set_fslpath', 
            'set_fsloutput',
            'set_fslpre',
-           'get_fslpre']
+           'get_fslpre',
+           'set_fslcache',
+           'get_fslcache',
+           'set_fslstaging',
+           'get_fslstaging',
+           'set_fslstagecache',
+           'set_fslcompress',
+           'set_fslgzip',
+           'set_fslscheduler']
 
+import os
 
 FSL_PATH = None
 FSL_OUTPUTTYPE = None
 FSL_PRE = None
 PYPACKAGE = 'ants'
+FSL_CACHE = None
+FSL_CACHE_SIZE = 20 * 1024**3
+FSL_STAGING = None
+FSL_STAGING_BUDGET = 0
+FSL_STAGE_CACHE = 8
+FSL_COMPRESS_BACKGROUND = False
+FSL_COMPRESS_WORKERS = 2
+FSL_GZIP_LEVEL = 6
+FSL_GZIP_THREADS = None
+FSL_SCHED_MEMORY = None
+FSL_SCHED_CORES = None
+FSL_SCHED_HISTORY = None
 
 def set_fslpath(path):
     global FSL_PATH 
@@ -44,4 +65,98 @@ def set_pypackage(p):
 
 def get_pypackage():
     global PYPACKAGE
-    return PYPACKAGE
\ No newline at end of file
+    return PYPACKAGE
+
+def set_fslcache(path, max_size=None):
+    """
+    Enable the on-disk result cache (see fsl.cache) in directory `path`,
+    bounded to `max_size` bytes. Pass None to disable it.
+    """
+    global FSL_CACHE, FSL_CACHE_SIZE
+    if path is not None:
+        path = os.path.abspath(os.path.expanduser(path))
+        os.makedirs(path, exist_ok=True)
+    FSL_CACHE = path
+    if max_size is not None:
+        FSL_CACHE_SIZE = int(max_size)
+
+def get_fslcache():
+    global FSL_CACHE
+    return FSL_CACHE
+
+
+def set_fslstaging(path='/dev/shm', budget=None):
+    """
+    Stage in-memory images and temporary outputs as uncompressed NIfTI in
+    a RAM-backed directory (see fsl.staging). `budget` bounds the bytes
+    staged there at once (default: half of its free space). Pass
+    path=None to disable staging.
+    """
+    global FSL_STAGING, FSL_STAGING_BUDGET
+    if path is None:
+        FSL_STAGING = None
+        return
+    path = os.path.abspath(os.path.expanduser(path))
+    if not os.path.isdir(path):
+        raise ValueError('staging directory %s doesnt exist' % path)
+    if budget is None:
+        st = os.statvfs(path)
+        budget = st.f_bavail * st.f_frsize // 2
+    FSL_STAGING = path
+    FSL_STAGING_BUDGET = int(budget)
+
+def get_fslstaging():
+    global FSL_STAGING
+    return FSL_STAGING
+
+
+def set_fslstagecache(n):
+    """
+    Keep up to `n` idle staged in-memory images for reuse by later calls
+    (see fsl.staging). 0 writes every image afresh for each call.
+    """
+    global FSL_STAGE_CACHE
+    FSL_STAGE_CACHE = int(n)
+
+
+def set_fslcompress(background=True, workers=None):
+    """
+    Gzip final .nii.gz outputs in the background (see fsl.compress): the
+    wrappers return while `workers` threads compress. background=False
+    compresses before returning.
+    """
+    global FSL_COMPRESS_BACKGROUND, FSL_COMPRESS_WORKERS
+    FSL_COMPRESS_BACKGROUND = bool(background)
+    if workers is not None:
+        FSL_COMPRESS_WORKERS = max(1, int(workers))
+
+
+def set_fslgzip(level=6, threads=None):
+    """
+    Compression level (1-9) and number of threads of the parallel gzip
+    writer (see fsl.compress.GzipWriter) used for .nii.gz files written
+    by the package. The threads are shared by every file compressed at
+    once; threads=None uses every core.
+    """
+    global FSL_GZIP_LEVEL, FSL_GZIP_THREADS
+    level = int(level)
+    if not 0 <= level <= 9:
+        raise ValueError('gzip level must be between 0 and 9')
+    FSL_GZIP_LEVEL = level
+    FSL_GZIP_THREADS = None if threads is None else max(1, int(threads))
+
+
+def set_fslscheduler(memory=None, cores=None, history=None):
+    """
+    Node-wide budget of the resource-aware scheduler (see fsl.scheduler):
+    `memory` bytes of RAM (default: 80% of the RAM available to the
+    process) and `cores` (a number or a list of CPU ids, default: every
+    CPU the process may use) shared by all scheduled jobs. `history` is a
+    JSON file the peak memory learned per tool is kept in.
+    """
+    global FSL_SCHED_MEMORY, FSL_SCHED_CORES, FSL_SCHED_HISTORY
+    FSL_SCHED_MEMORY = None if memory is None else int(memory)
+    if cores is not None and not isinstance(cores, int):
+        cores = tuple(sorted(int(c) for c in cores))
+    FSL_SCHED_CORES = cores
+    FSL_SCHED_HISTORY = None if history is None else os.path.abspath(os.path.expanduser(history))
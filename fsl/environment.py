@@ -0,0 +1,215 @@
+"""
+Resolved FSL environment
+
+`get_fsl` builds a shell prefix (`FSLDIR=...; PATH=...; ...`) that has to
+be parsed by /bin/sh on every call. Instead, the FSL installation is
+probed once here: the environment that fsl.sh sets up, the absolute
+path of every binary that is asked for and the installed FSL version.
+The result is cached and re-probed only when the configuration that
+it depends on (FSLDIR, FSLOUTPUTTYPE, `set_fslpath`, `set_fsloutput`,
+`set_fslpre`) changes.
+"""
+
+__all__ = ['FSLEnvironment',
+           'get_fsl_env',
+           'reset_fsl_env',
+           'format_cmd']
+
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+
+from . import config
+from .profiling import span
+
+
+DEFAULT_PATHS = ('/usr/local/fsl', '/usr/share/fsl/5.0', '/usr/share/fsl/5.1')
+
+_lock = threading.Lock()
+# (configuration key, FSLEnvironment) of the last probe
+_resolved = None
+
+
+class FSLEnvironment(object):
+    """
+    A probed FSL installation
+
+    Attributes
+    ----------
+    fsldir : string
+        FSL installation directory
+
+    bindir : string
+        directory holding the FSL binaries
+
+    env : dict
+        variables that the FSL setup adds to or changes in the environment
+        (FSLDIR, PATH, FSLOUTPUTTYPE and whatever fsl.sh sets)
+
+    version : string
+        FSL version from ${FSLDIR}/etc/fslversion, or None if unknown
+
+    prefix : string
+        prefix of the binary names (see `set_fslpre`)
+    """
+    def __init__(self, fsldir, bindir, env, version=None, prefix=''):
+        self.fsldir = fsldir
+        self.bindir = bindir
+        self.env = env
+        self.version = version
+        self.prefix = prefix
+        self._paths = {}
+
+    def which(self, tool):
+        """
+        Absolute path of an FSL binary
+        """
+        path = self._paths.get(tool)
+        if path is None:
+            name = '%s%s' % (self.prefix, tool)
+            path = shutil.which(name, path=self.environ().get('PATH'))
+            if path is None:
+                raise ValueError('Cant find FSL binary %s' % name)
+            self._paths[tool] = path
+        return path
+
+    def environ(self, extra=None):
+        """
+        Full environment to run FSL binaries with: the current process
+        environment updated with `env` and `extra`
+        """
+        environ = dict(os.environ)
+        environ.update(self.env)
+        if extra:
+            environ.update(extra)
+        return environ
+
+    def argv(self, tool, *args):
+        """
+        Build the argument list running an FSL binary
+        """
+        return [self.which(tool)] + [str(a) for a in args]
+
+    def __repr__(self):
+        return 'FSLEnvironment(fsldir=%r, version=%r)' % (self.fsldir, self.version)
+
+
+def format_cmd(argv):
+    """
+    Render an argument list as a shell command (for printing)
+    """
+    if isinstance(argv, str):
+        return argv
+    return ' '.join(shlex.quote(a) for a in argv)
+
+
+def _find_fsldir():
+    fsldir = os.getenv('FSLDIR')
+    if fsldir is None:
+        fsldir = config.FSL_PATH
+        if fsldir is None:
+            for default_path in DEFAULT_PATHS:
+                if os.path.exists(default_path):
+                    fsldir = default_path
+                    break
+        elif not os.path.exists(fsldir):
+            raise ValueError('fslpath is set but folder doesnt exist!')
+    if not fsldir:
+        raise ValueError('Cant find FSL')
+    return fsldir
+
+
+def _source_fslconf(fsldir, env):
+    """
+    Environment after sourcing ${FSLDIR}/etc/fslconf/fsl.sh
+    """
+    shfile = os.path.join(fsldir, 'etc', 'fslconf', 'fsl.sh')
+    if not os.path.exists(shfile):
+        return env
+    try:
+        res = subprocess.run(['/bin/sh', '-c', '. "$1" >/dev/null 2>&1; env -0',
+                              'sh', shfile],
+                             env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return env
+    if res.returncode != 0:
+        return env
+    sourced = {}
+    for item in res.stdout.decode('utf-8', 'replace').split('\0'):
+        key, sep, value = item.partition('=')
+        if sep:
+            sourced[key] = value
+    return sourced or env
+
+
+def _read_version(fsldir):
+    try:
+        with open(os.path.join(fsldir, 'etc', 'fslversion')) as f:
+            version = f.readline().strip()
+    except (IOError, OSError):
+        return None
+    # some releases append the build hash, e.g. 6.0.7.4:1234abcd
+    return version.split(':')[0] or None
+
+
+def _probe(fsldir, fslout, add_bin, prefix):
+    bindir = os.path.join(fsldir, 'bin') if add_bin else fsldir
+    env = dict(os.environ)
+    env['FSLDIR'] = fsldir
+    env['PATH'] = os.pathsep.join([bindir, env.get('PATH', '')])
+    env = _source_fslconf(fsldir, env)
+    env['FSLOUTPUTTYPE'] = fslout
+    env = {k: v for k, v in env.items() if os.environ.get(k) != v}
+    return FSLEnvironment(fsldir, bindir, env,
+                          version=_read_version(fsldir),
+                          prefix=prefix)
+
+
+def get_fsl_env(add_bin=True):
+    """
+    Get the resolved FSL environment, probing the installation if the
+    configuration changed since the last call
+
+    Arguments
+    ---------
+    add_bin : boolean
+        binaries are in ${FSLDIR}/bin (True) or ${FSLDIR} (False)
+
+    Returns
+    -------
+    FSLEnvironment
+
+    Example
+    -------
+    >>> import fsl
+    >>> fslenv = fsl.get_fsl_env()
+    >>> fslenv.version, fslenv.which('flirt')
+    """
+    from .fslhd import get_fsloutput
+
+    with span('env'):
+        fslout = get_fsloutput()
+        prefix = '' if config.FSL_PRE is None else str(config.FSL_PRE)
+        key = (os.getenv('FSLDIR'), config.FSL_PATH, fslout, prefix, add_bin)
+
+        global _resolved
+        resolved = _resolved
+        if resolved is not None and resolved[0] == key:
+            return resolved[1]
+
+        with _lock:
+            if _resolved is None or _resolved[0] != key:
+                _resolved = (key, _probe(_find_fsldir(), fslout, add_bin, prefix))
+            return _resolved[1]
+
+
+def reset_fsl_env():
+    """
+    Forget the resolved FSL environment, e.g. after (re)installing FSL
+    """
+    global _resolved
+    with _lock:
+        _resolved = None
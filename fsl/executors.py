@@ -0,0 +1,427 @@
+"""
+Backends that run the FSL commands of the wrapper functions
+
+`system_cmd`, and so every wrapper, hands its commands to the executor
+set with `set_executor`; the wrappers keep their arguments and read
+their outputs back once the executor reports the command finished.
+
+`InlineExecutor` (the default) runs each command straight away under
+the supervisor (see fsl.supervisor). `PoolExecutor` does the same but
+lets at most `max_jobs` commands run at once, however many threads
+call the wrappers. `ClusterExecutor` writes every command to a job
+script, submits it with fsl_sub (or any submit command printing a job
+id), and polls until the script has recorded its exit code; its inputs,
+outputs and temporary files must then be on a filesystem the cluster
+nodes share (set TMPDIR there and disable staging in /dev/shm).
+`QueueExecutor` is a local stand-in for a cluster: jobs are queued in a
+directory and run by `queue_worker` processes.
+
+Example
+-------
+>>> import fsl
+>>> fsl.set_fslstaging(None)
+>>> fsl.set_executor(fsl.ClusterExecutor('/shared/scratch/fsl_jobs',
+...                                      submit_args=('-q', 'short.q')))
+>>> img = fsl.flirt('/shared/img.nii.gz', '/shared/template.nii.gz')
+>>> with fsl.QueueExecutor('/tmp/fslqueue', workers=4) as executor:
+...     fsl.set_executor(executor)
+...     results = fsl.batch(fsl.fslbet, files)
+>>> fsl.set_executor(None)
+"""
+
+__all__ = ['Executor',
+           'InlineExecutor',
+           'PoolExecutor',
+           'ClusterExecutor',
+           'QueueExecutor',
+           'set_executor',
+           'get_executor',
+           'queue_worker',
+           'start_queue_workers']
+
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from .environment import format_cmd
+from .supervisor import JobResult, run_supervised, cmd_tool, get_policy
+
+
+class Executor(object):
+    """
+    Runs commands, see `run`
+    """
+    def run(self, cmd, env=None):
+        """
+        Run a command (argument list or shell command line) with the
+        given full environment (None: inherited) to completion
+
+        Returns
+        -------
+        JobResult (see fsl.supervisor)
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class InlineExecutor(Executor):
+    """
+    Run each command in a supervised local subprocess
+    """
+    def run(self, cmd, env=None):
+        return run_supervised(cmd, env=env)
+
+    def __repr__(self):
+        return 'InlineExecutor()'
+
+
+class PoolExecutor(InlineExecutor):
+    """
+    Run commands in local subprocesses, at most `max_jobs` (default:
+    number of cores) at a time; callers wait for a free slot
+    """
+    def __init__(self, max_jobs=None):
+        self.max_jobs = max(1, max_jobs or os.cpu_count() or 1)
+        self._slots = threading.BoundedSemaphore(self.max_jobs)
+
+    def run(self, cmd, env=None):
+        with self._slots:
+            return run_supervised(cmd, env=env)
+
+    def __repr__(self):
+        return 'PoolExecutor(max_jobs=%d)' % self.max_jobs
+
+
+# variables that always go into a job script when given
+JOB_ENV_VARS = ('FSLDIR', 'FSLOUTPUTTYPE')
+
+JOB_SCRIPT = """#!/bin/sh
+finish() {
+    echo $1 > %(jobdir)s/exitcode.tmp
+    mv %(jobdir)s/exitcode.tmp %(jobdir)s/exitcode
+}
+cd %(cwd)s || { finish 1; exit 1; }
+%(exports)s
+# run in the background so that a TERM from the batch system is handled
+# (and the exit code recorded) straight away
+trap 'kill $child 2>/dev/null; finish 143; exit 143' TERM INT
+(
+%(cmd)s
+) > %(jobdir)s/stdout 2> %(jobdir)s/stderr &
+child=$!
+wait $child
+finish $?
+"""
+
+# seconds a job may be missing from the batch system without having
+# written its exit code (which may take a while to show on a shared
+# filesystem) before it counts as lost
+LOST_AFTER = 60.0
+
+
+class ClusterExecutor(Executor):
+    """
+    Submit every command as a job script and poll for its completion
+
+    Arguments
+    ---------
+    workdir : string
+        directory (shared with the cluster nodes) the job directories
+        are made in
+
+    submit : string
+        submit command, given the submit_args and the script path. The
+        last word it prints is taken as the job id
+
+    submit_args : sequence of strings
+        extra arguments of the submit command; '{jobdir}' and '{name}'
+        are replaced by the job directory and name
+
+    cancel : string
+        command run with the job id when a job times out (e.g. 'qdel' or
+        'scancel'), none if None
+
+    poll : float
+        seconds between checks for finished jobs
+
+    keep : boolean
+        keep the job directories (scripts, stdout, stderr) after reading
+        them back
+
+    status : string
+        command run with the job id to check that a job is still queued
+        or running (e.g. 'squeue -h -j' or 'qstat -j'): a job for which
+        it fails or prints nothing, and that has not written its exit
+        code within `lost_after` seconds, failed (e.g. it was killed by the
+        batch system)
+
+    Jobs time out after the timeout of the tool's supervision policy
+    (see fsl.set_policy), if it has one. A job script that is sent TERM
+    records exit code 143. Without `status` a job killed outright before
+    it wrote its exit code is only noticed through the timeout.
+    """
+    lost_after = LOST_AFTER
+
+    def __init__(self, workdir, submit='fsl_sub',
+                 submit_args=('-l', '{jobdir}', '-N', '{name}'),
+                 cancel=None, poll=5.0, keep=False, status=None):
+        self.workdir = os.path.abspath(os.path.expanduser(workdir))
+        os.makedirs(self.workdir, exist_ok=True)
+        self.submit = submit
+        self.submit_args = tuple(submit_args)
+        self.cancel = cancel
+        self.poll = poll
+        self.keep = keep
+        self.status = status
+
+    def _script(self, cmd, env, jobdir):
+        # what the FSL environment and the job add to this process' one
+        exports = []
+        for var, value in sorted((env or {}).items()):
+            if var in JOB_ENV_VARS or os.environ.get(var) != value:
+                exports.append('%s=%s; export %s' % (var, shlex.quote(value), var))
+        return JOB_SCRIPT % {'cwd': shlex.quote(os.getcwd()),
+                             'exports': '\n'.join(exports),
+                             'cmd': format_cmd(cmd),
+                             'jobdir': shlex.quote(jobdir)}
+
+    def _submit(self, script, jobdir, name):
+        """
+        Submit a job script, gives back the job id
+        """
+        args = [a.replace('{jobdir}', jobdir).replace('{name}', name)
+                for a in self.submit_args]
+        result = run_supervised(shlex.split(self.submit) + args + [script])
+        if result.returncode != 0:
+            raise ValueError('%s failed: %s' % (self.submit, result.stderr.strip()))
+        words = result.stdout.split()
+        return words[-1] if words else name
+
+    def _cancel(self, jobid):
+        if self.cancel is not None:
+            run_supervised(shlex.split(self.cancel) + [jobid])
+
+    def _alive(self, jobid):
+        """
+        Whether a job is still queued or running: True, False or None
+        (unknown)
+        """
+        if self.status is None:
+            return None
+        result = run_supervised(shlex.split(self.status) + [jobid])
+        return result.returncode == 0 and bool(result.stdout.strip())
+
+    def run(self, cmd, env=None):
+        name = 'fsl_%s_%s' % (cmd_tool(cmd), uuid.uuid4().hex[:12])
+        jobdir = os.path.join(self.workdir, name)
+        os.makedirs(jobdir)
+        script = os.path.join(jobdir, 'job.sh')
+        with open(script, 'w') as f:
+            f.write(self._script(cmd, env, jobdir))
+        os.chmod(script, 0o755)
+
+        timeout = get_policy(cmd_tool(cmd)).timeout
+        start = time.perf_counter()
+        jobid = self._submit(script, jobdir, name)
+        exitcode = os.path.join(jobdir, 'exitcode')
+        timed_out = False
+        missing = None  # since when the job is no longer in the queue
+        try:
+            while not os.path.exists(exitcode):
+                now = time.perf_counter()
+                if timeout is not None and now - start > timeout:
+                    timed_out = True
+                    self._cancel(jobid)
+                    break
+                if self._alive(jobid) is False:
+                    if missing is None:
+                        missing = now
+                    elif now - missing > self.lost_after:
+                        break
+                else:
+                    missing = None
+                time.sleep(self.poll)
+        except BaseException:
+            self._cancel(jobid)
+            raise
+
+        returncode = None
+        lost = not timed_out and not os.path.exists(exitcode)
+        if lost:
+            # reported as killed
+            returncode = -signal.SIGKILL
+        elif not timed_out:
+            with open(exitcode) as f:
+                returncode = int(f.read().strip() or 1)
+        outputs = []
+        for stream in ('stdout', 'stderr'):
+            try:
+                with open(os.path.join(jobdir, stream), 'rb') as f:
+                    outputs.append(f.read())
+            except OSError:
+                outputs.append(b'')
+        if lost:
+            outputs[1] += (b'job %s ended without an exit code\n'
+                           % jobid.encode())
+        if not self.keep:
+            shutil.rmtree(jobdir, ignore_errors=True)
+        return JobResult(cmd=cmd, returncode=returncode,
+                         stdout=outputs[0].decode('unicode_escape'),
+                         stderr=outputs[1].decode('utf-8', 'replace'),
+                         maxrss=None, cpu_user=None, cpu_sys=None,
+                         wall=time.perf_counter() - start, attempts=1,
+                         timed_out=timed_out, cancelled=False)
+
+    def __repr__(self):
+        return 'ClusterExecutor(%r, submit=%r)' % (self.workdir, self.submit)
+
+
+class QueueExecutor(ClusterExecutor):
+    """
+    A local stand-in for a cluster: jobs are queued in `queue_dir` and
+    run by `queue_worker` processes (started here if `workers` > 0, or
+    separately with `start_queue_workers`). A job that times out is taken
+    off the queue, but a worker already running it lets it finish.
+    """
+    # the exit code is on a local filesystem
+    lost_after = 1.0
+
+    def __init__(self, queue_dir, workers=0, poll=0.1, keep=False):
+        self.queue_dir = os.path.abspath(os.path.expanduser(queue_dir))
+        for sub in ('pending', 'running'):
+            os.makedirs(os.path.join(self.queue_dir, sub), exist_ok=True)
+        ClusterExecutor.__init__(self, os.path.join(self.queue_dir, 'jobs'),
+                                 poll=poll, keep=keep)
+        self.workers = start_queue_workers(self.queue_dir, workers) if workers else []
+
+    def _submit(self, script, jobdir, name):
+        # the rename makes the job visible to the workers at once
+        marker = os.path.join(self.queue_dir, 'pending', name)
+        with open(marker + '.tmp', 'w') as f:
+            f.write(script)
+        os.rename(marker + '.tmp', marker)
+        return name
+
+    def _cancel(self, jobid):
+        for sub in ('pending', 'running'):
+            try:
+                os.remove(os.path.join(self.queue_dir, sub, jobid))
+            except OSError:
+                pass
+
+    def _alive(self, jobid):
+        # the worker running it takes it off the queue after it finished
+        return any(os.path.exists(os.path.join(self.queue_dir, sub, jobid))
+                   for sub in ('pending', 'running'))
+
+    def close(self):
+        """
+        Stop the workers started by this executor
+        """
+        if not self.workers:
+            return
+        open(os.path.join(self.queue_dir, 'stop'), 'w').close()
+        for proc in self.workers:
+            proc.wait()
+        os.remove(os.path.join(self.queue_dir, 'stop'))
+        self.workers = []
+
+    def __repr__(self):
+        return 'QueueExecutor(%r, workers=%d)' % (self.queue_dir, len(self.workers))
+
+
+def _claim(queue_dir):
+    """
+    Move the oldest pending job to running, gives back its name and
+    script, or None if there is none
+    """
+    pending = os.path.join(queue_dir, 'pending')
+    names = [n for n in os.listdir(pending) if not n.endswith('.tmp')]
+    names.sort(key=lambda n: os.path.getmtime(os.path.join(pending, n))
+               if os.path.exists(os.path.join(pending, n)) else 0)
+    for name in names:
+        running = os.path.join(queue_dir, 'running', name)
+        try:
+            os.rename(os.path.join(pending, name), running)
+        except OSError:
+            # claimed by another worker
+            continue
+        with open(running) as f:
+            return name, f.read()
+    return None
+
+
+def queue_worker(queue_dir, poll=0.1, max_jobs=None):
+    """
+    Run jobs queued by a `QueueExecutor` one after the other, until a
+    'stop' file appears in the queue directory (or `max_jobs` ran)
+    """
+    queue_dir = os.path.abspath(os.path.expanduser(queue_dir))
+    done = 0
+    while not os.path.exists(os.path.join(queue_dir, 'stop')):
+        if max_jobs is not None and done >= max_jobs:
+            break
+        job = _claim(queue_dir)
+        if job is None:
+            time.sleep(poll)
+            continue
+        name, script = job
+        # names are fsl_<tool>_<id>, the tool's policy applies
+        run_supervised(['/bin/sh', script], tool=name[4:].rsplit('_', 1)[0])
+        try:
+            os.remove(os.path.join(queue_dir, 'running', name))
+        except OSError:
+            pass
+        done += 1
+
+
+def start_queue_workers(queue_dir, n=1):
+    """
+    Start `n` worker processes for a directory queue, gives back their
+    Popen objects
+    """
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_root] + [p for p in [env.get('PYTHONPATH')] if p])
+    code = 'import sys; from fsl.executors import queue_worker; queue_worker(sys.argv[1])'
+    return [subprocess.Popen([sys.executable, '-c', code, queue_dir], env=env)
+            for _ in range(n)]
+
+
+_executor = None
+
+
+def set_executor(executor):
+    """
+    Run the wrappers' FSL commands with this Executor (None: the
+    default InlineExecutor)
+    """
+    global _executor
+    if executor is not None and not isinstance(executor, Executor):
+        raise ValueError('executor must be an Executor')
+    _executor = executor
+
+
+def get_executor():
+    """
+    The Executor the wrappers' FSL commands are run with
+    """
+    return _executor or _inline
+
+
+_inline = InlineExecutor()
@@ -1,16 +1,27 @@
 
 
-__all__ = ['fsl_biascorrect']
+__all__ = ['fsl_biascorrect',
+           'fast',
+           'FAST_OUTPUTS']
 
 import os
+import re
+import shlex
+import weakref
 
-from .fslhd import (checkimg, check_outfile, 
-                    get_fsl, get_imgext, readnii, 
-                    remove_tempfile, system_cmd)
+from .environment import get_fsl_env, format_cmd
+from .cache import result_cache, _stub_files
+from .compress import write_type, compress_outputs
+from .staging import (is_temp_output, resolve_output_type, detach,
+                      staging_enabled, release, keep_output)
+from .fslhd import (checkimg, check_outfile,
+                    get_imgext, readnii,
+                    remove_tempfile, run_steps)
 
 
 def fsl_biascorrect(file, outfile=None, retimg=True, reorient=False, 
-                    opts='', verbose=True, remove_seg=True, **kwargs):
+                    opts='', verbose=True, remove_seg=True, output_type=None,
+                    **kwargs):
     """
     FSL Bias Correct
     
@@ -38,6 +49,10 @@ def fsl_biascorrect(file, outfile=None, retimg=True, reorient=False,
     
     remove_seg : (logical 
          Should segmentation from FAST be removed? 
+
+    output_type : string
+        FSLOUTPUTTYPE of the output, e.g. 'NIFTI' (default: the configured
+        type for outfile, plain NIFTI for temporary outputs)
     
     kwargs : additional arguments 
         passed to \code{\link{readnii}}. 
@@ -51,27 +66,60 @@ def fsl_biascorrect(file, outfile=None, retimg=True, reorient=False,
     >>> import fsl
     >>> fsl.fsl_biascorrect(file='~/desktop/img.nii.gz', outfile='~/desktop/img_bc.nii.gz', False)
     """
-    cmd = get_fsl()
+    return run_steps(_fsl_biascorrect(file, outfile=outfile, retimg=retimg,
+                                      reorient=reorient, opts=opts,
+                                      verbose=verbose, remove_seg=remove_seg,
+                                      output_type=output_type,
+                                      **kwargs))
+
+
+def _fsl_biascorrect(file, outfile=None, retimg=True, reorient=False,
+                     opts='', verbose=True, remove_seg=True, output_type=None,
+                     **kwargs):
+    fslenv = get_fsl_env()
+    inputs = (file,)
     file, fileremove = checkimg(file, **kwargs)
 
-    cmd = '%sfast ' % cmd
-    #no_outfile = outfile is None
+    temporary = outfile is None or is_temp_output(outfile)
+    outtype = resolve_output_type(temporary, output_type)
+    runtype = write_type(outtype, temporary, 'fast', opts)
     outfile = check_outfile(outfile=outfile, retimg=retimg, fileext='')
     outfile = outfile.split('.')[0]
     
-    cmd = '%s %s -B --nopve --out="%s" "%s";' % (cmd, opts, outfile, file)
+    cmd = fslenv.argv('fast', *shlex.split(opts))
+    cmd += ['-B', '--nopve', '--out=%s' % outfile, file]
     
     if verbose:
-        print(cmd, '\n')
+        print(format_cmd(cmd), '\n')
 
-    retval, stdout = system_cmd(cmd)
+    written = _fast_written(['-B', '--nopve'] + shlex.split(opts),
+                            _opts_nclass(opts))
+    try:
+        with result_cache('fast', inputs, opts, mode='-B --nopve',
+                          outtype=runtype, stubs={'out': outfile},
+                          suffixes=written) as cache:
+            if cache.hit:
+                retval = 0
+            else:
+                retval, stdout = yield cmd, {'FSLOUTPUTTYPE': runtype}
+                cache.store(retval)
+    except BaseException:
+        # interrupted (cancelled, timed out): nothing to read back
+        if temporary: remove_tempfile('%s%s' % (outfile, get_imgext(runtype)))
+        raise
+    finally:
+        # the staged copy of an in-memory input
+        if fileremove: remove_tempfile(file)
 
-    ext = get_imgext()
+    ext = get_imgext(runtype)
     stub = outfile.split('.')[0]
+    if temporary and retval != 0:
+        # nothing to read back from it
+        remove_tempfile('%s%s' % (stub, ext))
     seg_file = '%s_seg%s' % (stub, ext)
     
     if remove_seg: 
-        os.remove(seg_file)
+        remove_tempfile(seg_file)
 
     output = '%s_restore%s' % (stub, ext)
     outfile = '%s%s' % (stub, ext)
@@ -79,10 +127,230 @@ def fsl_biascorrect(file, outfile=None, retimg=True, reorient=False,
 
     if retimg:
         img = readnii(outfile, reorient=reorient, **kwargs)
-        if fileremove:
-            remove_tempfile(file)
+        if temporary and staging_enabled():
+            img = detach(img)
+            remove_tempfile(outfile)
+        elif runtype != outtype:
+            # its file is compressed next
+            img = detach(img)
+        elif temporary:
+            # the image is read from it
+            keep_output(outfile)
+    if runtype != outtype and retval == 0:
+        # the output and whatever else FAST wrote next to it (kept seg,
+        # bias field)
+        compress_outputs(_stub_files(stub, written, exts=('.nii',)))
+    if retimg:
         return img
     else:
         return retval
 
 
+
+
+# outputs of fast() besides the per-class pve_<i>, seg_<i> and prob_<i>
+FAST_OUTPUTS = ('restore', 'bias', 'seg', 'pveseg', 'mixeltype')
+
+# FAST flags that make it write an output (seg is always written)
+_OUTPUT_FLAGS = (('restore', '-B'), ('bias', '-b'), ('seg_', '-g'),
+                 ('prob_', '-p'))
+# outputs of the partial volume step, skipped with --nopve
+_PVE_OUTPUTS = ('pveseg', 'mixeltype', 'pve_')
+
+
+def _opts_nclass(opts, default=3):
+    """
+    Number of tissue classes set in FAST options (-n / --class)
+    """
+    tokens = shlex.split(opts or '')
+    for i, token in enumerate(tokens):
+        if token in ('-n', '--class') and i + 1 < len(tokens):
+            return int(tokens[i + 1])
+        if token.startswith('--class='):
+            return int(token.split('=', 1)[1])
+    return default
+
+
+def _fast_written(flags, nclass):
+    """
+    Outputs FAST writes when run with these flags (seg always)
+    """
+    names = ['seg']
+    for prefix, flag in _OUTPUT_FLAGS:
+        if flag not in flags:
+            continue
+        if prefix.endswith('_'):
+            names.extend('%s%d' % (prefix, i) for i in range(nclass))
+        else:
+            names.append(prefix)
+    if '--nopve' not in flags:
+        names.extend(['pveseg', 'mixeltype'] + ['pve_%d' % i for i in range(nclass)])
+    return names
+
+
+def _fast_outputs(outputs, nclass):
+    """
+    Check and expand the requested outputs ('pve' is every pve_<i>)
+    """
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    names = []
+    for name in outputs:
+        if name in ('pve', 'seg_', 'prob_'):
+            expanded = ['%s_%d' % (name.rstrip('_'), i) for i in range(nclass)]
+        else:
+            match = re.match(r'^(pve|seg|prob)_(\d+)$', name)
+            if name not in FAST_OUTPUTS and (match is None or
+                                             int(match.group(2)) >= nclass):
+                raise ValueError('Unknown FAST output %s' % name)
+            expanded = [name]
+        names.extend(n for n in expanded if n not in names)
+    if not names:
+        raise ValueError('No FAST output requested')
+    return names
+
+
+def fast(file, outputs=('restore', 'seg', 'pve'), outfile=None, nclass=3,
+         img_type=1, retimg=True, reorient=False, opts='', verbose=True,
+         output_type=None, **kwargs):
+    """
+    Segment and bias-correct with FAST in one run
+
+    FAST is run once, with only the flags the requested outputs need:
+    -B for the restored image, -b for the bias field, -g / -p for the
+    per-class segmentations / probabilities, and --nopve unless a
+    partial volume output (pve_<i>, pveseg, mixeltype) is requested.
+    Files FAST writes that were not requested are removed.
+
+    Arguments
+    ---------
+    file : string | ants image | nibabel image
+        image to be segmented
+
+    outputs : list of strings
+        any of 'restore', 'bias', 'seg', 'pveseg', 'mixeltype',
+        'pve_<i>', 'seg_<i>', 'prob_<i>' (i < nclass), or 'pve' /
+        'seg_' / 'prob_' for all classes
+
+    outfile : string
+        output basename, FAST writes <outfile>_<output> (default:
+        temporary files)
+
+    nclass : integer
+        number of tissue classes (-n)
+
+    img_type : integer
+        1 for T1, 2 for T2, 3 for PD (-t)
+
+    retimg : boolean
+        return images instead of filenames
+
+    reorient : boolean
+        If retimg, should the images be reoriented when read in?
+
+    opts : string
+        other options passed to \code{fast}
+
+    verbose : boolean
+        print out command before running
+
+    output_type : string
+        FSLOUTPUTTYPE of the outputs (default: the configured type for
+        outfile, plain NIFTI for temporary outputs)
+
+    kwargs : additional arguments
+        passed to \code{\link{readnii}}
+
+    Returns
+    -------
+    dict of output name -> LazyImage (voxel data read on first use),
+    or -> filename if retimg is False. Temporary files are removed once
+    their image is no longer used. Unlike the other wrappers, which give
+    back the exit code of a failed run, a non-zero exit code of FAST
+    raises ValueError, as there are no outputs to give back
+
+    Example
+    -------
+    >>> import fsl
+    >>> out = fsl.fast('~/desktop/t1_brain.nii.gz',
+    ...                outputs=['restore', 'bias', 'pve_1'])
+    >>> wm = out['pve_1'].numpy()
+    """
+    return run_steps(_fast(file, outputs=outputs, outfile=outfile,
+                           nclass=nclass, img_type=img_type, retimg=retimg,
+                           reorient=reorient, opts=opts, verbose=verbose,
+                           output_type=output_type, **kwargs))
+
+
+def _fast(file, outputs=('restore', 'seg', 'pve'), outfile=None, nclass=3,
+          img_type=1, retimg=True, reorient=False, opts='', verbose=True,
+          output_type=None, **kwargs):
+    fslenv = get_fsl_env()
+    names = _fast_outputs(outputs, nclass)
+    # the outputs are always read lazily
+    kwargs.pop('lazy', None)
+    inputs = (file,)
+    file, fileremove = checkimg(file, **kwargs)
+
+    temporary = outfile is None or is_temp_output(outfile)
+    outtype = resolve_output_type(temporary, output_type)
+    runtype = write_type(outtype, temporary, 'fast', opts)
+    outfile = check_outfile(outfile=outfile, retimg=retimg, fileext='')
+    stub = outfile.split('.')[0]
+
+    flags = [flag for prefix, flag in _OUTPUT_FLAGS
+             if any(n.startswith(prefix) for n in names)]
+    if not any(n.startswith(_PVE_OUTPUTS) for n in names):
+        flags.append('--nopve')
+    cmd = fslenv.argv('fast', *shlex.split(opts))
+    cmd += flags + ['-n', str(nclass), '-t', str(img_type),
+                    '--out=%s' % stub, file]
+
+    if verbose:
+        print(format_cmd(cmd), '\n')
+
+    written = _fast_written(flags + shlex.split(opts), nclass)
+    try:
+        with result_cache('fast', inputs, opts, mode=' '.join(flags),
+                          nclass=nclass, img_type=img_type, outtype=runtype,
+                          stubs={'out': stub}, suffixes=written) as cache:
+            if cache.hit:
+                retval = 0
+            else:
+                retval, stdout = yield cmd, {'FSLOUTPUTTYPE': runtype}
+                cache.store(retval)
+    except BaseException:
+        # interrupted (cancelled, timed out): nothing to read back
+        if temporary: remove_tempfile('%s%s' % (stub, get_imgext(runtype)))
+        raise
+    finally:
+        # the staged copy of an in-memory input
+        if fileremove: remove_tempfile(file)
+    ext = get_imgext(runtype)
+    # the reservation of the stub itself
+    if temporary:
+        release(stub + ext)
+    if retval != 0:
+        raise ValueError('fast failed with exit code %s' % retval)
+
+    for name in written:
+        # written by FAST, but not asked for
+        path = '%s_%s%s' % (stub, name, ext)
+        if name not in names and os.path.exists(path):
+            os.remove(path)
+
+    if runtype != outtype:
+        compress_outputs(['%s_%s.nii' % (stub, n) for n in names])
+        ext = get_imgext(outtype)
+    files = dict((n, '%s_%s%s' % (stub, n, ext)) for n in names)
+    if not retimg:
+        return files
+
+    images = {}
+    for name, path in files.items():
+        img = readnii(path, reorient=reorient, lazy=True, **kwargs)
+        if temporary:
+            # the file goes with the last reference to its image
+            weakref.finalize(img, release, path)
+        images[name] = img
+    return images
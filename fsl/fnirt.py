@@ -4,15 +4,21 @@ __all__ = ['fnirt', 'fnirt_help',
            'fnirt_with_affine']
 
 import os
+import shlex
 from tempfile import mktemp
 
-from .fslhd import (checkimg, check_outfile, get_fsl, 
+from .environment import get_fsl_env, format_cmd
+from .cache import result_cache
+from .compress import write_type, compress_outputs
+from .staging import (temp_output, is_temp_output, resolve_output_type,
+                      detach, staging_enabled, keep_output)
+from .fslhd import (checkimg, check_outfile,
                     get_imgext, readnii, remove_tempfile, 
-                    system_cmd, fslhelp, flirt)
+                    run_steps, fslhelp, _flirt)
 
 
 def fnirt(infile, reffile, outfile=None, retimg=True,
-          reorient=False, opts='', verbose=True, **kwargs):
+          reorient=False, opts='', verbose=True, output_type=None, **kwargs):
     """
     Register using FNIRT
     
@@ -44,6 +50,10 @@ def fnirt(infile, reffile, outfile=None, retimg=True,
     
     verbose : boolean
         print out command before running
+
+    output_type : string
+        FSLOUTPUTTYPE of the output, e.g. 'NIFTI' (default: the configured
+        type for outfile, plain NIFTI for temporary outputs)
     
     kwargs : keyword args
         additional arguments passed to \code{\link{readnii}}.
@@ -52,7 +62,18 @@ def fnirt(infile, reffile, outfile=None, retimg=True,
     -------
     exit code | ants image | nibabel image
     """
-    cmd = get_fsl()
+    return run_steps(_fnirt(infile, reffile, outfile=outfile, retimg=retimg,
+                            reorient=reorient, opts=opts, verbose=verbose,
+                            output_type=output_type, **kwargs))
+
+
+def _fnirt(infile, reffile, outfile=None, retimg=True,
+           reorient=False, opts='', verbose=True, output_type=None, **kwargs):
+    fslenv = get_fsl_env()
+    inputs = (infile, reffile)
+    temporary = outfile is None or is_temp_output(outfile)
+    outtype = resolve_output_type(temporary, output_type)
+    runtype = write_type(outtype, temporary, 'fnirt', opts)
 
     outfile = check_outfile(outfile=outfile, retimg=retimg, fileext='')
     infile, inremove = checkimg(infile, **kwargs)
@@ -60,21 +81,50 @@ def fnirt(infile, reffile, outfile=None, retimg=True,
     outfile, outremove = checkimg(outfile, **kwargs)
     outfile = outfile.split('.')[0]
 
-    cmd = '%sfnirt --in="%s" --ref="%s" --iout="%s" %s' % \
-          (cmd, infile, reffile, outfile, opts)
+    cmd = fslenv.argv('fnirt', '--in=%s' % infile, '--ref=%s' % reffile,
+                      '--iout=%s' % outfile) + shlex.split(opts)
 
     if verbose:
-        print(cmd, '\n')
-
-    retval, stdout = system_cmd(cmd)
-    ext = get_imgext()
+        print(format_cmd(cmd), '\n')
+
+    try:
+        with result_cache('fnirt', inputs, opts, outtype=runtype,
+                          stubs={'iout': outfile}) as cache:
+            if cache.hit:
+                retval = 0
+            else:
+                retval, stdout = yield cmd, {'FSLOUTPUTTYPE': runtype}
+                cache.store(retval)
+    except BaseException:
+        # interrupted (cancelled, timed out): nothing to read back
+        if temporary: remove_tempfile('%s%s' % (outfile, get_imgext(runtype)))
+        raise
+    finally:
+        # the staged copies of in-memory inputs
+        if inremove: remove_tempfile(infile)
+        if refremove: remove_tempfile(reffile)
+    stub = outfile
+    ext = get_imgext(runtype)
     outfile = '%s%s' % (outfile, ext)
+    if temporary and retval != 0:
+        # nothing to read back from it
+        remove_tempfile(outfile)
 
     if retimg:
         img = readnii(outfile, reorient=reorient, **kwargs)
-        if inremove: remove_tempfile(infile)
-        if refremove: remove_tempfile(reffile)
-        if outremove: remove_tempfile(outremove)
+        if temporary and staging_enabled():
+            img = detach(img)
+            remove_tempfile(outfile)
+        elif runtype != outtype:
+            # its file is compressed next
+            img = detach(img)
+        elif temporary:
+            # the image is read from it
+            keep_output(outfile)
+        if outremove: remove_tempfile(outfile)
+    if runtype != outtype and retval == 0:
+        compress_outputs([stub + '.nii'])
+    if retimg:
         return img
     else:
         return retval        
@@ -86,7 +136,8 @@ def fnirt_help():
 
 def fnirt_with_affine(infile, reffile, flirt_omat=None, flirt_outfile=None,
                       outfile=None, retimg=True, reorient=False,
-                      flirt_opts='', opts='', verbose=True, **kwargs):
+                      flirt_opts='', opts='', verbose=True, output_type=None,
+                      **kwargs):
     """
     Register using FNIRT, but doing Affine Registration as well
 
@@ -129,14 +180,31 @@ def fnirt_with_affine(infile, reffile, flirt_omat=None, flirt_outfile=None,
     verbose : boolean 
         print out command before running
 
+    output_type : string
+        FSLOUTPUTTYPE of outfile and flirt_outfile (default: the configured
+        type; the affine-registered image is plain NIFTI when temporary)
+
     kwargs : keywords args
         additional arguments passed to \code{\link{readnii}}.
     
     Returns
     -------
-    exit code | ants image | nibabel image
+    exit code | ants image | nibabel image. If FLIRT fails, FNIRT is not
+    run: FLIRT's exit code is returned, or ValueError raised with retimg
     """
-    cmd = get_fsl()
+    return run_steps(_fnirt_with_affine(infile, reffile, flirt_omat=flirt_omat,
+                                         flirt_outfile=flirt_outfile,
+                                         outfile=outfile, retimg=retimg,
+                                         reorient=reorient, flirt_opts=flirt_opts,
+                                         opts=opts, verbose=verbose,
+                                         output_type=output_type, **kwargs))
+
+
+def _fnirt_with_affine(infile, reffile, flirt_omat=None, flirt_outfile=None,
+                       outfile=None, retimg=True, reorient=False,
+                       flirt_opts='', opts='', verbose=True, output_type=None,
+                       **kwargs):
+    temporary = outfile is None
     outfile = check_outfile(outfile=outfile, retimg=retimg, fileext='')
 
     ##################################
@@ -149,8 +217,9 @@ def fnirt_with_affine(infile, reffile, flirt_omat=None, flirt_outfile=None,
     ##################################
     # FLIRT output file
     ##################################
-    if flirt_outfile is None:
-        flirt_outfile = mktemp()
+    flirt_temporary = flirt_outfile is None
+    if flirt_temporary:
+        flirt_outfile = temp_output()
     flirt_outfile = os.path.expanduser(flirt_outfile)
 
     flirt_outfile, flirtoutremove = checkimg(flirt_outfile, **kwargs)
@@ -163,24 +232,46 @@ def fnirt_with_affine(infile, reffile, flirt_omat=None, flirt_outfile=None,
 
     #affine_file = mktemp()
     
-    # run FLIRT
-    res_flirt = flirt(infile=infile, 
-                      reffile=reffile, 
-                      omat=flirt_omat, 
-                      dof=12,
-                      outfile=flirt_outfile,                  
-                      ### keep retimg = False
-                      retimg=False,
-                      opts=flirt_opts, 
-                      verbose = verbose)
-    
-    # run FNIRT
-    res_fnirt = fnirt(infile=flirt_outfile, 
-                      reffile=reffile, 
-                      outfile=outfile,                  
-                      retimg=retimg,
-                      reorient=reorient,                 
-                      opts=opts, verbose=verbose, **kwargs)
+    try:
+        # run FLIRT
+        res_flirt = yield from _flirt(infile=infile, 
+                                      reffile=reffile, 
+                                      omat=flirt_omat, 
+                                      dof=12,
+                                      outfile=flirt_outfile,                  
+                                      ### keep retimg = False
+                                      retimg=False,
+                                      opts=flirt_opts, 
+                                      verbose = verbose,
+                                      output_type=None if flirt_temporary else output_type)
+
+        # run FNIRT, from the affine-registered image
+        if res_flirt == 0:
+            res_fnirt = yield from _fnirt(infile=flirt_outfile, 
+                                          reffile=reffile, 
+                                          outfile=outfile,                  
+                                          retimg=retimg,
+                                          reorient=reorient,                 
+                                          opts=opts, verbose=verbose,
+                                          output_type=output_type, **kwargs)
+    except BaseException:
+        # interrupted (cancelled, timed out): the output kept for FNIRT
+        if temporary:
+            remove_tempfile('%s%s' % (outfile, get_imgext(resolve_output_type(True))))
+        raise
+    finally:
+        # the staged copies of in-memory inputs
+        if inremove: remove_tempfile(infile)
+        if refremove: remove_tempfile(reffile)
+
+    if flirt_temporary:
+        remove_tempfile('%s%s' % (flirt_outfile, get_imgext(resolve_output_type(True))))
+    if res_flirt != 0:
+        if temporary:
+            remove_tempfile('%s%s' % (outfile, get_imgext(resolve_output_type(True))))
+        if not retimg:
+            return res_flirt
+        raise ValueError('flirt failed with exit code %s' % res_flirt)
     return res_fnirt
 
 
@@ -3,10 +3,42 @@
 
 import os
 import shlex
-import subprocess
+import sys
+import threading
+from concurrent.futures import CancelledError
 from tempfile import mktemp
 
 from . import config
+from .environment import get_fsl_env, format_cmd
+from .profiling import span
+from .executors import get_executor
+from .cache import result_cache, _stub_files
+from .stats import native_fslstats, native_cog, fslstats_stream
+from .header import native_fslorient
+from .lazy import LazyImage, ANTS_PIXELTYPES, reorient_image
+from .compress import write_type, compress_outputs, wait_output
+from .staging import (stage_image, stage_copy, temp_output, is_temp_output,
+                      resolve_output_type, release, detach, staging_enabled,
+                      keep_output, backing_file, register_source)
+
+
+# per-thread environment overrides for FSL subprocesses (see fsl.batch)
+_job = threading.local()
+
+
+def set_job_env(env):
+    """
+    Set environment variables that are added to every FSL subprocess
+    launched from the calling thread. Pass None to clear them.
+    """
+    _job.env = dict(env) if env else None
+
+
+def get_job_env():
+    """
+    Get the environment overrides set for the calling thread, or None
+    """
+    return getattr(_job, 'env', None)
 
 
 def get_fsloutput():
@@ -68,6 +100,9 @@ def get_fsl(add_bin=True):
     #' @return NULL if FSL in path, or bash code for setting up FSL DIR
     #' @export
     #' @import neurobase
+
+    The wrapper functions no longer use this shell prefix; they exec the
+    binaries directly through the cached `get_fsl_env()`.
     """
     cmd = None
     # check for environment variable
@@ -117,14 +152,17 @@ def get_fsl(add_bin=True):
     return cmd
 
 
-def get_imgext():
+def get_imgext(fslout=None):
     """
     #' @title Determine extension of image based on FSLOUTPUTTYPE
     #' @description Runs \code{get.fsloutput()} to extract FSLOUTPUTTYPE and then 
     #' gets corresponding extension (such as .nii.gz)
     #' @return Extension for output type
+
+    `fslout` gives the output type to use instead of FSLOUTPUTTYPE
     """
-    fslout = get_fsloutput()
+    if fslout is None:
+        fslout = get_fsloutput()
     ext_dict = {'NIFTI_PAIR'    : '.hdr', 
                 'NIFTI_GZ'      : '.nii.gz', 
                 'ANALYZE'       : '.hdr', 
@@ -135,18 +173,33 @@ def get_imgext():
 
 
 def checkimg(img, **kwargs):
+    if isinstance(img, LazyImage):
+        # its file holds what FSL should see unless it is reoriented or
+        # cast when read
+        if (not img.loaded and not img.reorient and img.dtype is None
+                and os.path.exists(img.filename)):
+            return img.filename, False
+        img = img.image
+
     if ('nibabel' in str(type(img))) or ('Nifti1' in str(type(img))) or ('Nifti2' in str(type(img))):
-        tmpfile = mktemp(suffix='.nii.gz')
-        img.to_filename(tmpfile)
-        return tmpfile, True
+        with span('stage', package='nibabel') as s:
+            source = backing_file(img)
+            if source is not None:
+                if s is not None: s.attrs['path'] = source
+                return source, False
+            return stage_image(img), True
 
     elif ('ants' in str(type(img))) or ('ANTs' in str(type(img))):
-        tmpfile = mktemp(suffix='.nii.gz')
-        img.to_file(tmpfile)
-        return tmpfile, True
+        with span('stage', package='ants') as s:
+            source = backing_file(img)
+            if source is not None:
+                if s is not None: s.attrs['path'] = source
+                return source, False
+            return stage_image(img), True
     
     elif isinstance(img, str):
         img = os.path.expanduser(img)
+        wait_output(img)
         return img, False
 
 
@@ -166,40 +219,148 @@ def check_outfile(outfile, retimg, fileext='.nii.gz'):
     """
     if retimg:
         if outfile is None:
-            outfile = mktemp(suffix=fileext)
+            outfile = temp_output(fileext)
     else:
         if outfile is None:
             raise ValueError('Outfile is None, and retimg=False, one of these must be changed')
 
-    return os.path.expanduser(outfile)
+    outfile = os.path.expanduser(outfile)
+    # not while an earlier output of that name is still being compressed
+    wait_output(outfile.split('.')[0])
+    return outfile
 
 
-def readnii(filename, reorient=False, **kwargs):
-    pypack = config.get_pypackage()
-    if pypack == 'ants':
-        import ants
-        img = ants.image_read(filename, **kwargs)
-    elif pypack == 'nibabel':
-        import nibabel
-        img = nibabel.load(filename, **kwargs)
-    else:
-        config.set_pypackage('nibabel')
-        import nibabel
-        img = nibabel.load(filename, **kwargs)
-    return img
+def readnii(filename, reorient=False, lazy=False, dtype=None, **kwargs):
+    """
+    Read an image with the configured package (ants or nibabel)
+
+    Arguments
+    ---------
+    filename : string
+        image file
+    reorient : boolean
+        reorient the image to RAS+
+    lazy : boolean
+        return a LazyImage that reads the header now and the voxel data on
+        first use (memory-mapped when the file is uncompressed)
+    dtype : string | numpy dtype
+        cast the voxel data to this type when it is read
+    kwargs : keyword args
+        passed to ants.image_read / nibabel.load
+    """
+    wait_output(filename)
+    with span('read', path=filename, lazy=lazy):
+        if lazy:
+            return LazyImage(filename, reorient=reorient, dtype=dtype, **kwargs)
+
+        pypack = config.get_pypackage()
+        if pypack == 'ants':
+            import ants
+            if dtype is not None:
+                import numpy as np
+                kwargs.setdefault('pixeltype', ANTS_PIXELTYPES[np.dtype(dtype).name])
+            img = ants.image_read(filename, **kwargs)
+            register_source(img, filename)
+        else:
+            if pypack != 'nibabel':
+                config.set_pypackage('nibabel')
+            import nibabel
+            img = nibabel.load(filename, **kwargs)
+            if dtype is not None:
+                img = img.__class__(img.get_fdata(dtype=dtype), img.affine, img.header)
+        if reorient:
+            img = reorient_image(img)
+        return img
 
 
 def remove_tempfile(file):
-    os.remove(file)
+    with span('cleanup', path=file):
+        release(file)
 
 
-def system_cmd(cmd):
+def cmd_env(cmd, env=None):
     """
-    Runs a bash system command and gives back return code and std out
+    Environment to run a command with: the resolved FSL environment for
+    argument lists (None, i.e. inherited, for shell strings) plus the
+    overrides set for the calling thread and the call itself
     """
-    retval = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
-    stdout = retval.stdout.decode('unicode_escape')
-    return retval.returncode, stdout
+    extra = dict(get_job_env() or {}, **(env or {}))
+    if not isinstance(cmd, str):
+        return get_fsl_env().environ(extra)
+    if extra:
+        return dict(os.environ, **extra)
+    return None
+
+
+def system_cmd(cmd, env=None):
+    """
+    Runs a system command and gives back return code and std out
+
+    An argument list (as built by the wrapper functions) is executed
+    directly in the resolved FSL environment, a string is run by the shell.
+    `env` holds extra environment variables for this command.
+
+    The command is run by the executor set with `set_executor` (see
+    `fsl.executors`), by default locally under supervision (see
+    `fsl.supervisor`): the policy of its tool sets its timeout, resource
+    limits and retries. Its stderr is passed on to sys.stderr;
+    TimeoutError is raised if it timed out and CancelledError if it was
+    cancelled.
+    """
+    env = cmd_env(cmd, env)
+    with span('subprocess', cmd=format_cmd(cmd)) as s:
+        result = get_executor().run(cmd, env=env)
+        if s is not None:
+            s.attrs.update(returncode=result.returncode,
+                           attempts=result.attempts)
+            if result.maxrss is not None:
+                s.attrs.update(cpu_user=result.cpu_user,
+                               cpu_sys=result.cpu_sys, maxrss=result.maxrss)
+    if result.stderr:
+        sys.stderr.write(result.stderr)
+    if result.cancelled:
+        raise CancelledError('%s was cancelled' % format_cmd(cmd))
+    if result.timed_out:
+        raise TimeoutError('%s timed out after %d attempt(s)'
+                           % (format_cmd(cmd), result.attempts))
+    return result.returncode, result.stdout
+
+
+def run_steps(steps):
+    """
+    Drive the step generator behind a wrapper function.
+
+    Each wrapper is written as a generator that yields the commands it
+    needs run, either as `cmd` or as `(cmd, env)` with extra environment
+    variables, and is sent back `(retval, stdout)` for each. Here they are
+    run one after the other with `system_cmd`; `fsl.aio` drives the same
+    generators on an event loop.
+    """
+    with span('call', tool=step_tool(steps)):
+        try:
+            cmd = next(steps)
+            while True:
+                cmd = steps.send(system_cmd(*split_step(cmd)))
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            steps.close()
+
+
+def step_tool(steps):
+    """
+    Name of the wrapper behind a step generator (for profiling)
+    """
+    return getattr(steps, '__name__', 'steps').lstrip('_')
+
+
+def split_step(step):
+    """
+    Split what a step generator yields into (cmd, env)
+    """
+    if isinstance(step, tuple):
+        return step
+    return step, None
 
 
 def have_fsl():
@@ -218,13 +379,14 @@ def have_fsl():
     }
     """
     try:
-        get_fsl()
+        get_fsl_env()
         return True
     except:
         return False
 
 
-def fslstats(file, opts=None, verbose=False, ts=False, **kwargs):
+def fslstats(file, opts=None, verbose=False, ts=False, native=True,
+             stream=False, **kwargs):
     """
     #' @title FSL Stats 
     #' @description This function calls \code{fslstats}
@@ -238,10 +400,17 @@ def fslstats(file, opts=None, verbose=False, ts=False, **kwargs):
         print out command before running
     ts : boolean
         true if img is a timeseries (4D), invoking `-t`
+    native : boolean
+        compute the statistics of in-memory images with NumPy when all the
+        options are supported (see `fsl.stats`), instead of calling FSL
+    stream : boolean
+        with `ts`, return a generator that reads the series a chunk of
+        volumes at a time and yields the statistics volume by volume
+        (see `fslstats_stream`)
     
     Returns
     -------
-    scalar
+    scalar (a generator with `stream`)
 
     Example
     -------
@@ -257,23 +426,45 @@ def fslstats(file, opts=None, verbose=False, ts=False, **kwargs):
     >>> img = ants.image_read('~/desktop/img.nii.gz')
     >>> val3 = fsl.fslstats(img, opts='-m')
     """
-    cmd = get_fsl()
+    if ts and stream:
+        return fslstats_stream(file, opts)
+    return run_steps(_fslstats(file, opts=opts, verbose=verbose, ts=ts,
+                               native=native, **kwargs))
+
+
+def _fslstats(file, opts=None, verbose=False, ts=False, native=True, **kwargs):
+    if native and not isinstance(file, str):
+        try:
+            with span('native', opts=opts):
+                stdout = native_fslstats(file, opts, ts=ts)
+        except (NotImplementedError, ImportError):
+            pass
+        else:
+            if verbose:
+                print('fslstats %s(native) %s' % ('-t ' if ts else '', opts))
+            return _parse_stats(stdout)
+
+    fslenv = get_fsl_env()
     file, needs_removing = checkimg(file, **kwargs)
 
     # build cmd
-    cmd = '%sfslstats %s "%s" %s' % \
-          (cmd, '-t' if ts else '', file, opts)
+    cmd = fslenv.argv('fslstats', *(['-t'] if ts else []))
+    cmd += [file] + shlex.split(opts or '')
 
     if verbose:
-        print(cmd)
+        print(format_cmd(cmd))
 
-    retval, stdout = system_cmd(cmd)
-
-    stdout = stdout.replace('\n',' ').strip(' ')
+    retval, stdout = yield cmd
 
     if needs_removing:
         remove_tempfile(file)
 
+    return _parse_stats(stdout)
+
+
+def _parse_stats(stdout):
+    stdout = stdout.replace('\n',' ').strip(' ')
+
     try:
         stdout = float(stdout)
     except:
@@ -327,19 +518,40 @@ def fslhelp(func_name, help_arg='--help', extra_args='', return_string=False):
       return(invisible(res))
     }
     """
-    cmd = get_fsl()
-    cmd = '%s%s %s %s' % \
-          (cmd, func_name, help_arg, extra_args)
-    retval, stdout = system_cmd(cmd)
+    return run_steps(_fslhelp(func_name, help_arg=help_arg, extra_args=extra_args,
+                              return_string=return_string))
+
+
+def _fslhelp(func_name, help_arg='--help', extra_args='', return_string=False):
+    cmd = get_fsl_env().argv(func_name, help_arg) + shlex.split(extra_args)
+    retval, stdout = yield cmd
 
-    helpstring = stdout.decode('unicode_escape') 
+    helpstring = stdout
     if return_string:
         return helpstring
     else:
         print(helpstring)
 
 
-def fslbet(infile, outfile=None, retimg=True, reorient=False, opts='', betcmd=('bet2', 'bet'), verbose=False, **kwargs):
+# outputs bet writes next to its output (<outfile>_<suffix>), by option
+_BET_SURFACES = ('inskull_mask', 'inskull_mesh', 'outskull_mask',
+                 'outskull_mesh', 'outskin_mask', 'outskin_mesh', 'skull_mask')
+_BET_OUTPUTS = {'-o': ('overlay',), '-m': ('mask',), '-s': ('skull',),
+               '-e': ('mesh',), '-A': _BET_SURFACES, '-A2': _BET_SURFACES}
+
+
+def _bet_suffixes(opts):
+    """
+    Suffixes of the outputs bet writes next to its output with these
+    options
+    """
+    suffixes = []
+    for token in shlex.split(opts or ''):
+        suffixes.extend(s for s in _BET_OUTPUTS.get(token, ()) if s not in suffixes)
+    return suffixes
+
+
+def fslbet(infile, outfile=None, retimg=True, reorient=False, opts='', betcmd=('bet2', 'bet'), verbose=False, output_type=None, **kwargs):
     """
     Use FSL's Brain Extraction Tool (BET)
     
@@ -369,6 +581,10 @@ def fslbet(infile, outfile=None, retimg=True, reorient=False, opts='', betcmd=('
     
     verbose : boolean
         print out command before running 
+
+    output_type : string
+        FSLOUTPUTTYPE of the output, e.g. 'NIFTI' (default: the configured
+        type for outfile, plain NIFTI for temporary outputs)
     
     kwargs : additional arguments passed to \code{\link{readnii}}.
     
@@ -383,30 +599,72 @@ def fslbet(infile, outfile=None, retimg=True, reorient=False, opts='', betcmd=('
     >>> outfile = '/users/ncullen/desktop/img_bet.nii.gz'
     >>> fsl.fslbet(infile, outfile, retimg=False)
     """
+    return run_steps(_fslbet(infile, outfile=outfile, retimg=retimg, reorient=reorient,
+                           opts=opts, betcmd=betcmd, verbose=verbose,
+                           output_type=output_type, **kwargs))
+
+
+def _fslbet(infile, outfile=None, retimg=True, reorient=False, opts='',
+            betcmd=('bet2', 'bet'), verbose=False, output_type=None, **kwargs):
     if isinstance(betcmd, tuple):
         betcmd = betcmd[0]
 
-    cmd = get_fsl()
+    fslenv = get_fsl_env()
+    inputs = (infile,)
+    temporary = outfile is None or is_temp_output(outfile)
+    outtype = resolve_output_type(temporary, output_type)
+    runtype = write_type(outtype, temporary, betcmd, opts)
     outfile = check_outfile(outfile=outfile, retimg=retimg, fileext='')
     infile, inremove = checkimg(infile, **kwargs)
     outfile, outremove = checkimg(outfile, **kwargs)
+    outfile = outfile.split('.')[0]
 
-    cmd = '%s%s "%s" "%s" %s' % (cmd, betcmd, infile, outfile, opts)
+    cmd = fslenv.argv(betcmd, infile, outfile) + shlex.split(opts)
 
     if verbose:
-        print(cmd, '\n')
+        print(format_cmd(cmd), '\n')
 
-    retval, stdout = system_cmd(cmd)
-    ext = get_imgext()
+    try:
+        with result_cache(betcmd, inputs, opts, outtype=runtype,
+                          stubs={'out': outfile},
+                          suffixes=_bet_suffixes(opts)) as cache:
+            if cache.hit:
+                retval = 0
+            else:
+                retval, stdout = yield cmd, {'FSLOUTPUTTYPE': runtype}
+                cache.store(retval)
+    except BaseException:
+        # interrupted (cancelled, timed out): nothing to read back
+        if temporary: remove_tempfile('%s%s' % (outfile, get_imgext(runtype)))
+        raise
+    finally:
+        # the staged copy of an in-memory input
+        if inremove: remove_tempfile(infile)
+    stub = outfile
+    ext = get_imgext(runtype)
     outfile = '%s%s' % (outfile, ext)
+    if temporary and retval != 0:
+        # nothing to read back from it
+        remove_tempfile(outfile)
     
     if retimg:
         img = readnii(outfile, reorient=reorient, **kwargs)
-        if inremove: remove_tempfile(infile)
+        if temporary and staging_enabled():
+            img = detach(img)
+            remove_tempfile(outfile)
+        elif runtype != outtype:
+            # its file is compressed next
+            img = detach(img)
+        elif temporary:
+            # the image is read from it
+            keep_output(outfile)
         if outremove: remove_tempfile(outfile)
+    if runtype != outtype and retval == 0:
+        # the output and the mask / surfaces bet writes next to it
+        compress_outputs(_stub_files(stub, _bet_suffixes(opts), exts=('.nii',)))
+    if retimg:
         return img
     else:
-        if inremove: remove_tempfile(infile)
         return retval
 
 
@@ -433,7 +691,7 @@ def fslbet_help(betcmd=('bet2', 'bet')):
     return fslhelp(betcmd)
 
 
-def fslcog(img, mm=True, verbose=False, ts=False):
+def fslcog(img, mm=True, verbose=False, ts=False, native=True, labels=None):
     """
     Image Center of Gravity (FSL)
     
@@ -453,17 +711,48 @@ def fslcog(img, mm=True, verbose=False, ts=False):
     ts : boolean
          is the series a timeseries (4D), invoking \code{-t} 
 
+    native : boolean
+         compute the CoG in-process with NumPy (all volumes at once)
+         instead of running fslstats; falls back to fslstats if NumPy or
+         nibabel/ants are missing
+
+    labels : string | nibabel image | ants image
+         label image on the same grid: CoG of every non-zero label
+         (computed in-process)
+
     Returns
     -------
-    list of length 3 unless `ts==True`
+    list of length 3 unless `ts==True` (then 3 per volume, one after the
+    other); with `labels`, a dict of label -> such a list
 
     Example
     -------
     >>> import fsl
     >>> cog = fslcog('~/desktop/img.nii.gz')
+    >>> cogs = fslcog('~/desktop/img.nii.gz', labels='~/desktop/atlas.nii.gz')
     """
+    return run_steps(_fslcog(img, mm=mm, verbose=verbose, ts=ts,
+                             native=native, labels=labels))
+
+
+def _fslcog(img, mm=True, verbose=False, ts=False, native=True, labels=None):
+    if native or labels is not None:
+        try:
+            with span('native', opts='cog'):
+                cog = native_cog(img, mm=mm, ts=ts, labels=labels)
+        except (NotImplementedError, ImportError):
+            if labels is not None:
+                raise
+        else:
+            if verbose:
+                print('fslstats %s(native) %s' % ('-t ' if ts else '',
+                                                   '-c' if mm else '-C'))
+            if labels is not None:
+                return {label: c.ravel().tolist() for label, c in cog.items()}
+            return cog.ravel().tolist()
+
     opts = '-c' if mm else '-C'
-    cog = fslstats(img, opts=opts, verbose=verbose, ts=ts)
+    cog = yield from _fslstats(img, opts=opts, verbose=verbose, ts=ts)
     cog = cog.split(' ')
 
     if len(cog) == 1:
@@ -474,17 +763,19 @@ def fslcog(img, mm=True, verbose=False, ts=False):
     return cog
 cog = fslcog
 
-def fslorient(file, retimg=True, reorient=False, opts='', verbose=False, **kwargs):
+def fslorient(file, retimg=True, reorient=False, opts='', verbose=False,
+              native=True, **kwargs):
     """
     FSL Orient
 
     Arguments
     ---------
     file : string | ants image | nibabel image
-        image to be manipulated
+        image to be manipulated. A file is changed in place; an in-memory
+        image is copied first and the changed copy returned
     
     retimg : boolean 
-        return image of class nifti
+        return image of class nifti (ignored for -get options)
     
     reorient : boolean 
         If \code{retimg}, should file be reoriented when read in?
@@ -494,42 +785,101 @@ def fslorient(file, retimg=True, reorient=False, opts='', verbose=False, **kwarg
     
     verbose : boolean 
         print out command before running
+
+    native : boolean
+        do the -get, -set, -copy, -deleteorient and -swaporient options
+        on the header without running fslorient (see
+        `fsl.header.native_fslorient`); only the header bytes are
+        rewritten, .nii.gz files are recompressed
     
     kwargs : additional arguments 
         passed to \code{\link{readnii}}.
     
     Returns
     -------
-    exit code from system call | ants image | nibabel image
+    exit code from system call | ants image | nibabel image, or for -get
+    options the value: 'NEUROLOGICAL' / 'RADIOLOGICAL' for -getorient,
+    16 floats for -getsform / -getqform, an integer for the form codes
     
     Example
     -------
     >>> import fsl
-    >>> fsl.fslorient('~/desktop/img.nii.gz', retimg=False)
+    >>> fsl.fslorient('~/desktop/img.nii.gz', opts='-getorient')
+    >>> fsl.fslorient('~/desktop/img.nii.gz', retimg=False,
+    ...               opts='-copysform2qform')
     """
-    if ('-get' in opts) and retimg:
-        print('fslorient option was a -get, ',
-              'image was not changed - output not returned,',
-              ' and retimg set to False')
+    return run_steps(_fslorient(file, retimg=retimg, reorient=reorient,
+                              opts=opts, verbose=verbose, native=native,
+                              **kwargs))
+
+
+def _fslorient(file, retimg=True, reorient=False, opts='', verbose=False,
+               native=True, **kwargs):
+    args = shlex.split(opts)
+    getter = bool(args) and args[0].startswith('-get')
+    if getter:
+        # the image is not changed, the value asked for is returned
         retimg = False
 
-    cmd = get_fsl()
-    file, fileremove = checkimg(file, **kwargs)
-    cmd = '%sfslorient %s "%s"' % (cmd, opts, file)
-    outfile = file.split('.')[0]
-    ext = get_imgext()
-    outfile = '%s%s' % (outfile, ext)
+    if not isinstance(file, str) and not getter:
+        # fslorient changes its input: never the file an in-memory image
+        # was read from, nor a staged file other calls may reuse
+        if isinstance(file, LazyImage):
+            file = file.image
+        file, fileremove = stage_copy(file), True
+    else:
+        file, fileremove = checkimg(file, **kwargs)
 
-    if verbose:
-        print(cmd, '\n')
+    if os.path.exists(file):
+        outfile = file
+    else:
+        outfile = '%s%s' % (file.split('.')[0], get_imgext())
+
+    result = None
+    if native:
+        try:
+            with span('native', opts=opts):
+                value = native_fslorient(file, args)
+        except NotImplementedError:
+            native = False
+        else:
+            if verbose:
+                print('fslorient (native) %s %s' % (opts, file), '\n')
+            result = value if getter else 0
 
-    retval, stdout = system_cmd(cmd)
+    if not native:
+        fslenv = get_fsl_env()
+        cmd = fslenv.argv('fslorient', *args) + [file]
+
+        if verbose:
+            print(format_cmd(cmd), '\n')
+
+        retval, stdout = yield cmd
+        result = retval
+        if getter and retval == 0:
+            result = _orient_value(args[0], stdout)
 
     if retimg:
-        img = readnii(outfile, **kwargs)
+        img = readnii(outfile, reorient=reorient, **kwargs)
+        if fileremove:
+            img = detach(img)
+            remove_tempfile(file)
         return img
     else:
-        return retval
+        if fileremove: remove_tempfile(file)
+        return result
+
+
+def _orient_value(option, stdout):
+    """
+    Value printed by a fslorient -get option
+    """
+    stdout = stdout.strip()
+    if option == '-getorient':
+        return stdout
+    if option in ('-getsformcode', '-getqformcode'):
+        return int(stdout)
+    return [float(v) for v in stdout.split()]
 
 
 def fslorient_help():
@@ -537,7 +887,7 @@ def fslorient_help():
 
 
 def flirt(infile, reffile, omat=None, dof=6, outfile=None, retimg=True,
-          reorient=False, opts='', verbose=False, **kwargs):
+          reorient=False, opts='', verbose=False, output_type=None, **kwargs):
     """
     #' @title Register using FLIRT
     #' @description This function calls \code{flirt} to register infile to reffile
@@ -570,6 +920,10 @@ def flirt(infile, reffile, omat=None, dof=6, outfile=None, retimg=True,
     
     verbose : boolean 
         print out command before running
+
+    output_type : string
+        FSLOUTPUTTYPE of the output, e.g. 'NIFTI' (default: the configured
+        type for outfile, plain NIFTI for temporary outputs)
     
     kwargs : additional  
         rguments passed to \code{\link{readnii}}.
@@ -583,7 +937,18 @@ def flirt(infile, reffile, omat=None, dof=6, outfile=None, retimg=True,
     >>> import fsl
     >>> fsl.flirt(infile='~/desktop/img.nii.gz', reffile='~/desktop/template.nii.gz', dof=6)
     """
-    cmd = get_fsl()
+    return run_steps(_flirt(infile, reffile, omat=omat, dof=dof, outfile=outfile,
+                          retimg=retimg, reorient=reorient, opts=opts,
+                          verbose=verbose, output_type=output_type, **kwargs))
+
+
+def _flirt(infile, reffile, omat=None, dof=6, outfile=None, retimg=True,
+           reorient=False, opts='', verbose=False, output_type=None, **kwargs):
+    fslenv = get_fsl_env()
+    inputs = (infile, reffile)
+    temporary = outfile is None or is_temp_output(outfile)
+    outtype = resolve_output_type(temporary, output_type)
+    runtype = write_type(outtype, temporary, 'flirt', opts)
     outfile = check_outfile(outfile=outfile, retimg=retimg, fileext='')
     infile, inremove = checkimg(infile, **kwargs)
     reffile, refremove = checkimg(reffile, **kwargs)
@@ -597,21 +962,50 @@ def flirt(infile, reffile, omat=None, dof=6, outfile=None, retimg=True,
 
     omat = os.path.expanduser(omat)
 
-    cmd = '%sflirt -in "%s" -ref "%s" -out "%s" -dof %d -omat "%s" %s' % \
-          (cmd, infile, reffile, outfile, dof, omat, opts)
+    cmd = fslenv.argv('flirt', '-in', infile, '-ref', reffile, '-out', outfile,
+                      '-dof', '%d' % dof, '-omat', omat) + shlex.split(opts)
 
     if verbose:
-        print(cmd, '\n')
+        print(format_cmd(cmd), '\n')
 
-    retval, stdout = system_cmd(cmd)
-    ext = get_imgext()
+    try:
+        with result_cache('flirt', inputs, opts, dof=dof, outtype=runtype,
+                          stubs={'out': outfile}, files={'omat': omat}) as cache:
+            if cache.hit:
+                retval = 0
+            else:
+                retval, stdout = yield cmd, {'FSLOUTPUTTYPE': runtype}
+                cache.store(retval)
+    except BaseException:
+        # interrupted (cancelled, timed out): nothing to read back
+        if temporary: remove_tempfile('%s%s' % (outfile, get_imgext(runtype)))
+        raise
+    finally:
+        # the staged copies of in-memory inputs
+        if inremove: remove_tempfile(infile)
+        if refremove: remove_tempfile(reffile)
+    stub = outfile
+    ext = get_imgext(runtype)
     outfile = '%s%s' % (outfile, ext)
+    if temporary and retval != 0:
+        # nothing to read back from it
+        remove_tempfile(outfile)
 
     if retimg:
         img = readnii(outfile, reorient=reorient, **kwargs)
-        if inremove: remove_tempfile(infile)
-        if refremove: remove_tempfile(reffile)
-        if outremove: remove_tempfile(outremove)
+        if temporary and staging_enabled():
+            img = detach(img)
+            remove_tempfile(outfile)
+        elif runtype != outtype:
+            # its file is compressed next
+            img = detach(img)
+        elif temporary:
+            # the image is read from it
+            keep_output(outfile)
+        if outremove: remove_tempfile(outfile)
+    if runtype != outtype and retval == 0:
+        compress_outputs([stub + '.nii'])
+    if retimg:
         return img
     else:
         if verbose and print_omat:
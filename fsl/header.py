@@ -0,0 +1,734 @@
+"""
+Header-only reading of NIfTI-1, NIfTI-2 and Analyze 7.5 images
+
+Getting the dimensions, voxel sizes, data type or sform of an image
+should not mean loading it with ants / nibabel or running fslhd. The
+functions here read only the header: the first 348 (NIfTI-1, Analyze)
+or 540 (NIfTI-2) bytes of the file, decompressing just the start of the
+stream for .gz files. Parsing is pure Python (struct).
+
+`get_fslhd` and `fslval` answer fslhd / fslval style queries, and
+`fslhd_many` scans many files in parallel into a columnar table.
+
+`update_header` writes header fields back: only the header bytes of an
+uncompressed file are rewritten, a gzipped file is recompressed without
+decoding its voxel data. `native_fslorient` builds the fslorient
+operations on these two.
+"""
+
+__all__ = ['read_header',
+           'get_fslhd',
+           'fslval',
+           'fslhd_many',
+           'update_header',
+           'native_fslorient',
+           'FSLHD_KEYS']
+
+import gzip
+import math
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from .compress import wait_output, GzipWriter
+
+
+# (name, struct code) of every header field, in file order
+NIFTI1_FIELDS = (
+    ('sizeof_hdr', 'i'), ('data_type', '10s'), ('db_name', '18s'),
+    ('extents', 'i'), ('session_error', 'h'), ('regular', 'c'),
+    ('dim_info', 'B'), ('dim', '8h'), ('intent_p1', 'f'),
+    ('intent_p2', 'f'), ('intent_p3', 'f'), ('intent_code', 'h'),
+    ('datatype', 'h'), ('bitpix', 'h'), ('slice_start', 'h'),
+    ('pixdim', '8f'), ('vox_offset', 'f'), ('scl_slope', 'f'),
+    ('scl_inter', 'f'), ('slice_end', 'h'), ('slice_code', 'B'),
+    ('xyzt_units', 'B'), ('cal_max', 'f'), ('cal_min', 'f'),
+    ('slice_duration', 'f'), ('toffset', 'f'), ('glmax', 'i'),
+    ('glmin', 'i'), ('descrip', '80s'), ('aux_file', '24s'),
+    ('qform_code', 'h'), ('sform_code', 'h'), ('quatern_b', 'f'),
+    ('quatern_c', 'f'), ('quatern_d', 'f'), ('qoffset_x', 'f'),
+    ('qoffset_y', 'f'), ('qoffset_z', 'f'), ('srow_x', '4f'),
+    ('srow_y', '4f'), ('srow_z', '4f'), ('intent_name', '16s'),
+    ('magic', '4s'))
+
+NIFTI2_FIELDS = (
+    ('sizeof_hdr', 'i'), ('magic', '8s'), ('datatype', 'h'),
+    ('bitpix', 'h'), ('dim', '8q'), ('intent_p1', 'd'),
+    ('intent_p2', 'd'), ('intent_p3', 'd'), ('pixdim', '8d'),
+    ('vox_offset', 'q'), ('scl_slope', 'd'), ('scl_inter', 'd'),
+    ('cal_max', 'd'), ('cal_min', 'd'), ('slice_duration', 'd'),
+    ('toffset', 'd'), ('slice_start', 'q'), ('slice_end', 'q'),
+    ('descrip', '80s'), ('aux_file', '24s'), ('qform_code', 'i'),
+    ('sform_code', 'i'), ('quatern_b', 'd'), ('quatern_c', 'd'),
+    ('quatern_d', 'd'), ('qoffset_x', 'd'), ('qoffset_y', 'd'),
+    ('qoffset_z', 'd'), ('srow_x', '4d'), ('srow_y', '4d'),
+    ('srow_z', '4d'), ('slice_code', 'i'), ('xyzt_units', 'i'),
+    ('intent_code', 'i'), ('intent_name', '16s'), ('dim_info', 'B'),
+    ('unused_str', '15s'))
+
+
+def _layout(fields):
+    """
+    struct format and {name: (offset, code)} of a header layout
+    """
+    offsets = {}
+    offset = 0
+    for name, code in fields:
+        offsets[name] = (offset, code)
+        offset += struct.calcsize('<' + code)
+    return ''.join(code for name, code in fields), offsets, offset
+
+
+NIFTI1_FORMAT, NIFTI1_OFFSETS, NIFTI1_SIZE = _layout(NIFTI1_FIELDS)
+NIFTI2_FORMAT, NIFTI2_OFFSETS, NIFTI2_SIZE = _layout(NIFTI2_FIELDS)
+
+DATATYPES = {0: 'UNKNOWN', 1: 'BINARY', 2: 'UINT8', 4: 'INT16', 8: 'INT32',
+             16: 'FLOAT32', 32: 'COMPLEX64', 64: 'FLOAT64', 128: 'RGB24',
+             256: 'INT8', 512: 'UINT16', 768: 'UINT32', 1024: 'INT64',
+             1280: 'UINT64', 1536: 'FLOAT128', 1792: 'COMPLEX128',
+             2048: 'COMPLEX256', 2304: 'RGBA32'}
+
+SPACE_UNITS = {0: 'Unknown', 1: 'm', 2: 'mm', 3: 'um'}
+TIME_UNITS = {0: 'Unknown', 8: 's', 16: 'ms', 24: 'us', 32: 'Hz',
+              40: 'ppm', 48: 'rad/s'}
+XFORM_NAMES = {0: 'Unknown', 1: 'Scanner Anat', 2: 'Aligned Anat',
+               3: 'Talairach', 4: 'MNI_152', 5: 'Template'}
+SLICE_NAMES = {0: 'Unknown', 1: 'sequential_increasing',
+               2: 'sequential_decreasing', 3: 'alternating_increasing',
+               4: 'alternating_decreasing', 5: 'alternating_increasing_2',
+               6: 'alternating_decreasing_2'}
+
+# compressed bytes read at a time from .gz files
+GZ_READ = 1024
+
+# bytes copied at a time when recompressing a .gz file
+GZ_COPY = 1 << 20
+
+
+def _header_file(filename):
+    """
+    File holding the header: the .hdr of an Analyze / NIfTI pair, the
+    file itself otherwise. A name without extension is looked up like
+    FSL does.
+    """
+    filename = os.path.expanduser(filename)
+    if os.path.exists(filename):
+        for img_ext, hdr_ext in (('.img', '.hdr'), ('.img.gz', '.hdr.gz')):
+            if filename.endswith(img_ext):
+                return filename[:-len(img_ext)] + hdr_ext
+        return filename
+    for ext in ('.nii.gz', '.nii', '.hdr', '.hdr.gz'):
+        if os.path.exists(filename + ext):
+            return filename + ext
+    raise ValueError('Cant find image %s' % filename)
+
+
+def _read_start(filename, nbytes):
+    """
+    First `nbytes` of a file, decompressing only as much of a gzip
+    stream as that needs
+    """
+    with open(filename, 'rb') as f:
+        start = f.read(2)
+        if start != b'\x1f\x8b':
+            return start + f.read(nbytes - 2)
+        f.seek(0)
+        inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out = b''
+        while len(out) < nbytes:
+            chunk = f.read(GZ_READ)
+            if not chunk:
+                break
+            out += inflate.decompress(chunk, nbytes - len(out))
+            # output held back by the max_length limit
+            while inflate.unconsumed_tail and len(out) < nbytes:
+                out += inflate.decompress(inflate.unconsumed_tail, nbytes - len(out))
+        return out
+
+
+def _unpack(fields, fmt, endian, raw):
+    values = struct.unpack(endian + fmt, raw)
+    hdr = {}
+    i = 0
+    for name, code in fields:
+        count = int(code[:-1]) if code[:-1] and code[-1] != 's' else 1
+        if count > 1:
+            hdr[name] = values[i:i + count]
+            i += count
+        else:
+            value = values[i]
+            if isinstance(value, bytes) and code != 'c':
+                value = value.split(b'\0', 1)[0].decode('latin-1')
+            hdr[name] = value
+            i += 1
+    return hdr
+
+
+def read_header(filename):
+    """
+    Read the header of a NIfTI-1, NIfTI-2 or Analyze 7.5 image
+
+    Arguments
+    ---------
+    filename : string
+        image (.nii, .nii.gz, .hdr/.img pair, optionally without extension)
+
+    Returns
+    -------
+    dict of the raw header fields (arrays as tuples, strings decoded),
+    plus 'format' ('NIFTI-1', 'NIFTI-2' or 'ANALYZE'), 'endian' ('<' or
+    '>'), 'header_file' and 'compressed'
+
+    Example
+    -------
+    >>> import fsl
+    >>> hdr = fsl.read_header('~/desktop/img.nii.gz')
+    >>> hdr['dim'], hdr['pixdim'], hdr['datatype']
+    """
+    wait_output(filename)
+    header_file = _header_file(filename)
+    raw = _read_start(header_file, NIFTI2_SIZE)
+    if len(raw) < 4:
+        raise ValueError('%s is not a NIfTI or Analyze image' % header_file)
+
+    for endian in ('<', '>'):
+        sizeof_hdr = struct.unpack(endian + 'i', raw[:4])[0]
+        if sizeof_hdr in (NIFTI1_SIZE, NIFTI2_SIZE):
+            break
+    else:
+        raise ValueError('%s is not a NIfTI or Analyze image' % header_file)
+
+    if sizeof_hdr == NIFTI2_SIZE:
+        fields, fmt, fmt_size = NIFTI2_FIELDS, NIFTI2_FORMAT, NIFTI2_SIZE
+    else:
+        fields, fmt, fmt_size = NIFTI1_FIELDS, NIFTI1_FORMAT, NIFTI1_SIZE
+    if len(raw) < fmt_size:
+        raise ValueError('%s: header is truncated' % header_file)
+    hdr = _unpack(fields, fmt, endian, raw[:fmt_size])
+
+    magic = hdr['magic'][:3]
+    if sizeof_hdr == NIFTI2_SIZE:
+        hdr['format'] = 'NIFTI-2'
+    elif magic in ('n+1', 'ni1'):
+        hdr['format'] = 'NIFTI-1'
+    else:
+        # Analyze 7.5 has no transforms nor scaling in these fields
+        hdr['format'] = 'ANALYZE'
+        hdr.update(qform_code=0, sform_code=0, intent_code=0, intent_name='',
+                   quatern_b=0.0, quatern_c=0.0, quatern_d=0.0,
+                   qoffset_x=0.0, qoffset_y=0.0, qoffset_z=0.0,
+                   srow_x=(0.0,) * 4, srow_y=(0.0,) * 4, srow_z=(0.0,) * 4,
+                   slice_code=0, xyzt_units=0)
+    hdr['endian'] = endian
+    hdr['header_file'] = header_file
+    hdr['compressed'] = header_file.endswith('.gz')
+    return hdr
+
+
+def qform_matrix(hdr):
+    """
+    4x4 voxel-to-mm matrix from the qform quaternion (the pixdim scaling
+    when qform_code is 0), as nested lists
+    """
+    pixdim = hdr['pixdim']
+    if not hdr['qform_code']:
+        return [[pixdim[1], 0.0, 0.0, 0.0], [0.0, pixdim[2], 0.0, 0.0],
+                [0.0, 0.0, pixdim[3], 0.0], [0.0, 0.0, 0.0, 1.0]]
+    b, c, d = hdr['quatern_b'], hdr['quatern_c'], hdr['quatern_d']
+    a2 = 1.0 - (b * b + c * c + d * d)
+    if a2 < 1e-7:
+        # a is 0 and (b, c, d) should be a unit vector
+        norm = math.sqrt(b * b + c * c + d * d) or 1.0
+        a, b, c, d = 0.0, b / norm, c / norm, d / norm
+    else:
+        a = math.sqrt(a2)
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    scale = (pixdim[1], pixdim[2], qfac * pixdim[3])
+    rot = [[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+           [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+           [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]]
+    offset = (hdr['qoffset_x'], hdr['qoffset_y'], hdr['qoffset_z'])
+    return [[rot[i][j] * scale[j] for j in range(3)] + [offset[i]] for i in range(3)] + \
+           [[0.0, 0.0, 0.0, 1.0]]
+
+
+def sform_matrix(hdr):
+    """
+    4x4 voxel-to-mm matrix stored in the sform rows, as nested lists
+    """
+    return [list(hdr['srow_x']), list(hdr['srow_y']), list(hdr['srow_z']),
+            [0.0, 0.0, 0.0, 1.0]]
+
+
+def _det3(m):
+    return (m[0][0] * (m[1][1] * m[2][2] - m[1][2] * m[2][1]) -
+            m[0][1] * (m[1][0] * m[2][2] - m[1][2] * m[2][0]) +
+            m[0][2] * (m[1][0] * m[2][1] - m[1][1] * m[2][0]))
+
+
+def _inv3(m):
+    det = _det3(m)
+    return [[(m[(j + 1) % 3][(i + 1) % 3] * m[(j + 2) % 3][(i + 2) % 3] -
+              m[(j + 1) % 3][(i + 2) % 3] * m[(j + 2) % 3][(i + 1) % 3]) / det
+             for j in range(3)] for i in range(3)]
+
+
+def _polar(m, tol=3e-6, max_iter=100):
+    """
+    Nearest orthogonal matrix (polar decomposition, as nifti_mat33_polar)
+    """
+    x = [row[:] for row in m]
+    for _ in range(max_iter):
+        z = _inv3(x)
+        norm_x = math.sqrt(sum(v * v for row in x for v in row))
+        norm_z = math.sqrt(sum(v * v for row in z for v in row))
+        gam = math.sqrt(norm_z / norm_x)
+        y = [[0.5 * (gam * x[i][j] + z[j][i] / gam) for j in range(3)]
+             for i in range(3)]
+        change = sum(abs(y[i][j] - x[i][j]) for i in range(3) for j in range(3))
+        x = y
+        if change <= tol:
+            break
+    return x
+
+
+def qform_fields(mat):
+    """
+    qform header fields (quaternion, offsets, pixdim 0-3) of a 4x4
+    voxel-to-mm matrix, like nifti_mat44_to_quatern. Shears are dropped.
+    """
+    # voxel sizes are the column lengths
+    zooms = [math.sqrt(sum(mat[i][j] ** 2 for i in range(3))) or 1.0
+             for j in range(3)]
+    r = _polar([[mat[i][j] / zooms[j] for j in range(3)] for i in range(3)])
+    qfac = 1.0
+    if _det3(r) < 0:
+        qfac = -1.0
+        for i in range(3):
+            r[i][2] = -r[i][2]
+
+    a = r[0][0] + r[1][1] + r[2][2] + 1.0
+    if a > 0.5:
+        a = 0.5 * math.sqrt(a)
+        b = 0.25 * (r[2][1] - r[1][2]) / a
+        c = 0.25 * (r[0][2] - r[2][0]) / a
+        d = 0.25 * (r[1][0] - r[0][1]) / a
+    else:
+        xd = 1.0 + r[0][0] - (r[1][1] + r[2][2])
+        yd = 1.0 + r[1][1] - (r[0][0] + r[2][2])
+        zd = 1.0 + r[2][2] - (r[0][0] + r[1][1])
+        if xd > 1.0:
+            b = 0.5 * math.sqrt(xd)
+            c = 0.25 * (r[0][1] + r[1][0]) / b
+            d = 0.25 * (r[0][2] + r[2][0]) / b
+            a = 0.25 * (r[2][1] - r[1][2]) / b
+        elif yd > 1.0:
+            c = 0.5 * math.sqrt(yd)
+            b = 0.25 * (r[0][1] + r[1][0]) / c
+            d = 0.25 * (r[1][2] + r[2][1]) / c
+            a = 0.25 * (r[0][2] - r[2][0]) / c
+        else:
+            d = 0.5 * math.sqrt(zd)
+            b = 0.25 * (r[0][2] + r[2][0]) / d
+            c = 0.25 * (r[1][2] + r[2][1]) / d
+            a = 0.25 * (r[1][0] - r[0][1]) / d
+        if a < 0.0:
+            b, c, d = -b, -c, -d
+    return {'quatern_b': b, 'quatern_c': c, 'quatern_d': d,
+            'qoffset_x': mat[0][3], 'qoffset_y': mat[1][3],
+            'qoffset_z': mat[2][3], 'pixdim': [qfac] + zooms}
+
+
+# keys of `get_fslhd`, in the order fslhd prints them
+FSLHD_KEYS = (['filename', 'sizeof_hdr', 'data_type'] +
+              ['dim%d' % i for i in range(8)] +
+              ['vox_units', 'time_units', 'datatype', 'nbyper', 'bitpix'] +
+              ['pixdim%d' % i for i in range(8)] +
+              ['vox_offset', 'cal_max', 'cal_min', 'scl_slope', 'scl_inter',
+               'phase_dim', 'freq_dim', 'slice_dim', 'slice_name',
+               'slice_code', 'slice_start', 'slice_end', 'slice_duration',
+               'toffset', 'intent', 'intent_code', 'intent_name',
+               'intent_p1', 'intent_p2', 'intent_p3', 'qform_name',
+               'qform_code'] +
+              ['qto_xyz:%d' % i for i in range(1, 5)] +
+              ['sform_name', 'sform_code'] +
+              ['sto_xyz:%d' % i for i in range(1, 5)] +
+              ['file_type', 'file_code', 'descrip', 'aux_file'])
+
+
+def _file_type(hdr):
+    if hdr['format'] == 'ANALYZE':
+        return 'ANALYZE-7.5'
+    if hdr['header_file'].endswith(('.nii', '.nii.gz')):
+        # single file
+        return hdr['format'] + '+'
+    return hdr['format']
+
+
+def _fslhd_fields(hdr, filename):
+    dim, pixdim = hdr['dim'], hdr['pixdim']
+    units = hdr['xyzt_units']
+    dim_info = hdr['dim_info']
+    out = {'filename': filename,
+           'sizeof_hdr': hdr['sizeof_hdr'],
+           'data_type': DATATYPES.get(hdr['datatype'], 'UNKNOWN'),
+           'vox_units': SPACE_UNITS.get(units & 0x07, 'Unknown'),
+           'time_units': TIME_UNITS.get(units & 0x38, 'Unknown'),
+           'datatype': hdr['datatype'],
+           'nbyper': hdr['bitpix'] // 8,
+           'bitpix': hdr['bitpix'],
+           'vox_offset': int(hdr['vox_offset']),
+           'cal_max': hdr['cal_max'],
+           'cal_min': hdr['cal_min'],
+           'scl_slope': hdr['scl_slope'],
+           'scl_inter': hdr['scl_inter'],
+           'freq_dim': dim_info & 0x03,
+           'phase_dim': (dim_info >> 2) & 0x03,
+           'slice_dim': (dim_info >> 4) & 0x03,
+           'slice_name': SLICE_NAMES.get(hdr['slice_code'], 'Unknown'),
+           'slice_code': hdr['slice_code'],
+           'slice_start': hdr['slice_start'],
+           'slice_end': hdr['slice_end'],
+           'slice_duration': hdr['slice_duration'],
+           'toffset': hdr['toffset'],
+           'intent': hdr['intent_code'],
+           'intent_code': hdr['intent_code'],
+           'intent_name': hdr['intent_name'],
+           'intent_p1': hdr['intent_p1'],
+           'intent_p2': hdr['intent_p2'],
+           'intent_p3': hdr['intent_p3'],
+           'qform_name': XFORM_NAMES.get(hdr['qform_code'], 'Unknown'),
+           'qform_code': hdr['qform_code'],
+           'sform_name': XFORM_NAMES.get(hdr['sform_code'], 'Unknown'),
+           'sform_code': hdr['sform_code'],
+           'file_type': _file_type(hdr),
+           'file_code': {'ANALYZE': 0, 'NIFTI-1': 1, 'NIFTI-2': 2}[hdr['format']],
+           'descrip': hdr['descrip'],
+           'aux_file': hdr['aux_file']}
+    for i in range(8):
+        out['dim%d' % i] = dim[i]
+        out['pixdim%d' % i] = pixdim[i]
+    for i, row in enumerate(qform_matrix(hdr)):
+        out['qto_xyz:%d' % (i + 1)] = row
+    for i, row in enumerate(sform_matrix(hdr)):
+        out['sto_xyz:%d' % (i + 1)] = row
+    return out
+
+
+def get_fslhd(filename):
+    """
+    Header information of an image, as `fslhd` prints it, without
+    loading the image or running FSL
+
+    Arguments
+    ---------
+    filename : string
+        image filename
+
+    Returns
+    -------
+    dict with the keys in FSLHD_KEYS (qto_xyz/sto_xyz rows as lists)
+
+    Example
+    -------
+    >>> import fsl
+    >>> hd = fsl.get_fslhd('~/desktop/img.nii.gz')
+    >>> hd['dim1'], hd['pixdim1'], hd['data_type']
+    """
+    return _fslhd_fields(read_header(filename), filename)
+
+
+def fslval(filename, keyword):
+    """
+    One header value of an image, like `fslval`
+
+    Arguments
+    ---------
+    filename : string
+        image filename
+
+    keyword : string
+        key from FSLHD_KEYS, e.g. 'dim4' or 'pixdim1'
+
+    Example
+    -------
+    >>> import fsl
+    >>> ntimepoints = fsl.fslval('~/desktop/rest.nii.gz', 'dim4')
+    """
+    fields = get_fslhd(filename)
+    if keyword not in fields:
+        raise ValueError('unknown header keyword %s' % keyword)
+    return fields[keyword]
+
+
+DEFAULT_MANY_KEYS = ('file_type', 'data_type', 'dim0', 'dim1', 'dim2', 'dim3',
+                     'dim4', 'pixdim1', 'pixdim2', 'pixdim3', 'pixdim4',
+                     'qform_code', 'sform_code')
+
+
+def _header_row(filename, keys):
+    try:
+        fields = get_fslhd(filename)
+    except (IOError, OSError, ValueError, struct.error, zlib.error) as e:
+        return dict.fromkeys(keys), '%s: %s' % (type(e).__name__, e)
+    return {k: fields[k] for k in keys}, None
+
+
+def fslhd_many(files, keys=DEFAULT_MANY_KEYS, max_workers=None):
+    """
+    Read the headers of many images in parallel into a table
+
+    Arguments
+    ---------
+    files : list of strings
+        image filenames
+
+    keys : list of strings
+        header keys to collect (see FSLHD_KEYS)
+
+    max_workers : integer
+        number of files read at once (default: 4 per core, at most 32)
+
+    Returns
+    -------
+    dict mapping 'file', each key and 'error' to a column with one entry
+    per file (numpy arrays for numeric keys when numpy is installed).
+    Files that cannot be read have None values and an error message
+
+    Example
+    -------
+    >>> import fsl, glob
+    >>> table = fsl.fslhd_many(glob.glob('/data/*/anat/*.nii.gz'))
+    >>> table['dim1'], table['pixdim1']
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    keys = list(keys)
+    for key in keys:
+        if key not in FSLHD_KEYS:
+            raise ValueError('unknown header keyword %s' % key)
+    files = list(files)
+    if max_workers is None:
+        max_workers = min(32, 4 * (os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        rows = list(pool.map(lambda f: _header_row(f, keys), files))
+
+    table = {'file': files}
+    for key in keys:
+        table[key] = [row[key] for row, error in rows]
+    table['error'] = [error for row, error in rows]
+
+    try:
+        import numpy as np
+    except ImportError:
+        return table
+    for key in keys:
+        column = table[key]
+        if any(v is None for v in column):
+            continue
+        if all(isinstance(v, int) for v in column):
+            table[key] = np.array(column, dtype='int64')
+        elif all(isinstance(v, (int, float)) for v in column):
+            table[key] = np.array(column, dtype='float64')
+    return table
+
+
+def _recompress(filename, patches):
+    """
+    Rewrite a gzipped image with header bytes replaced; the rest of the
+    stream is copied through without being decoded
+    """
+    end = max(offset + len(data) for offset, data in patches)
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                   suffix='.tmp')
+    os.close(fd)
+    try:
+        with gzip.open(filename, 'rb') as src, GzipWriter(tmpfile) as dst:
+            head = bytearray(src.read(end))
+            for offset, data in patches:
+                head[offset:offset + len(data)] = data
+            dst.write(head)
+            shutil.copyfileobj(src, dst, GZ_COPY)
+        shutil.copymode(filename, tmpfile)
+        os.replace(tmpfile, filename)
+    except BaseException:
+        os.remove(tmpfile)
+        raise
+
+
+def update_header(filename, **fields):
+    """
+    Overwrite header fields of a NIfTI-1 or NIfTI-2 image in place
+
+    Only the bytes of the given fields are written to an uncompressed
+    .nii / .hdr; a .gz file is recompressed, its voxel data copied
+    through. The pixdim and srow fields may be given partially (missing
+    trailing values are kept).
+
+    Arguments
+    ---------
+    filename : string
+        image filename
+
+    fields : header fields
+        new values by field name (see NIFTI1_FIELDS), e.g. sform_code=4
+
+    Example
+    -------
+    >>> import fsl
+    >>> fsl.update_header('~/desktop/img.nii.gz', qform_code=0)
+    """
+    hdr = read_header(filename)
+    if hdr['format'] == 'ANALYZE':
+        raise NotImplementedError('%s is an Analyze image, it has no '
+                                  'NIfTI header fields' % hdr['header_file'])
+    offsets = NIFTI2_OFFSETS if hdr['format'] == 'NIFTI-2' else NIFTI1_OFFSETS
+
+    patches = []
+    for name, value in fields.items():
+        if name not in offsets:
+            raise ValueError('unknown header field %s' % name)
+        offset, code = offsets[name]
+        if code.endswith('s'):
+            value = value.encode('latin-1') if isinstance(value, str) else value
+            data = struct.pack(hdr['endian'] + code, value)
+        elif code[:-1]:
+            values = list(value) + list(hdr[name][len(value):])
+            data = struct.pack(hdr['endian'] + code, *values)
+        else:
+            data = struct.pack(hdr['endian'] + code, value)
+        patches.append((offset, data))
+    if not patches:
+        return
+
+    if hdr['compressed']:
+        _recompress(hdr['header_file'], patches)
+    else:
+        with open(hdr['header_file'], 'r+b') as f:
+            for offset, data in patches:
+                f.seek(offset)
+                f.write(data)
+
+
+def _orientation(hdr):
+    """
+    'NEUROLOGICAL' or 'RADIOLOGICAL' voxel order, from the sign of the
+    determinant of the sform (or else the qform)
+    """
+    if hdr['sform_code']:
+        det = _det3(sform_matrix(hdr))
+    elif hdr['qform_code']:
+        det = _det3(qform_matrix(hdr))
+    else:
+        # no transform: Analyze convention
+        return 'RADIOLOGICAL'
+    return 'RADIOLOGICAL' if det < 0 else 'NEUROLOGICAL'
+
+
+def _flat(mat):
+    return [float(v) for row in mat for v in row]
+
+
+def _matrix(values, option):
+    if len(values) != 16:
+        raise ValueError('fslorient %s needs 16 matrix values' % option)
+    values = [float(v) for v in values]
+    return [values[i:i + 4] for i in range(0, 16, 4)]
+
+
+def _mul(a, b):
+    return [[sum(a[i][k] * b[k][j] for k in range(4)) for j in range(4)]
+            for i in range(4)]
+
+
+def _sform_fields(mat):
+    return {'srow_x': mat[0], 'srow_y': mat[1], 'srow_z': mat[2]}
+
+
+# fslorient options answered from the header
+GET_OPTS = ('-getorient', '-getsform', '-getqform', '-getsformcode',
+            '-getqformcode')
+SET_OPTS = ('-setsform', '-setqform', '-setsformcode', '-setqformcode',
+            '-copysform2qform', '-copyqform2sform', '-deleteorient',
+            '-swaporient')
+
+
+def native_fslorient(filename, opts):
+    """
+    Run a fslorient operation on the header of an image, without FSL
+
+    The -get options read the header only; the -set, -copy, -delete and
+    -swaporient options rewrite it with `update_header`. Options that
+    change voxel data (-forceradiological, -forceneurological) raise
+    NotImplementedError, as do Analyze images.
+
+    Arguments
+    ---------
+    filename : string
+        image filename
+
+    opts : string | list of strings
+        fslorient main option and its arguments, e.g. '-getsform' or
+        '-setsformcode 4'
+
+    Returns
+    -------
+    the value for -get options (a string for -getorient, 16 floats for
+    -getsform / -getqform, an integer for the codes), None otherwise
+
+    Example
+    -------
+    >>> import fsl
+    >>> fsl.native_fslorient('~/desktop/img.nii.gz', '-getorient')
+    'RADIOLOGICAL'
+    """
+    args = opts.split() if isinstance(opts, str) else list(opts)
+    if not args or args[0] not in GET_OPTS + SET_OPTS:
+        raise NotImplementedError('fslorient %s is not done natively'
+                                  % ' '.join(args))
+    option, values = args[0], args[1:]
+    hdr = read_header(filename)
+
+    if option == '-getorient':
+        return _orientation(hdr)
+    if option == '-getsform':
+        return _flat(sform_matrix(hdr))
+    if option == '-getqform':
+        return _flat(qform_matrix(hdr))
+    if option == '-getsformcode':
+        return hdr['sform_code']
+    if option == '-getqformcode':
+        return hdr['qform_code']
+
+    if hdr['format'] == 'ANALYZE':
+        raise NotImplementedError('fslorient %s on Analyze images is not '
+                                  'done natively' % option)
+    if option == '-setsform':
+        fields = _sform_fields(_matrix(values, option))
+    elif option == '-setqform':
+        fields = qform_fields(_matrix(values, option))
+    elif option in ('-setsformcode', '-setqformcode'):
+        if len(values) != 1:
+            raise ValueError('fslorient %s needs one code' % option)
+        fields = {option[4:-4] + '_code': int(values[0])}
+    elif option == '-copysform2qform':
+        fields = qform_fields(sform_matrix(hdr))
+        fields['qform_code'] = hdr['sform_code']
+    elif option == '-copyqform2sform':
+        fields = _sform_fields(qform_matrix(hdr))
+        fields['sform_code'] = hdr['qform_code']
+    elif option == '-deleteorient':
+        fields = {'qform_code': 0, 'sform_code': 0}
+    else:
+        # -swaporient: flip the x axis of the voxel grid in the transforms
+        swap = [[-1.0, 0.0, 0.0, hdr['dim'][1] - 1.0], [0.0, 1.0, 0.0, 0.0],
+                [0.0, 0.0, 1.0, 0.0], [0.0, 0.0, 0.0, 1.0]]
+        fields = {}
+        if hdr['sform_code']:
+            fields.update(_sform_fields(_mul(sform_matrix(hdr), swap)))
+        if hdr['qform_code']:
+            fields.update(qform_fields(_mul(qform_matrix(hdr), swap)))
+    update_header(filename, **fields)
+    return None
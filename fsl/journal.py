@@ -0,0 +1,302 @@
+"""
+Crash-resumable record of batch jobs
+
+A `Journal` is an SQLite file with one row per job of `fsl.batch`: the
+wrapper, its arguments (input files with their checksums), its output
+files with their checksums, its status ('running', 'done' or 'failed')
+and its result. Each row is committed as soon as the job starts and
+finishes, so a batch that dies half-way loses no finished work.
+
+Run again with the same journal, `batch` skips the jobs that are done
+and whose outputs are still there, unchanged; it re-runs jobs that
+failed, never finished, or are stale: an input changed (the job then
+has another key), or an output went missing or was modified.
+
+Only jobs whose results can be recovered are skipped: their outputs are
+written to named files (e.g. `outfile=`, `omat=`), in which case an
+image result is given back as a lazily read image of the file, or
+their result (e.g. of fslstats) fits in the journal as JSON.
+
+Example
+-------
+>>> import fsl
+>>> jobs = [dict(infile=f, reffile='~/desktop/template.nii.gz',
+...              outfile=f.replace('.nii.gz', '_flirt.nii.gz'),
+...              omat=f.replace('.nii.gz', '.mat'))
+...         for f in files]
+>>> results = fsl.batch(fsl.flirt, jobs, journal='~/desktop/flirt.journal')
+>>> fsl.Journal('~/desktop/flirt.journal').summary()
+"""
+
+__all__ = ['Journal']
+
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from .cache import IMG_EXTS, _hash_file, _normalise_opts, _stub, fingerprint
+from .compress import wait_outputs
+from .lazy import LazyImage
+from .scheduler import _bind
+
+
+# wrapper arguments naming output files, and the FSL binary whose
+# options (in `opts`) may name more
+OUTPUT_ARGS = ('outfile', 'omat', 'flirt_omat', 'flirt_outfile')
+WRAPPER_TOOLS = {'flirt': 'flirt',
+                 'fnirt': 'fnirt',
+                 'fnirt_with_affine': 'fnirt',
+                 'fslbet': 'bet',
+                 'fsl_biascorrect': 'fast',
+                 'fast': 'fast'}
+
+# arguments of the wrappers the returned image is read with
+READ_ARGS = ('reorient', 'dtype')
+
+VERIFY = ('checksum', 'stat', 'exists')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    tool TEXT,
+    job TEXT,
+    status TEXT,
+    outputs TEXT,
+    value TEXT,
+    error TEXT,
+    started REAL,
+    finished REAL,
+    attempts INTEGER DEFAULT 0
+)
+"""
+
+JournalJob = namedtuple('JournalJob', ['key', 'tool', 'job', 'outputs',
+                                       'outfile', 'read'])
+
+
+def _describe(value):
+    """
+    JSON description of an argument: files by path and checksum,
+    in-memory images by fingerprint
+    """
+    if isinstance(value, str):
+        path = os.path.expanduser(value)
+        if os.path.isfile(path):
+            return {'file': os.path.abspath(path), 'checksum': _hash_file(path)}
+        return value
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_describe(v) for v in value]
+    if isinstance(value, dict):
+        return dict((str(k), _describe(v)) for k, v in sorted(value.items()))
+    if hasattr(value, 'dataobj') or hasattr(value, 'pixeltype'):
+        return {'image': fingerprint(value)}
+    return repr(value)
+
+
+def _output_files(stub):
+    """
+    Files on disk an output path (with or without extension) stands for
+    """
+    path = os.path.abspath(os.path.expanduser(stub))
+    if os.path.isfile(path) and not path.endswith(IMG_EXTS):
+        return [path]
+    stub = _stub(path)
+    return sorted(f for f in glob.glob(glob.escape(stub) + '.*')
+                  if f[len(stub):] in IMG_EXTS)
+
+
+def _is_image(value):
+    return (isinstance(value, LazyImage) or hasattr(value, 'dataobj')
+            or hasattr(value, 'pixeltype'))
+
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Journal(object):
+    """
+    SQLite journal of batch jobs, see the module documentation
+
+    Arguments
+    ---------
+    path : string
+        journal file (created if needed)
+
+    verify : string
+        how the outputs of finished jobs are checked before they are
+        skipped: 'checksum' (contents unchanged, the default), 'stat'
+        (size and modification time unchanged) or 'exists'
+    """
+    def __init__(self, path, verify='checksum'):
+        if verify not in VERIFY:
+            raise ValueError('verify must be one of %s' % ', '.join(VERIFY))
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=60,
+                                   check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(SCHEMA)
+
+    def job(self, func, args, kwargs):
+        """
+        Identify a call: its key (from the wrapper and its arguments by
+        parameter name, with input files by content) and the output paths
+        it names
+        """
+        tool = getattr(func, '__name__', None) or type(func).__name__
+        named = _bind(func, args, kwargs, defaults=True)
+        outputs = []
+        described = {}
+        for name, value in named.items():
+            if name in OUTPUT_ARGS and isinstance(value, str):
+                outputs.append(value)
+            else:
+                described[name] = _describe(value)
+        if tool in WRAPPER_TOOLS and named.get('opts'):
+            outputs.extend(_normalise_opts(WRAPPER_TOOLS[tool], named['opts'])[1].values())
+        desc = {'tool': tool, 'args': described,
+                'outputs': sorted(os.path.abspath(os.path.expanduser(o))
+                                  for o in outputs)}
+        text = json.dumps(desc, sort_keys=True, default=repr)
+        key = hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+        outfile = named.get('outfile')
+        read = dict((k, named[k]) for k in READ_ARGS if k in named)
+        return JournalJob(key, tool, text, desc['outputs'],
+                          outfile if isinstance(outfile, str) else None,
+                          json.loads(json.dumps(read, default=str)))
+
+    def _row(self, key):
+        with self._lock:
+            return self._db.execute(
+                'SELECT status, outputs, value, error, attempts FROM jobs '
+                'WHERE key = ?', (key,)).fetchone()
+
+    def _verified(self, outputs):
+        for path, recorded in outputs.items():
+            if recorded is None or not os.path.isfile(path):
+                return False
+            size, mtime, checksum = recorded
+            if self.verify == 'stat' and _stat(path) != [size, mtime]:
+                return False
+            if self.verify == 'checksum' and _hash_file(path) != checksum:
+                return False
+        return True
+
+    def restore(self, job):
+        """
+        Result of a job that is done and whose outputs check out, as a
+        (value,) tuple; None if the job has to run
+        """
+        row = self._row(job.key)
+        if row is None or row[0] != 'done' or row[2] is None:
+            return None
+        if not self._verified(json.loads(row[1] or '{}')):
+            return None
+        value = json.loads(row[2])
+        if 'image' in value:
+            from .fslhd import readnii
+            return (readnii(value['image'], lazy=True, **value['read']),)
+        return (value['value'],)
+
+    def start(self, job):
+        """
+        Record that a job is starting
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO jobs (key, tool, job, status, started, attempts) '
+                "VALUES (?, ?, ?, 'running', ?, 1) "
+                "ON CONFLICT(key) DO UPDATE SET status = 'running', "
+                'started = excluded.started, finished = NULL, error = NULL, '
+                'attempts = attempts + 1',
+                (job.key, job.tool, job.job, time.time()))
+
+    def finish(self, job, value=None, error=None):
+        """
+        Record the outcome of a job: its output files with their
+        checksums and its result (or error)
+        """
+        if error is not None:
+            with self._lock, self._db:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished = ? "
+                    'WHERE key = ?', (repr(error), time.time(), job.key))
+            return
+
+        wait_outputs()
+        outputs = {}
+        for out in job.outputs:
+            files = _output_files(out)
+            if not files:
+                # never written: the job is not recoverable
+                outputs[out] = None
+            for path in files:
+                outputs[path] = _stat(path) + [_hash_file(path)]
+
+        stored = None
+        if _is_image(value):
+            # recoverable if it was written to a named output
+            image_files = _output_files(job.outfile) if job.outfile else []
+            if image_files:
+                stored = {'image': image_files[0], 'read': job.read}
+        else:
+            try:
+                stored = {'value': json.loads(json.dumps(value))}
+            except (TypeError, ValueError):
+                stored = None
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET status = 'done', outputs = ?, value = ?, "
+                'finished = ? WHERE key = ?',
+                (json.dumps(outputs),
+                 None if stored is None else json.dumps(stored),
+                 time.time(), job.key))
+
+    def summary(self):
+        """
+        Number of jobs per status
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict(rows)
+
+    def jobs(self, status=None):
+        """
+        Recorded jobs (optionally of one status), as dicts
+        """
+        query = ('SELECT key, tool, job, status, outputs, error, started, '
+                 'finished, attempts FROM jobs')
+        params = ()
+        if status is not None:
+            query += ' WHERE status = ?'
+            params = (status,)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY started', params).fetchall()
+        names = ('key', 'tool', 'job', 'status', 'outputs', 'error',
+                 'started', 'finished', 'attempts')
+        jobs = []
+        for row in rows:
+            job = dict(zip(names, row))
+            job['job'] = json.loads(job['job'])
+            job['outputs'] = json.loads(job['outputs'] or '{}')
+            jobs.append(job)
+        return jobs
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __repr__(self):
+        return 'Journal(%r)' % self.path
@@ -0,0 +1,196 @@
+"""
+Lazily loaded images
+
+`readnii(..., lazy=True)` (and so every wrapper called with `lazy=True`)
+returns a `LazyImage`: the header is read straight away, but voxel data is
+only read when it is first needed, memory-mapped if the file is
+uncompressed. Slicing reads only the requested part of the file,
+`dtype` casts the voxel data when it is read (e.g. float32 instead of
+float64) and `reorient` is applied when the full image is first used.
+"""
+
+__all__ = ['LazyImage',
+           'ANTS_PIXELTYPES']
+
+import os
+
+from . import config
+
+
+# numpy dtype name -> ants pixel type
+ANTS_PIXELTYPES = {'uint8': 'unsigned char',
+                   'uint32': 'unsigned int',
+                   'float32': 'float',
+                   'float64': 'double'}
+
+
+def reorient_image(img):
+    """
+    Reorient an ants or nibabel image to the closest canonical (RAS+)
+    orientation
+    """
+    if hasattr(img, 'dataobj'):
+        import nibabel
+        return nibabel.as_closest_canonical(img)
+    import ants
+    return ants.reorient_image2(img, orientation='RAS')
+
+
+class LazyImage(object):
+    """
+    An image whose voxel data is read on first use
+
+    Attributes that are not defined here (e.g. `to_file`, `plot`, `affine`
+    of the backing image) are looked up on the fully loaded image, so a
+    LazyImage can be used in place of the ants / nibabel image `readnii`
+    would return.
+
+    Arguments
+    ---------
+    filename : string
+        image file
+
+    reorient : boolean
+        reorient to RAS+ when the image is loaded
+
+    dtype : string | numpy dtype
+        cast voxel data to this type when it is read
+
+    pypackage : string
+        'ants' or 'nibabel' (default: `config.get_pypackage()`)
+
+    kwargs : keyword args
+        passed to `ants.image_read` / `nibabel.load` when the image is loaded
+
+    Example
+    -------
+    >>> import fsl
+    >>> img = fsl.flirt('~/desktop/img.nii.gz', '~/desktop/template.nii.gz',
+    ...                 lazy=True, dtype='float32')
+    >>> img.shape          # from the header, no voxel data read
+    >>> img[:, :, 40]      # reads a single slice
+    """
+    def __init__(self, filename, reorient=False, dtype=None, pypackage=None, **kwargs):
+        self.filename = os.path.expanduser(filename)
+        self.reorient = reorient
+        self.dtype = dtype
+        self.pypackage = pypackage or config.get_pypackage()
+        self._kwargs = kwargs
+        self._image = None
+        self._data = None
+        self._nib = None
+        self.header = self._read_header()
+
+    def _read_header(self):
+        try:
+            import nibabel
+        except ImportError:
+            nibabel = None
+        if nibabel is not None:
+            # nibabel only parses the header here; data stays on disk
+            self._nib = nibabel.load(self.filename, mmap=True)
+            return self._nib.header
+        import ants
+        return ants.image_header_info(self.filename)
+
+    @property
+    def loaded(self):
+        """
+        Whether the full image has been read
+        """
+        return self._image is not None
+
+    @property
+    def shape(self):
+        if self._nib is not None:
+            return self._nib.shape
+        return tuple(int(d) for d in self.header['dimensions'])
+
+    @property
+    def image(self):
+        """
+        The fully loaded ants / nibabel image
+        """
+        if self._image is None:
+            self._image = self._load()
+        return self._image
+
+    def _load(self):
+        import numpy as np
+
+        if self.pypackage == 'ants':
+            import ants
+            kwargs = dict(self._kwargs)
+            if self.dtype is not None:
+                kwargs.setdefault('pixeltype', ANTS_PIXELTYPES[np.dtype(self.dtype).name])
+            img = ants.image_read(self.filename, **kwargs)
+        else:
+            import nibabel
+            img = self._nib
+            if img is None:
+                img = nibabel.load(self.filename, **self._kwargs)
+            if self.dtype is not None:
+                img = img.__class__(self._array(img.dataobj), img.affine, img.header)
+                # saved (e.g. staged for FSL) as the type it was cast to
+                img.set_data_dtype(self.dtype)
+        if self.reorient:
+            img = reorient_image(img)
+        return img
+
+    def _array(self, dataobj):
+        import numpy as np
+
+        if self.dtype is None:
+            return np.asanyarray(dataobj)
+        if np.issubdtype(np.dtype(self.dtype), np.floating) and hasattr(dataobj, 'get_scaled'):
+            return dataobj.get_scaled(dtype=self.dtype)
+        return np.asanyarray(dataobj).astype(self.dtype, copy=False)
+
+    def numpy(self):
+        """
+        Voxel data, memory-mapped when the file is uncompressed
+        """
+        if self._data is None:
+            if self._nib is not None and not self.reorient and self._image is None:
+                self._data = self._array(self._nib.dataobj)
+            elif hasattr(self.image, 'dataobj'):
+                self._data = self._array(self.image.dataobj)
+            else:
+                self._data = self.image.numpy()
+        return self._data
+
+    def get_fdata(self, dtype='float64'):
+        """
+        Voxel data as floating point, like nibabel's `get_fdata`
+        """
+        import numpy as np
+        return np.asarray(self.numpy(), dtype=dtype)
+
+    def __getitem__(self, slices):
+        if self._data is None and self._nib is not None and not self.reorient:
+            # read just this part of the file
+            data = self._nib.dataobj[slices]
+            return data if self.dtype is None else data.astype(self.dtype, copy=False)
+        return self.numpy()[slices]
+
+    def pin(self):
+        """
+        Make sure the voxel data stays available if the file is removed:
+        memory-maps uncompressed files (the mapping outlives the file),
+        reads everything else into memory
+        """
+        if self.pypackage == 'ants' or self.reorient or self.dtype is not None:
+            # these load the voxel data into memory
+            self.image
+        elif self._image is None or self._image is self._nib:
+            data = self.numpy()
+            self._image = self._nib.__class__(data, self._nib.affine, self._nib.header)
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.image, name)
+
+    def __repr__(self):
+        return 'LazyImage(%r, loaded=%s)' % (self.filename, self.loaded)
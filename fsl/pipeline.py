@@ -0,0 +1,368 @@
+"""
+Pipelines of FSL steps
+
+A `Pipeline` chains wrapper calls (bet -> fast -> flirt -> fnirt -> stats)
+without the caller managing intermediate files. Steps declare their inputs
+by taking other steps (or `scratch` files) as arguments; steps that do not
+depend on each other run in parallel. Outputs of intermediate steps are
+written to temporary plain NIFTI files (in the RAM directory when
+`set_fslstaging` is enabled), and each one is removed as soon as the last
+step reading it has finished. Only the declared outputs are read back and
+returned.
+"""
+
+__all__ = ['Pipeline']
+
+import glob
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .batch import thread_env, _run_job, _resolve_scheduler
+from .cache import _stub_files
+from .fslhd import get_imgext, readnii
+from .staging import (temp_output, is_temp_output, resolve_output_type,
+                      release, detach, _stub)
+
+
+# readnii arguments of a wrapper that apply when reading its output back
+READ_ARGS = ('reorient', 'lazy', 'dtype')
+
+
+def _release_outputs(path):
+    """
+    Remove the temporary output of a step and what the step wrote next to
+    it (e.g. bet's mask and surfaces): every file named after its stub
+    """
+    stub = _stub(path)
+    # the stub is a unique temporary name, nothing else starts with it
+    others = set(_stub_files(stub) + glob.glob(glob.escape(stub) + '_*'))
+    others.discard(path)
+    release(path)
+    for fname in sorted(others):
+        release(fname)
+
+
+class Scratch(object):
+    """
+    A temporary file passed between steps (e.g. a flirt matrix). The first
+    step that takes it as an argument writes it, later steps read it.
+    """
+    def __init__(self, name, suffix=''):
+        self.name = name
+        self.suffix = suffix
+        self.path = None
+
+    def __repr__(self):
+        return 'Scratch(%r)' % self.name
+
+
+class Step(object):
+    """
+    One wrapper call of a pipeline, stands for its output when passed as
+    an argument to later steps
+    """
+    def __init__(self, name, func, args, kwargs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        try:
+            params = inspect.signature(func).parameters
+        except (TypeError, ValueError):
+            params = {}
+        # wrappers with outfile/retimg write an image, others return a value
+        self.writes_image = 'outfile' in params and 'retimg' in params
+        # wrappers giving back several images (fast) have no single
+        # output file later steps could read
+        self.multi_output = 'outputs' in params
+
+    def inputs(self):
+        """
+        Steps and scratch files among the arguments
+        """
+        refs = []
+        for value in list(self.args) + list(self.kwargs.values()):
+            values = value if isinstance(value, (list, tuple)) else (value,)
+            refs.extend(v for v in values if isinstance(v, (Step, Scratch)))
+        return refs
+
+    def __repr__(self):
+        return 'Step(%r)' % self.name
+
+
+def _resolve(value, results):
+    if isinstance(value, (list, tuple)):
+        return type(value)(_resolve(v, results) for v in value)
+    if isinstance(value, Step):
+        return results[value]
+    if isinstance(value, Scratch):
+        return value.path
+    return value
+
+
+class Pipeline(object):
+    """
+    Build and run a graph of FSL steps
+
+    Example
+    -------
+    >>> import fsl
+    >>> p = fsl.Pipeline()
+    >>> brain = p.add(fsl.fslbet, '~/desktop/t1.nii.gz', opts='-f 0.4')
+    >>> restored = p.add(fsl.fsl_biascorrect, brain)
+    >>> omat = p.scratch('.mat')
+    >>> affine = p.add(fsl.flirt, restored, '~/desktop/template.nii.gz',
+    ...                omat=omat, dof=12)
+    >>> warped = p.add(fsl.fnirt, affine, '~/desktop/template.nii.gz',
+    ...                name='warped')
+    >>> mean = p.add(fsl.fslstats, warped, opts='-M', name='mean')
+    >>> res = p.run(outputs=[warped, mean])
+    >>> res['warped'], res['mean']
+    """
+    def __init__(self):
+        self.steps = []
+        self.scratches = []
+
+    def add(self, func, *args, name=None, **kwargs):
+        """
+        Add a wrapper call
+
+        Arguments
+        ---------
+        func : callable
+            wrapper function, e.g. `fsl.flirt` (not `fsl.fast`, which
+            gives back several outputs)
+
+        args, kwargs : arguments
+            passed to `func`. Steps (and scratch files) among them, also
+            inside lists and tuples, are replaced by their output. Giving
+            an `outfile` keeps that step's output on disk
+
+        name : string
+            key of the step's result in `run` (default: function name)
+
+        Returns
+        -------
+        Step
+        """
+        names = set(ref.name for ref in self.steps + self.scratches)
+        if name is None:
+            name = getattr(func, '__name__', 'step')
+            base, i = name, 1
+            while name in names:
+                i += 1
+                name = '%s_%d' % (base, i)
+        elif name in names:
+            raise ValueError('Pipeline already has a step named %s' % name)
+        step = Step(name, func, args, kwargs)
+        if step.multi_output:
+            raise ValueError('%s gives back several outputs and cannot be a '
+                             'Pipeline step; run it on the result of the '
+                             'pipeline instead' % getattr(func, '__name__', name))
+        self.steps.append(step)
+        return step
+
+    def scratch(self, suffix='', name=None):
+        """
+        A temporary file for outputs that are not images (e.g. `omat` of
+        flirt), removed once its last reader has finished
+        """
+        if name is None:
+            name = 'scratch_%d' % (len(self.scratches) + 1)
+        scratch = Scratch(name, suffix)
+        self.scratches.append(scratch)
+        return scratch
+
+    def _needed(self, outputs):
+        """
+        Steps the outputs depend on, in the order they were added
+        """
+        needed = set()
+        todo = list(outputs)
+        while todo:
+            ref = todo.pop()
+            if isinstance(ref, Step) and ref not in needed:
+                needed.add(ref)
+                todo.extend(ref.inputs())
+            elif isinstance(ref, Scratch):
+                # the step writing a scratch file is the first to take it
+                writer = self._writer(ref)
+                if writer is not None:
+                    todo.append(writer)
+        return [step for step in self.steps if step in needed]
+
+    def _depends(self, step):
+        """
+        Steps that must finish before `step` runs
+        """
+        deps = []
+        for ref in step.inputs():
+            if isinstance(ref, Scratch):
+                ref = self._writer(ref)
+            if ref is not None and ref is not step:
+                deps.append(ref)
+        return deps
+
+    def _writer(self, scratch):
+        for step in self.steps:
+            if scratch in step.inputs():
+                return step
+        return None
+
+    def run(self, outputs=None, max_workers=None, threads_per_job=None,
+            scheduler=None):
+        """
+        Run the steps the outputs need, independent steps in parallel
+
+        Arguments
+        ---------
+        outputs : list of Steps and scratch files
+            results to return (default: steps no other step reads). Only
+            the steps these depend on are run
+
+        max_workers : integer
+            number of steps run at the same time (default: number of cores)
+
+        threads_per_job : integer
+            threads each step may use (default: cores / max_workers)
+
+        scheduler : Scheduler | True
+            admit each step against the scheduler's RAM and core budget
+            (see fsl.scheduler, True: the node-wide scheduler)
+
+        Returns
+        -------
+        dict of step (or scratch file) name -> result. Image steps give
+        the image (or the exit code if run with retimg=False), other steps
+        their return value, scratch files their path
+        """
+        if outputs is None:
+            read = set()
+            for step in self.steps:
+                read.update(step.inputs())
+            outputs = [step for step in self.steps if step not in read]
+        outputs = list(outputs)
+        steps = self._needed(outputs)
+        final = set(outputs)
+
+        # number of unfinished readers of each intermediate
+        readers = {}
+        for step in steps:
+            for ref in set(step.inputs()):
+                readers[ref] = readers.get(ref, 0) + 1
+        for ref in final:
+            readers[ref] = readers.get(ref, 0) + 1
+
+        scheduler = _resolve_scheduler(scheduler)
+        ncores = os.cpu_count() or 1
+        if scheduler is not None:
+            ncores = len(scheduler.cores)
+        if max_workers is None:
+            max_workers = ncores
+        max_workers = max(1, min(max_workers, len(steps) or 1))
+        if scheduler is not None:
+            env = None
+        else:
+            if threads_per_job is None:
+                threads_per_job = max(1, ncores // max_workers)
+            env = thread_env(threads_per_job)
+
+        scratches = [ref for ref in readers if isinstance(ref, Scratch)]
+        for scratch in scratches:
+            scratch.path = temp_output(scratch.suffix)
+
+        files = {}    # step -> output file of image steps
+        results = {}  # step -> what later steps get as argument
+        returned = {}
+        pending = list(steps)
+        running = {}
+
+        def finished(ref):
+            readers[ref] -= 1
+            if readers[ref] > 0:
+                return
+            if isinstance(ref, Scratch):
+                if ref in final:
+                    returned[ref] = ref.path
+                else:
+                    release(ref.path)
+            elif ref in files:
+                if ref in final:
+                    returned[ref] = self._read_back(ref, files[ref])
+                if 'outfile' not in ref.kwargs:
+                    _release_outputs(files[ref])
+            elif ref in final:
+                returned[ref] = results[ref]
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                while pending or running:
+                    for step in list(pending):
+                        if all(d in results for d in self._depends(step)):
+                            pending.remove(step)
+                            running[pool.submit(self._run_step, step, results,
+                                                files, env, scheduler,
+                                                threads_per_job)] = step
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        step = running.pop(future)
+                        result = future.result()
+                        if result.error is not None:
+                            for other in running:
+                                other.cancel()
+                            raise result.error
+                        results[step] = result.value
+                        for ref in set(step.inputs()):
+                            finished(ref)
+                        if step in final:
+                            finished(step)
+            for scratch in scratches:
+                if scratch in final:
+                    finished(scratch)
+        finally:
+            # remove whatever a failed run left behind
+            for step, path in files.items():
+                if 'outfile' not in step.kwargs:
+                    _release_outputs(path)
+            for scratch in scratches:
+                if scratch not in returned:
+                    release(scratch.path)
+                scratch.path = None
+        return {ref.name: returned.get(ref) for ref in outputs}
+
+    def _run_step(self, step, results, files, env, scheduler=None,
+                  threads=None):
+        args = _resolve(step.args, results)
+        kwargs = {k: _resolve(v, results) for k, v in step.kwargs.items()}
+        if step.writes_image:
+            # write the image to a file, later steps read it from there
+            if kwargs.get('outfile') is None:
+                kwargs['outfile'] = temp_output()
+            kwargs['retimg'] = False
+            stub = os.path.expanduser(kwargs['outfile']).split('.')[0]
+            ext = get_imgext(resolve_output_type(is_temp_output(stub),
+                                                 kwargs.get('output_type')))
+            files[step] = stub + ext
+        result = _run_job(step.func, (args, kwargs), env, scheduler, threads)
+        if result.error is None and step.writes_image:
+            if result.value != 0:
+                return result._replace(
+                    value=None,
+                    error=ValueError('Pipeline step %s failed with exit code %s'
+                                     % (step.name, result.value)))
+            return result._replace(value=files[step])
+        return result
+
+    def _read_back(self, step, path):
+        if step.kwargs.get('retimg', True) is False:
+            return 0
+        kwargs = {k: step.kwargs[k] for k in READ_ARGS if k in step.kwargs}
+        img = readnii(path, **kwargs)
+        if 'outfile' not in step.kwargs:
+            # its file is about to be removed
+            img = detach(img)
+        return img
+
+    def __repr__(self):
+        return 'Pipeline(%s)' % ', '.join(step.name for step in self.steps)
@@ -0,0 +1,245 @@
+"""
+Profiling of wrapper calls
+
+Every wrapper call is recorded as a tree of timed spans: the call itself
+('call', tagged with the tool) and its phases, 'env' (FSL environment
+resolution), 'stage' (writing an in-memory input for FSL, with the bytes
+written), 'subprocess' (the FSL binary, with its CPU time and peak memory),
+'native' (statistics computed in-process), 'read' (reading outputs back)
+and 'cleanup' (removing temporary files).
+
+Spans are only recorded while at least one listener is registered with
+`add_listener`. `Profiler` is a listener that collects spans, summarises
+them per tool and phase and writes Chrome trace-event JSON (viewable in
+chrome://tracing or Perfetto).
+"""
+
+__all__ = ['add_listener',
+           'remove_listener',
+           'Span',
+           'Profiler']
+
+import contextvars
+import json
+import os
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+
+_listeners = []
+_listeners_lock = threading.Lock()
+
+# innermost open span of the running thread / task
+_current = contextvars.ContextVar('fsl_span', default=None)
+
+
+class Span(object):
+    """
+    A timed phase of a wrapper call
+
+    Attributes
+    ----------
+    name : string
+        phase ('call', 'env', 'stage', 'subprocess', 'native', 'read',
+        'cleanup')
+
+    tool : string
+        wrapper the span belongs to (e.g. 'flirt'), None outside a call
+
+    start, end : float
+        `time.perf_counter()` at the start and end of the span
+
+    attrs : dict
+        details of the phase, e.g. 'bytes' for 'stage', 'cpu_user',
+        'cpu_sys' and 'maxrss' (bytes) for 'subprocess'
+
+    parent : Span
+        enclosing span, or None
+    """
+    def __init__(self, name, parent, attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.tool = attrs.pop('tool', None) or (parent.tool if parent else None)
+        self.pid = os.getpid()
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self):
+        """
+        Wall time in seconds
+        """
+        return (self.end or time.perf_counter()) - self.start
+
+    def __repr__(self):
+        return 'Span(%r, tool=%r, duration=%.6f)' % (self.name, self.tool,
+                                                     self.duration)
+
+
+def add_listener(listener):
+    """
+    Register a callable that is given every finished `Span`
+
+    Listeners are called from the thread that ran the span and must be
+    thread-safe. Calls run in worker processes (`batch(processes=True)`)
+    are not seen.
+    """
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """
+    Unregister a listener added with `add_listener`
+    """
+    with _listeners_lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Time a phase of a call, yields the Span (None when nobody listens)
+    """
+    if not _listeners:
+        yield None
+        return
+    s = Span(name, _current.get(), attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs['error'] = repr(e)
+        raise
+    finally:
+        s.end = time.perf_counter()
+        _current.reset(token)
+        for listener in list(_listeners):
+            try:
+                listener(s)
+            except Exception as e:
+                warnings.warn('fsl profiling listener failed: %r' % e)
+
+
+def annotate(**attrs):
+    """
+    Add details to the innermost open span, if any
+    """
+    s = _current.get()
+    if s is not None:
+        s.attrs.update(attrs)
+
+
+def _percentile(values, q):
+    # nearest rank on sorted values
+    idx = int(round(q / 100. * (len(values) - 1)))
+    return values[min(max(idx, 0), len(values) - 1)]
+
+
+class Profiler(object):
+    """
+    Collect the spans of wrapper calls
+
+    Example
+    -------
+    >>> import fsl
+    >>> with fsl.Profiler() as prof:
+    ...     fsl.batch(fsl.flirt, jobs)
+    >>> prof.summary()[('flirt', 'subprocess')]['p90']
+    >>> prof.write_trace('~/desktop/flirt_trace.json')
+    """
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def __call__(self, s):
+        with self._lock:
+            self.spans.append(s)
+
+    def start(self):
+        add_listener(self)
+        return self
+
+    def stop(self):
+        remove_listener(self)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        Aggregate span durations per tool and phase
+
+        Arguments
+        ---------
+        percentiles : sequence of numbers
+            percentiles of the duration to report
+
+        Returns
+        -------
+        dict of (tool, phase) -> dict with 'count', 'total', 'mean', 'max',
+        'p<q>' for each percentile (all in seconds), and the summed
+        'bytes', 'cpu_user' and 'cpu_sys' where the spans have them
+        """
+        with self._lock:
+            spans = list(self.spans)
+        groups = {}
+        for s in spans:
+            groups.setdefault((s.tool, s.name), []).append(s)
+
+        summary = {}
+        for key, group in groups.items():
+            durations = sorted(s.duration for s in group)
+            stats = {'count': len(durations),
+                     'total': sum(durations),
+                     'mean': sum(durations) / len(durations),
+                     'max': durations[-1]}
+            for q in percentiles:
+                stats['p%g' % q] = _percentile(durations, q)
+            for attr in ('bytes', 'cpu_user', 'cpu_sys'):
+                values = [s.attrs[attr] for s in group if attr in s.attrs]
+                if values:
+                    stats[attr] = sum(values)
+            summary[key] = stats
+        return summary
+
+    def trace_events(self):
+        """
+        Spans as Chrome trace-event 'complete' events
+        """
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        for s in spans:
+            args = dict(s.attrs)
+            if s.tool is not None:
+                args['tool'] = s.tool
+            events.append({'name': s.name if s.name != 'call' else s.tool,
+                           'cat': s.name,
+                           'ph': 'X',
+                           'ts': s.start * 1e6,
+                           'dur': s.duration * 1e6,
+                           'pid': s.pid,
+                           'tid': s.thread,
+                           'args': args})
+        return events
+
+    def write_trace(self, filename):
+        """
+        Write the spans as Chrome trace-event JSON
+        """
+        with open(os.path.expanduser(filename), 'w') as f:
+            json.dump({'traceEvents': self.trace_events(),
+                       'displayTimeUnit': 'ms'}, f, default=str)
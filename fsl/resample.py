@@ -0,0 +1,383 @@
+"""
+In-process resampling with FLIRT matrices
+
+`apply_flirt_matrix` applies an affine matrix written by `flirt`
+(`omat`) to an image, on the grid of the reference image, the way
+`flirt -applyxfm -init <mat>` does, without writing the image to disk
+and running the binary.
+
+FLIRT matrices map between "scaled voxel" coordinates: voxel indices
+times the voxel sizes, with the x axis flipped when the image is stored
+in neurological order (its sform, else qform, has a positive
+determinant). Each reference voxel is mapped back into the input image
+and interpolated there (trilinear, nearest neighbour or cubic spline,
+the latter needing scipy). The output is computed in slabs of
+reference slices, so that the coordinate and weight arrays stay small,
+on a pool of threads. The coordinates and weights of a slab are
+computed once and used for every volume of a 4D image and for every
+image of a batch sharing one grid.
+"""
+
+__all__ = ['apply_flirt_matrix',
+           'read_flirt_matrix',
+           'INTERPOLATIONS']
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .compress import wait_output
+from .lazy import LazyImage
+
+
+INTERPOLATIONS = ('trilinear', 'nearestneighbour', 'spline')
+# other names accepted for them
+_INTERP_ALIASES = {'linear': 'trilinear', 'nearest': 'nearestneighbour',
+                   'nn': 'nearestneighbour', 'cubic': 'spline'}
+
+# output voxels per slab
+BLOCK_VOXELS = 1 << 18
+
+# voxels of edge padding before the spline prefilter, so that the
+# coefficients near the border do not depend on a mirrored image
+SPLINE_PAD = 12
+
+
+def read_flirt_matrix(mat):
+    """
+    4x4 FLIRT matrix from a file (as written by flirt -omat) or an array
+    """
+    import numpy as np
+
+    if isinstance(mat, str):
+        mat = np.loadtxt(os.path.expanduser(mat))
+    mat = np.asarray(mat, dtype='float64')
+    if mat.shape != (4, 4):
+        raise ValueError('FLIRT matrix must be 4x4, not %s' % (mat.shape,))
+    return mat
+
+
+def _as_image(img):
+    """
+    nibabel / ants image of a file, LazyImage or in-memory image (voxel
+    data not read for files)
+    """
+    if isinstance(img, LazyImage):
+        return img.image
+    if isinstance(img, str):
+        filename = os.path.expanduser(img)
+        wait_output(filename)
+        if config.get_pypackage() == 'ants':
+            import ants
+            return ants.image_read(filename)
+        import nibabel
+        return nibabel.load(filename)
+    return img
+
+
+def _is_nibabel(img):
+    return hasattr(img, 'dataobj') and hasattr(img, 'header')
+
+
+def _grid(img):
+    """
+    Shape (3D) of an image and its voxel -> FSL scaled voxel matrix
+    """
+    import numpy as np
+    from .stats import image_geometry
+
+    shape = tuple(int(n) for n in img.shape[:3])
+    shape += (1,) * (3 - len(shape))
+    affine, zooms = image_geometry(img)
+
+    neurological = np.linalg.det(affine[:3, :3]) > 0
+    if _is_nibabel(img) and hasattr(img.header, 'get_sform'):
+        if not (img.header.get_sform(coded=True)[1] or
+                img.header.get_qform(coded=True)[1]):
+            # no transform: FSL takes the voxels as radiological
+            neurological = False
+
+    scale = np.diag([float(z) for z in zooms[:3]] + [1.0])
+    if neurological:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = shape[0] - 1
+        scale = scale.dot(flip)
+    return shape, scale
+
+
+def _volumes(img):
+    """
+    3D float32 volumes of an image (one per volume of a 4D image), in
+    Fortran order
+    """
+    import numpy as np
+
+    if _is_nibabel(img):
+        dataobj = img.dataobj
+        if hasattr(dataobj, 'get_scaled'):
+            data = dataobj.get_scaled(dtype='float32')
+        else:
+            data = np.asarray(dataobj, dtype='float32')
+    else:
+        data = np.asarray(img.numpy(), dtype='float32')
+    while data.ndim < 3:
+        data = data[..., np.newaxis]
+    if data.ndim > 4:
+        raise NotImplementedError('images with more than 4 dimensions')
+    # Fortran order, so the volumes flatten (x fastest) without a copy
+    data = np.asfortranarray(data)
+    if data.ndim == 3:
+        return [data]
+    return [data[..., t] for t in range(data.shape[3])]
+
+
+def _interp_name(interp):
+    name = _INTERP_ALIASES.get(interp, interp)
+    if name not in INTERPOLATIONS:
+        raise ValueError('interp must be one of %s' % ', '.join(INTERPOLATIONS))
+    return name
+
+
+def _slab_coords(vox, out_shape, k0, k1):
+    """
+    Input voxel coordinates (3 x n) of the reference voxels in slices
+    k0..k1 (x fastest, like the output slab in Fortran order)
+    """
+    import numpy as np
+
+    i, j, k = np.meshgrid(np.arange(out_shape[0], dtype='float64'),
+                          np.arange(out_shape[1], dtype='float64'),
+                          np.arange(k0, k1, dtype='float64'), indexing='ij')
+    ijk = np.stack([i.ravel(order='F'), j.ravel(order='F'), k.ravel(order='F')])
+    return vox[:3, :3].dot(ijk) + vox[:3, 3:4]
+
+
+def _inside(coords, shape, tol=1e-4):
+    inside = None
+    for axis in range(3):
+        c = coords[axis]
+        ok = (c >= -tol) & (c <= shape[axis] - 1 + tol)
+        inside = ok if inside is None else inside & ok
+    return inside
+
+
+def _trilinear_weights(coords, shape):
+    """
+    Flat indices of the 8 neighbours and their weights, per point
+    """
+    import numpy as np
+
+    lo, frac = [], []
+    for axis in range(3):
+        n = shape[axis]
+        c = np.clip(coords[axis], 0, n - 1)
+        i0 = np.minimum(np.floor(c), max(n - 2, 0)).astype('intp')
+        lo.append(i0)
+        frac.append((c - i0).astype('float32'))
+    strides = (1, shape[0], shape[0] * shape[1])
+    indices, weights = [], []
+    for dx in (0, 1):
+        for dy in (0, 1):
+            for dz in (0, 1):
+                offset = 0
+                weight = None
+                for axis, d in enumerate((dx, dy, dz)):
+                    step = d if shape[axis] > 1 else 0
+                    offset = offset + (lo[axis] + step) * strides[axis]
+                    w = frac[axis] if d else 1 - frac[axis]
+                    weight = w if weight is None else weight * w
+                indices.append(offset)
+                weights.append(weight)
+    return indices, weights
+
+
+def _resample_slab(volumes, prepared, vox, shape, out_shape, k0, k1, interp,
+                   outputs):
+    import numpy as np
+
+    coords = _slab_coords(vox, out_shape, k0, k1)
+    inside = _inside(coords, shape)
+    slab_shape = (out_shape[0], out_shape[1], k1 - k0)
+
+    if interp == 'nearestneighbour':
+        idx = np.zeros(coords.shape[1], dtype='intp')
+        strides = (1, shape[0], shape[0] * shape[1])
+        for axis in range(3):
+            i = np.clip(np.rint(coords[axis]), 0, shape[axis] - 1).astype('intp')
+            idx += i * strides[axis]
+        for vol, out in zip(volumes, outputs):
+            values = vol.ravel(order='F')[idx]
+            values[~inside] = 0
+            out[:, :, k0:k1] = values.reshape(slab_shape, order='F')
+
+    elif interp == 'trilinear':
+        indices, weights = _trilinear_weights(coords, shape)
+        for vol, out in zip(volumes, outputs):
+            flat = vol.ravel(order='F')
+            values = np.zeros(coords.shape[1], dtype='float32')
+            for idx, w in zip(indices, weights):
+                values += flat[idx] * w
+            values[~inside] = 0
+            out[:, :, k0:k1] = values.reshape(slab_shape, order='F')
+
+    else:
+        from scipy import ndimage
+        for coeffs, out in zip(prepared, outputs):
+            values = ndimage.map_coordinates(coeffs, coords + SPLINE_PAD,
+                                             order=3, prefilter=False,
+                                             mode='mirror')
+            values[~inside] = 0
+            out[:, :, k0:k1] = values.reshape(slab_shape, order='F')
+
+
+def _new_image(data, template, ref, dtype):
+    """
+    Image of the input's kind holding `data` on the reference grid
+    """
+    import numpy as np
+
+    if _is_nibabel(template) or not hasattr(template, 'pixeltype'):
+        import nibabel
+        if not _is_nibabel(ref):
+            ref = nibabel.load(ref.filename) if hasattr(ref, 'filename') else None
+        if ref is None:
+            raise ValueError('a nibabel output needs a nibabel reference')
+        header = ref.header.copy()
+        header.set_data_dtype(dtype)
+        img = nibabel.Nifti1Image(data, ref.affine, header)
+        if data.ndim == 4 and _is_nibabel(template):
+            zooms = template.header.get_zooms()
+            img.header.set_zooms(tuple(ref.header.get_zooms()[:3]) +
+                                 (zooms[3] if len(zooms) > 3 else 1.0,))
+        return img
+
+    import ants
+    if not hasattr(ref, 'pixeltype'):
+        ref = ants.from_nibabel(ref)
+    if data.ndim == 3:
+        return ants.from_numpy(data, origin=ref.origin, spacing=ref.spacing,
+                               direction=ref.direction)
+    direction = np.eye(4)
+    direction[:3, :3] = np.asarray(ref.direction)
+    return ants.from_numpy(data, origin=tuple(ref.origin) + (0.0,),
+                           spacing=tuple(ref.spacing) + (1.0,),
+                           direction=direction)
+
+
+def apply_flirt_matrix(img, ref, mat, interp='trilinear', dtype=None,
+                       block=None, threads=None):
+    """
+    Apply a FLIRT affine matrix to an image, in-process
+
+    Does what `flirt -in img -ref ref -applyxfm -init mat -interp interp`
+    does, without temporary files and without FSL.
+
+    Arguments
+    ---------
+    img : string | ants image | nibabel image | list
+        image to resample (3D or 4D), or a list of images that share one
+        grid (batch mode: the coordinates are computed once for all)
+
+    ref : string | ants image | nibabel image
+        reference image, giving the output grid
+
+    mat : string | 4x4 array
+        FLIRT matrix (e.g. the `omat` of `fsl.flirt`) from img to ref
+
+    interp : string
+        'trilinear', 'nearestneighbour' or 'spline' (needs scipy)
+
+    dtype : string | numpy dtype
+        data type of the output (default: float32, the input's type for
+        nearestneighbour)
+
+    block : integer
+        output voxels computed at a time (default: BLOCK_VOXELS)
+
+    threads : integer
+        threads the slabs are computed on (default: number of cores)
+
+    Returns
+    -------
+    ants image | nibabel image (the kind of the input) on the reference
+    grid, or a list of them in batch mode
+
+    Example
+    -------
+    >>> import fsl
+    >>> omat = '~/desktop/t1_to_mni.mat'
+    >>> t1 = fsl.flirt('~/desktop/t1.nii.gz', '~/desktop/mni.nii.gz',
+    ...                omat=omat, dof=12)
+    >>> flair = fsl.apply_flirt_matrix('~/desktop/flair.nii.gz',
+    ...                                '~/desktop/mni.nii.gz', omat)
+    >>> pves = fsl.apply_flirt_matrix([pve_0, pve_1, pve_2], ref, omat)
+    """
+    import numpy as np
+
+    interp = _interp_name(interp)
+    batch = isinstance(img, (list, tuple))
+    images = [_as_image(i) for i in (img if batch else [img])]
+    if not images:
+        return []
+    ref = _as_image(ref)
+    mat = read_flirt_matrix(mat)
+
+    shape, in_scale = _grid(images[0])
+    for other in images[1:]:
+        other_shape, other_scale = _grid(other)
+        if other_shape != shape or not np.allclose(other_scale, in_scale):
+            raise ValueError('images of a batch must share one grid')
+    out_shape, ref_scale = _grid(ref)
+
+    # reference voxel -> input voxel
+    vox = np.linalg.inv(in_scale).dot(np.linalg.inv(mat)).dot(ref_scale)
+
+    volumes, counts, dtypes = [], [], []
+    for image in images:
+        vols = _volumes(image)
+        volumes.extend(vols)
+        counts.append(len(vols))
+        if dtype is not None:
+            dtypes.append(np.dtype(dtype))
+        elif interp == 'nearestneighbour' and _is_nibabel(image):
+            dtypes.append(image.get_data_dtype())
+        else:
+            dtypes.append(np.dtype('float32'))
+
+    prepared = None
+    if interp == 'spline':
+        from scipy import ndimage
+        prepared = [ndimage.spline_filter(np.pad(v, SPLINE_PAD, mode='edge'),
+                                          order=3, output=np.float32,
+                                          mode='mirror') for v in volumes]
+
+    outputs = [np.zeros(out_shape, dtype='float32', order='F') for _ in volumes]
+    block = block or BLOCK_VOXELS
+    depth = max(1, block // max(1, out_shape[0] * out_shape[1]))
+    slabs = [(k0, min(k0 + depth, out_shape[2]))
+             for k0 in range(0, out_shape[2], depth)]
+    threads = max(1, min(threads or os.cpu_count() or 1, len(slabs)))
+
+    def run(slab):
+        _resample_slab(volumes, prepared, vox, shape, out_shape, slab[0],
+                       slab[1], interp, outputs)
+
+    if threads == 1:
+        for slab in slabs:
+            run(slab)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(run, slabs))
+
+    results = []
+    start = 0
+    for image, count, out_dtype in zip(images, counts, dtypes):
+        vols = outputs[start:start + count]
+        start += count
+        data = vols[0] if len(vols) == 1 and len(image.shape) <= 3 else np.stack(vols, axis=-1)
+        if np.issubdtype(out_dtype, np.integer) and interp != 'nearestneighbour':
+            data = np.rint(data)
+        results.append(_new_image(data.astype(out_dtype, copy=False), image,
+                                  ref, out_dtype))
+    return results if batch else results[0]
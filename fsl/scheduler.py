@@ -0,0 +1,355 @@
+"""
+Resource-aware scheduling of wrapper calls
+
+A fixed-size pool either runs out of memory (fnirt can take several GB a
+job) or leaves cores idle (fslstats needs next to nothing). A
+`Scheduler` instead estimates what each call needs before it runs: its
+memory from the tool and the size of its input images (dims x datatype,
+read from the header; for registrations mostly the reference grid) and
+its threads from the tool. Calls are admitted in order against a
+node-wide RAM and core budget; each admitted call gets a disjoint set of
+CPUs its FSL commands are pinned to (through affinity, see
+`fsl.supervisor.set_job_cpus`) and as many threads (OMP_NUM_THREADS and
+friends).
+
+The peak RSS of every finished call is compared with its estimate, and
+the ratio corrects the estimates of later calls to the same tool, so the
+budget gets used more tightly over time. With a `history` file the
+learned ratios are kept between sessions.
+
+`fsl.batch(..., scheduler=True)` and `Pipeline.run(scheduler=True)` use
+the node-wide scheduler set up with `fsl.set_fslscheduler`.
+
+Example
+-------
+>>> import fsl
+>>> fsl.set_fslscheduler(memory=48 * 1024**3, history='~/.fsl_sched.json')
+>>> jobs = [dict(infile=f, reffile='~/desktop/MNI152_T1_1mm.nii.gz')
+...         for f in files]
+>>> results = fsl.batch(fsl.fnirt, jobs, scheduler=True)
+>>> fsl.get_scheduler().estimate(fsl.fnirt, kwargs=jobs[0])
+"""
+
+__all__ = ['Scheduler',
+           'Estimate',
+           'ToolModel',
+           'TOOL_MODELS',
+           'get_scheduler',
+           'image_nbytes']
+
+import inspect
+import json
+import os
+import threading
+from collections import namedtuple, deque
+from contextlib import contextmanager
+
+from . import config
+from .header import read_header
+
+
+MB = 1024 ** 2
+
+ToolModel = namedtuple('ToolModel', ['base', 'factors', 'threads'])
+ToolModel.__doc__ = """
+Memory and thread model of a wrapper: `base` bytes plus, for each image
+argument named in `factors`, its size in bytes times the factor (other
+image arguments count with factor '*', if given), and `threads`
+"""
+
+# first guesses, refined by the peak memory measured per tool
+TOOL_MODELS = {
+    'flirt': ToolModel(64 * MB, {'infile': 6, 'reffile': 6}, 1),
+    'fnirt': ToolModel(256 * MB, {'infile': 6, 'reffile': 60}, 1),
+    'fnirt_with_affine': ToolModel(256 * MB, {'infile': 6, 'reffile': 60}, 1),
+    'fslbet': ToolModel(32 * MB, {'infile': 6}, 1),
+    'fsl_biascorrect': ToolModel(64 * MB, {'file': 16}, 1),
+    'fast': ToolModel(64 * MB, {'file': 16}, 1),
+    'fslstats': ToolModel(16 * MB, {'file': 2}, 1),
+    'fslcog': ToolModel(16 * MB, {'img': 2}, 1),
+    'fslorient': ToolModel(16 * MB, {}, 1),
+}
+DEFAULT_MODEL = ToolModel(64 * MB, {'*': 4}, 1)
+
+# measured / estimated ratios kept per tool, and needed before the
+# estimate may go below the model
+HISTORY = 20
+MIN_SAMPLES = 3
+# head room on top of the largest ratio seen
+MARGIN = 1.2
+
+Estimate = namedtuple('Estimate', ['tool', 'memory', 'threads', 'model'])
+Estimate.__doc__ = """
+What a call is expected to need: `memory` bytes and `threads`, and the
+uncorrected `model` bytes the learned ratio applies to
+"""
+
+# ants pixel type -> bytes per component
+_ANTS_ITEMSIZE = {'unsigned char': 1, 'unsigned int': 4, 'float': 4,
+                  'double': 8}
+
+
+def image_nbytes(img):
+    """
+    Bytes of the voxel data of an image (file or in-memory), from its
+    dimensions and datatype; 0 if it is not an image
+    """
+    if isinstance(img, str):
+        try:
+            hdr = read_header(os.path.expanduser(img))
+        except (ValueError, OSError):
+            return 0
+        dim = hdr['dim']
+        nvox = 1
+        for n in dim[1:max(1, min(int(dim[0]), 7)) + 1]:
+            nvox *= max(int(n), 1)
+        return nvox * max(int(hdr['bitpix']), 8) // 8
+
+    shape = getattr(img, 'shape', None)
+    if shape is None:
+        return 0
+    if hasattr(img, 'get_data_dtype'):
+        itemsize = img.get_data_dtype().itemsize
+    elif hasattr(img, 'pixeltype'):
+        itemsize = _ANTS_ITEMSIZE.get(img.pixeltype, 4) * getattr(img, 'components', 1)
+    elif hasattr(getattr(img, 'dtype', None), 'itemsize'):
+        itemsize = img.dtype.itemsize
+    else:
+        itemsize = 4
+    nvox = 1
+    for n in shape:
+        nvox *= int(n)
+    return nvox * itemsize
+
+
+def _tool_name(func):
+    if isinstance(func, str):
+        return func
+    return getattr(func, '__name__', None) or type(func).__name__
+
+
+def _bind(func, args, kwargs, defaults=False):
+    """
+    Arguments of a call by parameter name (positional ones as 'arg<i>'
+    where the signature is unknown), with the defaults of the others if
+    `defaults`
+    """
+    try:
+        bound = inspect.signature(func).bind_partial(*args, **kwargs)
+    except (TypeError, ValueError):
+        named = dict(('arg%d' % i, a) for i, a in enumerate(args))
+        named.update(kwargs)
+        return named
+    if defaults:
+        bound.apply_defaults()
+    named = dict(bound.arguments)
+    named.update(named.pop('kwargs', None) or {})
+    return named
+
+
+def _total_memory():
+    """
+    RAM available to the process: physical memory, or the cgroup limit
+    if lower
+    """
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        total = 8 * 1024 ** 3
+    for limit_file in ('/sys/fs/cgroup/memory.max',
+                       '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            total = min(total, int(limit))
+    return total
+
+
+def _all_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class Scheduler(object):
+    """
+    Admit calls against a RAM and core budget
+
+    Arguments
+    ---------
+    memory : integer
+        bytes of RAM the admitted calls may use together (default: 80%
+        of the RAM available to the process)
+
+    cores : integer | list of integers
+        number of CPUs, or the CPU ids, shared by the calls (default:
+        every CPU the process may use)
+
+    threads : dict
+        tool name -> threads, overriding the tool models
+
+    history : string
+        JSON file the learned memory ratios are loaded from and saved to
+        (saving is best-effort: a file that cannot be written is skipped)
+
+    A call that needs more memory than the whole budget is admitted when
+    nothing else is running, rather than never.
+    """
+    def __init__(self, memory=None, cores=None, threads=None, history=None):
+        if memory is None:
+            memory = int(_total_memory() * 0.8)
+        if cores is None:
+            cores = _all_cpus()
+        elif isinstance(cores, int):
+            cores = _all_cpus()[:max(1, cores)]
+        self.memory = int(memory)
+        self.cores = tuple(sorted(cores))
+        self.threads = dict(threads or {})
+        if history is not None:
+            history = os.path.expanduser(history)
+        self.history = history
+
+        self._cond = threading.Condition()
+        self._free = set(self.cores)
+        self._used = 0
+        self._running = 0
+        self._queue = deque()
+        self._ratios = {}
+        if history is not None and os.path.exists(history):
+            with open(history) as f:
+                for tool, ratios in json.load(f).items():
+                    self._ratios[tool] = deque(ratios, maxlen=HISTORY)
+
+    def estimate(self, func, args=(), kwargs=None, threads=None):
+        """
+        Estimate the memory and threads of a call of `func` (a wrapper
+        or a tool name) with these arguments
+
+        Returns
+        -------
+        Estimate(tool, memory, threads, model)
+        """
+        tool = _tool_name(func)
+        model = TOOL_MODELS.get(tool, DEFAULT_MODEL)
+        named = _bind(func, args, kwargs or {}) if not isinstance(func, str) else dict(kwargs or {})
+
+        nbytes = model.base
+        for name, value in named.items():
+            factor = model.factors.get(name, model.factors.get('*'))
+            if factor:
+                nbytes += factor * image_nbytes(value)
+
+        memory = nbytes
+        with self._cond:
+            ratios = list(self._ratios.get(tool, ()))
+        if ratios:
+            ratio = max(ratios) * MARGIN
+            if len(ratios) < MIN_SAMPLES:
+                ratio = max(ratio, 1.0)
+            memory = int(nbytes * ratio)
+
+        if threads is None:
+            threads = self.threads.get(tool, model.threads)
+        threads = max(1, min(int(threads), len(self.cores)))
+        return Estimate(tool, memory, threads, nbytes)
+
+    def record(self, estimate, maxrss):
+        """
+        Learn from the peak RSS (bytes) a call with this estimate reached
+        """
+        if not maxrss or not estimate.model:
+            return
+        with self._cond:
+            ratios = self._ratios.setdefault(estimate.tool, deque(maxlen=HISTORY))
+            ratios.append(maxrss / float(estimate.model))
+            if self.history is None:
+                return
+            saved = dict((tool, list(r)) for tool, r in self._ratios.items())
+        tmp = '%s.%d.%d' % (self.history, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp, self.history)
+        except OSError:
+            # the ratios are still used for the rest of the session
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _fits(self, estimate):
+        if self._running == 0:
+            return True
+        return (len(self._free) >= estimate.threads
+                and self._used + estimate.memory <= self.memory)
+
+    @contextmanager
+    def admit(self, estimate):
+        """
+        Wait until the call fits the budget (calls are admitted in the
+        order they asked), yields the CPU ids it is given
+        """
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while self._queue[0] is not ticket or not self._fits(estimate):
+                    self._cond.wait()
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+            cpus = sorted(self._free)[:estimate.threads]
+            self._free.difference_update(cpus)
+            self._used += estimate.memory
+            self._running += 1
+        try:
+            yield cpus
+        finally:
+            with self._cond:
+                self._free.update(cpus)
+                self._used -= estimate.memory
+                self._running -= 1
+                self._cond.notify_all()
+
+    def usage(self):
+        """
+        Current load: dict with 'running' calls, 'memory' bytes reserved
+        and 'cores' in use, 'waiting' calls
+        """
+        with self._cond:
+            return {'running': self._running,
+                    'memory': self._used,
+                    'cores': len(self.cores) - len(self._free),
+                    'waiting': len(self._queue)}
+
+    def learned(self):
+        """
+        Correction ratio (measured / modelled memory) learned per tool
+        """
+        with self._cond:
+            return dict((tool, max(r)) for tool, r in self._ratios.items() if r)
+
+    def __repr__(self):
+        return 'Scheduler(memory=%d, cores=%r)' % (self.memory, self.cores)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    The node-wide scheduler of this process, with the budget set by
+    `fsl.set_fslscheduler`
+    """
+    global _shared
+    key = (config.FSL_SCHED_MEMORY, config.FSL_SCHED_CORES,
+           config.FSL_SCHED_HISTORY)
+    with _shared_lock:
+        if _shared is None or _shared[0] != key:
+            _shared = (key, Scheduler(memory=key[0], cores=key[1],
+                                      history=key[2]))
+        return _shared[1]
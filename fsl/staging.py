@@ -0,0 +1,422 @@
+"""
+Staging of in-memory images and intermediate outputs
+
+By default `checkimg` writes in-memory images to a temporary .nii.gz on
+disk, so every call pays for gzip compression, and FSL then pays for
+decompression. With `set_fslstaging` enabled, images are instead written
+uncompressed (.nii) into a RAM-backed directory such as /dev/shm, and
+temporary outputs are written there as FSLOUTPUTTYPE=NIFTI. Once the
+staged files would exceed the RAM budget, staging falls back to disk.
+
+Staged images are cached by object identity plus a fingerprint of their
+data, so passing the same image (e.g. a template) to many calls writes
+it only once. Each use holds a reference that `release` gives back; the
+file is kept while idle, evicted least-recently-used, and dropped as soon
+as the image is mutated or garbage collected.
+
+Images that are still an unmodified view of a file on disk (nibabel
+images with a proxy dataobj, ants images read with `readnii`) are not
+staged at all: `backing_file` hands their source filename to FSL.
+"""
+
+__all__ = ['staging_enabled',
+           'stage_image',
+           'stage_copy',
+           'clear_staged',
+           'backing_file',
+           'register_source',
+           'temp_output',
+           'is_temp_output',
+           'resolve_output_type',
+           'release',
+           'keep_output',
+           'detach']
+
+import atexit
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from tempfile import mktemp
+
+from . import config
+from .compress import save_image_gz
+from .profiling import annotate
+
+
+NIFTI_HEADER_BYTES = 352
+
+# re-entrant: weakref callbacks can fire while the lock is held
+_lock = threading.RLock()
+# staged path -> bytes reserved for it
+_staged = {}
+# stubs of the temporary outputs outside the RAM directory
+_temp_outputs = set()
+
+# staged images, by id(img) in least-recently-used order and by path
+_images = OrderedDict()
+_image_paths = {}
+
+
+class _StagedImage(object):
+    def __init__(self, key, path, fingerprint, ref):
+        self.key = key
+        self.path = path
+        self.fingerprint = fingerprint
+        self.ref = ref
+        self.refs = 1
+        self.stale = False
+
+
+# FSL-readable file formats
+FSL_EXTS = ('.nii.gz', '.nii', '.hdr', '.img', '.hdr.gz', '.img.gz')
+
+# id(img) -> (weakref, path, (size, mtime), fingerprint) of ants images
+# read from disk
+_sources = {}
+
+
+def staging_enabled():
+    return config.FSL_STAGING is not None
+
+
+def image_nbytes(img):
+    """
+    Size of an in-memory image written as uncompressed NIfTI
+    """
+    if hasattr(img, 'dataobj'):
+        shape, dtype = img.shape, img.get_data_dtype()
+    else:
+        shape, dtype = img.shape, img.numpy().dtype
+    n = 1
+    for s in shape:
+        n *= s
+    return NIFTI_HEADER_BYTES + n * dtype.itemsize
+
+
+def _usage():
+    used = 0
+    for path, reserved in _staged.items():
+        try:
+            used += max(reserved, os.path.getsize(path))
+        except OSError:
+            used += reserved
+    return used
+
+
+def _reserve(nbytes, suffix):
+    """
+    Path in the RAM directory if `nbytes` more fit in the budget, else None
+    """
+    if not staging_enabled():
+        return None
+    with _lock:
+        if _usage() + nbytes > config.FSL_STAGING_BUDGET:
+            # make room by dropping idle staged images
+            _evict(0)
+            if _usage() + nbytes > config.FSL_STAGING_BUDGET:
+                return None
+        path = mktemp(suffix=suffix, dir=config.FSL_STAGING)
+        _staged[path] = nbytes
+    return path
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def register_source(img, path):
+    """
+    Remember that an in-memory (ants) image was read from `path`, so that
+    it can be handed to FSL as is while it is unmodified
+    """
+    from .cache import fingerprint
+
+    path = os.path.abspath(os.path.expanduser(path))
+    key = id(img)
+    try:
+        ref = weakref.ref(img, lambda r, key=key: _sources.pop(key, None))
+    except TypeError:
+        return
+    with _lock:
+        _sources[key] = (ref, path, _file_stamp(path), fingerprint(img))
+
+
+def _nibabel_backing_file(img):
+    from nibabel.arrayproxy import is_proxy
+
+    fname = img.get_filename()
+    if not fname or not is_proxy(img.dataobj):
+        return None
+    if not fname.endswith(FSL_EXTS) or not os.path.exists(fname):
+        return None
+    if not hasattr(img.header, 'get_sform'):
+        return None
+    # the header and affine in memory must still match the file
+    import numpy as np
+    ondisk = type(img).from_filename(fname)
+    if img.header.binaryblock != ondisk.header.binaryblock:
+        return None
+    if not np.allclose(img.affine, ondisk.affine):
+        return None
+    return fname
+
+
+def _ants_backing_file(img):
+    from .cache import fingerprint
+
+    with _lock:
+        source = _sources.get(id(img))
+    if source is None or source[0]() is not img:
+        return None
+    ref, path, stamp, fp = source
+    try:
+        if _file_stamp(path) != stamp:
+            return None
+    except OSError:
+        return None
+    if fingerprint(img) != fp:
+        return None
+    return path
+
+
+def backing_file(img):
+    """
+    Filename an in-memory image was loaded from, if the image (voxel data
+    and header) is unchanged since and the file is readable by FSL, else None
+    """
+    try:
+        if hasattr(img, 'dataobj'):
+            return _nibabel_backing_file(img)
+        return _ants_backing_file(img)
+    except (ImportError, OSError, ValueError):
+        return None
+
+
+def _write_image(img):
+    tmpfile = _reserve(image_nbytes(img), '.nii')
+    if tmpfile is None:
+        tmpfile = save_image_gz(img, mktemp(suffix='.nii.gz'))
+    elif hasattr(img, 'to_filename'):
+        img.to_filename(tmpfile)
+    else:
+        img.to_file(tmpfile)
+    annotate(bytes=os.path.getsize(tmpfile), path=tmpfile)
+    return tmpfile
+
+
+def stage_image(img):
+    """
+    Write an in-memory image where FSL can read it, or reuse the file
+    already written for it if the image has not changed since
+
+    Returns
+    -------
+    filename of an uncompressed .nii in the RAM directory, or of a .nii.gz
+    on disk when staging is disabled or over budget
+    """
+    if config.FSL_STAGE_CACHE <= 0:
+        return _write_image(img)
+
+    from .cache import fingerprint
+
+    key = id(img)
+    fp = fingerprint(img)
+    with _lock:
+        path = _reuse(key, img, fp)
+    if path is not None:
+        return path
+
+    tmpfile = _write_image(img)
+    try:
+        ref = weakref.ref(img, lambda r, key=key: _collected(key, r))
+    except TypeError:
+        return tmpfile
+
+    with _lock:
+        path = _reuse(key, img, fp)
+        if path is not None:
+            # another thread staged the same image meanwhile
+            _remove(tmpfile)
+            return path
+        entry = _StagedImage(key, tmpfile, fp, ref)
+        _images[key] = entry
+        _image_paths[tmpfile] = entry
+        _evict(config.FSL_STAGE_CACHE)
+    return tmpfile
+
+
+def _reuse(key, img, fp):
+    """
+    Path of the staged file of an unchanged image, with one more
+    reference taken, else None (call with the lock held)
+    """
+    entry = _images.get(key)
+    if entry is None:
+        return None
+    if (entry.ref() is img and entry.fingerprint == fp
+            and os.path.exists(entry.path)):
+        entry.refs += 1
+        _images.move_to_end(key)
+        annotate(reused=True, path=entry.path)
+        return entry.path
+    # mutated, or a new object that reuses the id
+    _forget(entry)
+    return None
+
+
+def stage_copy(img):
+    """
+    Write an in-memory image to a temporary file of the caller's own, for
+    FSL tools that modify their input in place. Unlike `stage_image` the
+    file is never shared nor reused; give it back with `release`.
+    """
+    return _write_image(img)
+
+
+def _remove(path):
+    _staged.pop(path, None)
+    _temp_outputs.discard(_stub(path))
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _forget(entry):
+    """
+    Stop reusing a staged image; its file goes once nobody uses it
+    """
+    if _images.get(entry.key) is entry:
+        del _images[entry.key]
+    entry.stale = True
+    if entry.refs <= 0:
+        _image_paths.pop(entry.path, None)
+        _remove(entry.path)
+
+
+def _collected(key, ref):
+    with _lock:
+        entry = _images.get(key)
+        if entry is not None and entry.ref is ref:
+            _forget(entry)
+
+
+def _evict(max_idle):
+    """
+    Drop least-recently-used idle staged images beyond `max_idle`
+    """
+    idle = [e for e in _images.values() if e.refs <= 0]
+    for entry in idle[:max(0, len(idle) - max_idle)]:
+        _forget(entry)
+
+
+def clear_staged():
+    """
+    Remove every idle staged image
+    """
+    with _lock:
+        _evict(0)
+
+
+atexit.register(clear_staged)
+
+
+def temp_output(fileext='', nbytes=0):
+    """
+    Filename for a temporary FSL output (written as NIFTI): in the RAM
+    directory if staging is enabled and within budget, else in the
+    default temporary directory
+    """
+    path = _reserve(nbytes, fileext)
+    if path is None:
+        path = mktemp(suffix=fileext)
+        with _lock:
+            _temp_outputs.add(_stub(path))
+        return path
+    if not fileext:
+        # FSL appends the extension to output stubs
+        with _lock:
+            _staged[path + '.nii'] = _staged.pop(path)
+    return path
+
+
+def _stub(path):
+    for ext in FSL_EXTS:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def is_temp_output(path):
+    """
+    Whether `path` (an output stub or filename) was handed out by
+    `temp_output`
+    """
+    path = os.path.expanduser(path)
+    with _lock:
+        return (path in _staged or path + '.nii' in _staged or
+                _stub(path) in _temp_outputs)
+
+
+# FSLOUTPUTTYPE values
+OUTPUT_TYPES = ('NIFTI', 'NIFTI_GZ', 'NIFTI_PAIR', 'NIFTI_PAIR_GZ',
+                'ANALYZE', 'ANALYZE_GZ')
+
+
+def resolve_output_type(temporary, requested=None):
+    """
+    FSLOUTPUTTYPE for an output: the `output_type` asked for in the call,
+    else plain NIFTI for temporary outputs (read back and removed, never
+    worth compressing) and the configured type for the others
+    """
+    from .fslhd import get_fsloutput
+
+    if requested is not None:
+        if requested not in OUTPUT_TYPES:
+            raise ValueError('output_type must be one of %s'
+                             % ', '.join(OUTPUT_TYPES))
+        return requested
+    if temporary:
+        return 'NIFTI'
+    return get_fsloutput()
+
+
+def release(path):
+    """
+    Give back a staged image (kept for reuse until evicted), or remove a
+    temporary file and give back its share of the budget
+    """
+    with _lock:
+        entry = _image_paths.get(path)
+        if entry is not None:
+            entry.refs -= 1
+            if entry.stale:
+                _forget(entry)
+            else:
+                _evict(config.FSL_STAGE_CACHE)
+            return
+        _remove(path)
+
+
+def keep_output(path):
+    """
+    Stop tracking a temporary output whose file is handed on rather than
+    released (outside the RAM directory, the file an image returned by a
+    wrapper is read from)
+    """
+    with _lock:
+        _temp_outputs.discard(_stub(os.path.expanduser(path)))
+
+
+def detach(img):
+    """
+    Load a nibabel image's data into memory so that its file can be removed
+    (ants images are always read into memory)
+    """
+    if hasattr(img, 'pin'):
+        # LazyImage
+        return img.pin()
+    if hasattr(img, 'dataobj'):
+        import numpy as np
+        return img.__class__(np.asanyarray(img.dataobj), img.affine, img.header)
+    return img
@@ -0,0 +1,897 @@
+"""
+In-process NumPy implementation of fslstats
+
+`fslstats` hands in-memory (ants / nibabel) images to `native_fslstats`,
+which computes the common options directly on the voxel array instead
+of writing the image to a temporary file and running the binary. Any
+option it does not support raises NotImplementedError, and `fslstats`
+falls back to the FSL binary.
+
+`fslstats_many` computes several statistics of many images in one pass
+per image and returns them as a table, `fslstats_stream` the statistics
+of every volume of a long 4D series while it is being read, and
+`native_cog` the centre of gravity of every volume (or of every label of
+a label image) for `fslcog`.
+"""
+
+__all__ = ['native_fslstats',
+           'native_cog',
+           'fslstats_many',
+           'fslstats_stream',
+           'NATIVE_OPTS',
+           'MANY_STATS']
+
+import os
+import shlex
+
+from .compress import wait_output
+
+
+# options computed natively, with the number of arguments they take
+NATIVE_OPTS = {'-m': 0, '-M': 0, '-s': 0, '-S': 0, '-r': 0, '-R': 0,
+               '-v': 0, '-V': 0, '-e': 0, '-E': 0, '-c': 0, '-C': 0,
+               '-w': 0, '-x': 0, '-X': 0, '-p': 1, '-P': 1,
+               '-k': 1, '-l': 1, '-u': 1}
+
+HISTOGRAM_BINS = 1000
+# label images with values below this are counted directly by value
+MAX_DIRECT_LABEL = 1 << 20
+MAX_PASSES = 10
+
+
+def _is_nibabel(img):
+    return hasattr(img, 'dataobj') and hasattr(img, 'header')
+
+
+def image_geometry(img):
+    """
+    Voxel-to-mm matrix and voxel sizes of an image, following FSL
+    (sform if set, else qform if set, else scaled voxel coordinates)
+    """
+    import numpy as np
+
+    if _is_nibabel(img):
+        hdr = img.header
+        zooms = np.ones(3)
+        nzooms = min(3, len(hdr.get_zooms()))
+        zooms[:nzooms] = hdr.get_zooms()[:nzooms]
+        if hasattr(hdr, 'get_sform'):
+            sform, scode = hdr.get_sform(coded=True)
+            qform, qcode = hdr.get_qform(coded=True)
+            if scode:
+                return np.asarray(sform, dtype='float64'), zooms
+            if qcode:
+                return np.asarray(qform, dtype='float64'), zooms
+        return np.diag(list(zooms) + [1.0]), zooms
+
+    # ants images live in LPS physical space, FSL/NIfTI in RAS
+    ndim = img.dimension
+    spacing = np.ones(3)
+    spacing[:min(3, ndim)] = img.spacing[:3]
+    direction = np.eye(3)
+    direction[:min(3, ndim), :min(3, ndim)] = np.asarray(img.direction)[:3, :3]
+    origin = np.zeros(3)
+    origin[:min(3, ndim)] = img.origin[:3]
+    affine = np.eye(4)
+    affine[:3, :3] = direction * spacing
+    affine[:3, 3] = origin
+    affine = np.diag([-1.0, -1.0, 1.0, 1.0]).dot(affine)
+    return affine, spacing
+
+
+def image_data(img, dtype='float64'):
+    """
+    Voxel array of an in-memory image (scaled, as FSL reads it), as 4D
+    """
+    import numpy as np
+
+    if _is_nibabel(img):
+        data = np.asarray(img.dataobj, dtype=dtype)
+    else:
+        data = np.asarray(img.numpy(), dtype=dtype)
+    while data.ndim < 4:
+        data = data[..., np.newaxis]
+    if data.ndim > 4:
+        raise NotImplementedError('images with more than 4 dimensions')
+    return data
+
+
+def _load_mask(maskfile):
+    from .fslhd import readnii
+    return image_data(readnii(maskfile))
+
+
+def _fmt(value):
+    # fslstats writes with the default C++ stream precision (6)
+    return '%g' % value
+
+
+def _robust_range(values):
+    """
+    Histogram-based robust range, following FSL's find_thresholds
+    """
+    import numpy as np
+
+    vmin, vmax = float(values.min()), float(values.max())
+    lo, hi = vmin, vmax
+    bottom, top = 0, HISTOGRAM_BINS - 1
+    t2 = t98 = 0.0
+    for npass in range(1, MAX_PASSES + 1):
+        if npass > 1:
+            # redo the histogram over the previous range (slightly widened)
+            bottom = max(bottom - 1, 0)
+            top = min(top + 1, HISTOGRAM_BINS - 1)
+            width = hi - lo
+            lo, hi = (lo + width * bottom / HISTOGRAM_BINS,
+                      lo + width * (top + 1) / HISTOGRAM_BINS)
+        if npass == MAX_PASSES or lo == hi:
+            lo, hi = vmin, vmax
+        if lo == hi:
+            return lo, hi
+
+        hist = _histogram(values, lo, hi)
+        lowest, highest = 0, HISTOGRAM_BINS - 1
+        if npass == MAX_PASSES:
+            # ignore the end bins on the last pass
+            lowest, highest = 1, HISTOGRAM_BINS - 2
+        hist = hist[lowest:highest + 1]
+        count = hist.sum()
+        if count == 0:
+            return lo, hi
+        limit = int(count / 50)
+        cumsum = np.cumsum(hist)
+        bottom = lowest + int(np.searchsorted(cumsum, limit, side='right'))
+        rcumsum = np.cumsum(hist[::-1])
+        top = highest - int(np.searchsorted(rcumsum, limit, side='right'))
+        width = hi - lo
+        t2 = lo + width * bottom / HISTOGRAM_BINS
+        t98 = lo + width * (top + 1) / HISTOGRAM_BINS
+        if npass == MAX_PASSES or (t98 - t2) >= (hi - lo) / 10.0:
+            break
+    return t2, t98
+
+
+def _histogram(values, lo, hi):
+    import numpy as np
+
+    values = values[(values >= lo) & (values <= hi)]
+    idx = ((values - lo) * (HISTOGRAM_BINS / (hi - lo))).astype('int64')
+    np.clip(idx, 0, HISTOGRAM_BINS - 1, out=idx)
+    return np.bincount(idx, minlength=HISTOGRAM_BINS)
+
+
+def _entropy(values):
+    import numpy as np
+
+    if values.size == 0:
+        return 0.0
+    lo, hi = float(values.min()), float(values.max())
+    if lo == hi:
+        return 0.0
+    hist = _histogram(values, lo, hi).astype('float64')
+    p = hist[hist > 0] / hist.sum()
+    return float(-(p * np.log(p)).sum() / np.log(HISTOGRAM_BINS))
+
+
+def _percentile(values, p):
+    import numpy as np
+
+    if values.size == 0:
+        return 0.0
+    idx = min(int(values.size * p / 100.0), values.size - 1)
+    return float(np.partition(values, idx)[idx])
+
+
+def _cog(vols, mask=None):
+    """
+    Centre of gravity (voxel coordinates) of each volume in `vols`
+    (X, Y, Z, G), after zeroing voxels outside the mask and subtracting
+    the minimum as FSL does
+    """
+    import numpy as np
+
+    if mask is not None and not mask.all():
+        vols = np.where(mask, vols, 0.0)
+    nx, ny, nz = vols.shape[:3]
+    nvox = nx * ny * nz
+    # FSL subtracts the minimum before weighting, which is folded into
+    # the sums instead of copying the data:
+    # sum((v - min) x) = sum(v x) - min sum(x)
+    vmin = vols.min(axis=(0, 1, 2)).astype('float64')
+    sxy = vols.sum(axis=2, dtype='float64')
+    marginals = (sxy.sum(axis=1), sxy.sum(axis=0),
+                 vols.sum(axis=(0, 1), dtype='float64'))
+    total = sxy.sum(axis=(0, 1)) - vmin * nvox
+    total[total == 0] = 1.0
+    cog = np.empty((vols.shape[-1], 3))
+    for axis, marginal in enumerate(marginals):
+        coords = np.arange(vols.shape[axis], dtype='float64')
+        coord_sum = coords.sum() * (nvox // vols.shape[axis])
+        cog[:, axis] = (coords.dot(marginal) - vmin * coord_sum) / total
+    return cog
+
+
+def _label_cog(vols, labels):
+    """
+    Centre of gravity (voxel coordinates) of each volume in `vols`
+    (X, Y, Z, G) within every non-zero label of `labels` (X, Y, Z), as
+    `fslstats -K labels -C` computes them
+
+    Returns
+    -------
+    dict of label -> array (G, 3)
+    """
+    import numpy as np
+
+    order = 'F' if vols.flags.f_contiguous else 'C'
+    if np.issubdtype(labels.dtype, np.floating):
+        labels = np.rint(labels)
+    flat = labels.astype('int64').ravel(order)
+    if flat.size and flat.min() >= 0 and flat.max() < MAX_DIRECT_LABEL:
+        values, index = np.arange(flat.max() + 1), flat
+    else:
+        values, index = np.unique(flat, return_inverse=True)
+        index = index.ravel()
+    nlabels = len(values)
+    counts = np.bincount(index, minlength=nlabels)
+
+    nvox = flat.size
+    ngroups = vols.shape[-1]
+    # per volume and label: sum of v, and of v times each coordinate
+    sums = np.zeros((ngroups, nlabels, 4))
+    for axis in range(3):
+        n = vols.shape[axis]
+        shape = [1, 1, 1]
+        shape[axis] = n
+        coord = np.broadcast_to(np.arange(n).reshape(shape), vols.shape[:3])
+        # one bincount per volume over (label, coordinate) pairs
+        idx = index * n + coord.ravel(order)
+        coords = np.arange(n, dtype='float64')
+        for g in range(ngroups):
+            s = np.bincount(idx, weights=vols[..., g].ravel(order),
+                            minlength=nlabels * n).reshape(nlabels, n)
+            sums[g, :, axis + 1] = s.dot(coords)
+            if axis == 0:
+                sums[g, :, 0] = s.sum(axis=1)
+
+    # the minimum FSL subtracts is that of the masked volume, which is
+    # 0 unless the label has negative values or covers every voxel
+    vmin = vols.min(axis=(0, 1, 2)).astype('float64')
+    shifts = np.zeros((ngroups, nlabels))
+    for g in range(ngroups):
+        if vmin[g] < 0:
+            mins = np.zeros(nlabels)
+            np.minimum.at(mins, index, vols[..., g].ravel(order))
+            shifts[g] = mins
+        shifts[g, counts == nvox] = vmin[g]
+    dims = vols.shape[:3]
+    coord_sums = np.array([(d - 1) * d / 2.0 * nvox / d for d in dims])
+
+    total = sums[..., 0] - shifts * nvox
+    total[total == 0] = 1.0
+    cog = (sums[..., 1:] - shifts[..., None] * coord_sums) / total[..., None]
+    return {int(values[l]): cog[:, l] for l in range(nlabels)
+            if values[l] != 0 and counts[l]}
+
+
+def _open_image(img):
+    """
+    Image object for a filename (header only for nibabel, the voxel data
+    is read when used), other images as they are
+    """
+    if not isinstance(img, str):
+        return img
+    wait_output(img)
+    try:
+        import nibabel
+        return nibabel.load(os.path.expanduser(img))
+    except ImportError:
+        from .fslhd import readnii
+        return readnii(os.path.expanduser(img))
+
+
+def native_cog(img, mm=True, ts=False, labels=None):
+    """
+    Centre of gravity of an image, like `fslstats -c` / `-C`
+
+    All volumes of a 4D image are reduced at once, and with `labels` the
+    centre of gravity within every label is computed in the same pass.
+
+    Arguments
+    ---------
+    img : string | nibabel image | ants image
+        image on which the centre of gravity is calculated
+
+    mm : boolean
+        coordinates in mm (through the sform, else the qform) or voxels
+
+    ts : boolean
+        every volume of a 4D image (else only the first, as fslstats)
+
+    labels : string | nibabel image | ants image
+        label image on the same grid; the centre of gravity of `img`
+        within each non-zero label is computed (`fslstats -K`)
+
+    Returns
+    -------
+    array (volumes, 3), or with `labels` a dict of label -> array (volumes, 3)
+    """
+    img = _open_image(img)
+    data = image_data(img, dtype=None)
+    if not ts:
+        data = data[..., :1]
+    vox2mm = image_geometry(img)[0] if mm else None
+
+    def to_mm(cog):
+        if vox2mm is None:
+            return cog
+        return cog.dot(vox2mm[:3, :3].T) + vox2mm[:3, 3]
+
+    if labels is None:
+        return to_mm(_cog(data))
+
+    labels = image_data(_open_image(labels), dtype=None)
+    if labels.shape[:3] != data.shape[:3]:
+        raise ValueError('Label image and image must be the same size')
+    return {label: to_mm(cog)
+            for label, cog in _label_cog(data, labels[..., 0]).items()}
+
+
+def native_fslstats(img, opts, ts=False):
+    """
+    Compute fslstats options on an in-memory image
+
+    Arguments
+    ---------
+    img : nibabel image | ants image
+        image on which statistics are calculated
+
+    opts : string
+        fslstats options (see NATIVE_OPTS for the supported ones).
+        Masks (-k) and thresholds (-l/-u, exclusive as in FSL) apply to
+        the statistics that follow them
+
+    ts : boolean
+        compute the statistics for each volume of a 4D image (`-t`)
+
+    Returns
+    -------
+    string formatted like the output of the fslstats binary
+
+    Raises
+    ------
+    NotImplementedError if an option is not supported natively
+    """
+    tokens = _native_tokens(opts)
+    vox2mm, zooms = image_geometry(img)
+    return _native_stats(image_data(img), vox2mm, zooms, tokens, ts)
+
+
+def _native_tokens(opts):
+    """
+    Split fslstats options, raising NotImplementedError for any that are
+    not computed natively
+    """
+    tokens = shlex.split(opts or '')
+    i = 0
+    while i < len(tokens):
+        nargs = NATIVE_OPTS.get(tokens[i])
+        if nargs is None:
+            raise NotImplementedError('fslstats option %s' % tokens[i])
+        i += 1 + nargs
+    if i > len(tokens):
+        raise NotImplementedError('missing argument for %s' % tokens[-1])
+    return tokens
+
+
+def _native_stats(data, vox2mm, zooms, tokens, ts, masks=None, first=0):
+    """
+    fslstats output for a 4D voxel array. `masks` caches the -k masks
+    across calls, `first` is the index of the first volume of `data` in
+    the series (for -w)
+    """
+    import numpy as np
+
+    voxvol = float(np.prod(np.abs(zooms)))
+    shape = data.shape
+
+    # a group is what one output line is computed over: every volume
+    # separately with ts, else the whole image
+    if ts:
+        groups = data.reshape(-1, shape[3], order='F')
+    else:
+        groups = data.reshape(-1, 1, order='F')
+    ngroups = groups.shape[1]
+
+    kmask = None
+    lthr = uthr = None
+    lines = [[] for _ in range(ngroups)]
+
+    def make_mask():
+        full = np.ones(shape, dtype=bool) if kmask is None else kmask.copy()
+        if lthr is not None:
+            full &= data > lthr
+        if uthr is not None:
+            full &= data < uthr
+        return full
+
+    def put(per_group):
+        for line, values in zip(lines, per_group):
+            line.extend(values)
+
+    def selected(g, nonzero=False):
+        values = groups[mask[:, g], g]
+        if nonzero:
+            values = values[values != 0]
+        return values
+
+    mask4d = make_mask()
+    mask = mask4d.reshape(groups.shape, order='F')
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in ('-k', '-l', '-u'):
+            flag, arg = tokens[i], tokens[i + 1]
+            i += 2
+            if flag == '-k':
+                if masks is None:
+                    kmask = _load_mask(arg) > 0
+                else:
+                    if arg not in masks:
+                        masks[arg] = _load_mask(arg) > 0
+                    kmask = masks[arg]
+                if kmask.shape[:3] != shape[:3]:
+                    raise ValueError('Mask and image must be the same size')
+                kmask = np.broadcast_to(kmask[..., :1], shape)
+            elif flag == '-l':
+                lthr = float(arg)
+            else:
+                uthr = float(arg)
+            mask4d = make_mask()
+            mask = mask4d.reshape(groups.shape, order='F')
+            continue
+
+        flag = tokens[i]
+        i += 1
+        nonzero = flag in ('-M', '-S', '-V', '-E', '-P')
+        if nonzero:
+            m = mask & (groups != 0)
+        else:
+            m = mask
+        n = m.sum(axis=0)
+
+        if flag in ('-m', '-M', '-s', '-S'):
+            v = np.where(m, groups, 0.0)
+            s1 = v.sum(axis=0)
+            mean = s1 / np.maximum(n, 1)
+            if flag in ('-m', '-M'):
+                put([[_fmt(x)] for x in mean])
+            else:
+                s2 = (v * v).sum(axis=0)
+                var = (s2 - n * mean * mean) / np.maximum(n - 1, 1)
+                put([[_fmt(x)] for x in np.sqrt(np.maximum(var, 0.0))])
+        elif flag == '-R':
+            lo = np.where(m, groups, np.inf).min(axis=0)
+            hi = np.where(m, groups, -np.inf).max(axis=0)
+            lo[n == 0] = hi[n == 0] = 0
+            put([[_fmt(a), _fmt(b)] for a, b in zip(lo, hi)])
+        elif flag == '-r':
+            put([[_fmt(x) for x in _robust_range(selected(g))]
+                 if n[g] else ['0', '0'] for g in range(ngroups)])
+        elif flag in ('-v', '-V'):
+            put([['%d' % x, _fmt(x * voxvol)] for x in n])
+        elif flag in ('-e', '-E'):
+            put([[_fmt(_entropy(selected(g, nonzero)))] for g in range(ngroups)])
+        elif flag in ('-p', '-P'):
+            p = float(tokens[i])
+            i += 1
+            put([[_fmt(_percentile(selected(g, nonzero), p))] for g in range(ngroups)])
+        elif flag in ('-c', '-C'):
+            # without -t, FSL only uses the first volume
+            if ts:
+                cog = _cog(data, mask4d)
+            else:
+                cog = _cog(data[..., :1], mask4d[..., :1])
+            if flag == '-c':
+                cog = cog.dot(vox2mm[:3, :3].T) + vox2mm[:3, 3]
+            put([[_fmt(x) for x in c] for c in cog])
+        elif flag in ('-x', '-X'):
+            fill = -np.inf if flag == '-x' else np.inf
+            v = np.where(mask, groups, fill)
+            idx = v.argmax(axis=0) if flag == '-x' else v.argmin(axis=0)
+            coords = np.unravel_index(idx, shape[:3] if ts else shape, order='F')
+            put([['%d' % c[g] for c in coords[:3]] for g in range(ngroups)])
+        elif flag == '-w':
+            rois = []
+            vshape = shape[:3] if ts else shape
+            for g in range(ngroups):
+                nz = np.nonzero((m[:, g] & (groups[:, g] != 0)).reshape(vshape, order='F'))
+                roi = []
+                for axis in range(4):
+                    if axis >= len(nz):
+                        roi += [first + g if ts else 0, 1]
+                    elif nz[axis].size:
+                        roi += [nz[axis].min(), nz[axis].max() - nz[axis].min() + 1]
+                    else:
+                        roi += [0, 0]
+                rois.append(['%d' % x for x in roi])
+            put(rois)
+
+    return '\n'.join(' '.join(line) + ' ' for line in lines) + '\n'
+
+
+# statistics computed by fslstats_many, and the fslstats options they match
+MANY_STATS = ('mean', 'sd', 'min', 'max', 'voxels', 'volume',
+              'mean_nonzero', 'sd_nonzero', 'voxels_nonzero',
+              'volume_nonzero', 'cog_vox', 'cog_mm')
+
+STAT_ALIASES = {'-m': ('mean',), '-s': ('sd',), '-M': ('mean_nonzero',),
+                '-S': ('sd_nonzero',), '-R': ('min', 'max'),
+                'range': ('min', 'max'), '-v': ('voxels', 'volume'),
+                '-V': ('voxels_nonzero', 'volume_nonzero'),
+                '-C': ('cog_vox',), '-c': ('cog_mm',), 'cog': ('cog_mm',)}
+
+CHUNK_VOXELS = 1 << 22
+
+
+class _Moments(object):
+    """
+    Running count / mean / sum of squared deviations, merged chunk by
+    chunk with Chan et al.'s parallel form of Welford's algorithm
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        n = values.size
+        if n == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.n = total
+
+    @property
+    def sd(self):
+        return (self.m2 / (self.n - 1)) ** 0.5 if self.n > 1 else 0.0
+
+
+def _chunks(img):
+    """
+    Yield (offset along the last axis, block) chunks of an image's data.
+    Uncompressed nibabel images are read slab by slab from disk;
+    everything else is read once and then walked in slabs.
+    """
+    import numpy as np
+
+    if _is_nibabel(img):
+        proxy = img.dataobj
+        shape = proxy.shape
+        fname = img.get_filename() or ''
+        if not fname.endswith('.gz') and hasattr(proxy, 'slice_offset'):
+            arr = proxy
+        else:
+            arr = np.asanyarray(proxy)
+    else:
+        arr = img.numpy()
+        shape = arr.shape
+
+    slab = int(np.prod(shape[:-1])) if len(shape) > 1 else 1
+    step = max(1, CHUNK_VOXELS // max(slab, 1))
+    for start in range(0, shape[-1], step):
+        block = np.asarray(arr[..., start:start + step], dtype='float64')
+        yield start, block
+
+
+def _fused_stats(img, want):
+    """
+    Compute the requested statistics of one image in a single pass
+    """
+    import numpy as np
+
+    img = _open_image(img)
+
+    vox2mm, zooms = image_geometry(img)
+    voxvol = float(np.prod(np.abs(zooms)))
+    every, nonzero = _Moments(), _Moments()
+    vmin, vmax = np.inf, -np.inf
+    # sums for the centre of gravity of the first volume
+    need_cog = 'cog_vox' in want or 'cog_mm' in want
+    s_vx, s_x, s_v, s_n = np.zeros(3), np.zeros(3), 0.0, 0
+    cog_min = np.inf
+
+    for start, block in _chunks(img):
+        flat = block.ravel()
+        every.update(flat)
+        nonzero.update(flat[flat != 0])
+        if flat.size:
+            vmin = min(vmin, float(flat.min()))
+            vmax = max(vmax, float(flat.max()))
+        if need_cog:
+            vol = block
+            if vol.ndim == 4:
+                vol = vol[..., 0]
+            elif vol.ndim < 3:
+                vol = vol.reshape(vol.shape + (1,) * (3 - vol.ndim))
+            if block.ndim == 4 and start > 0:
+                continue
+            zoff = start if block.ndim <= 3 else 0
+            for axis in range(3):
+                other = tuple(a for a in range(3) if a != axis)
+                coords = np.arange(vol.shape[axis]) + (zoff if axis == 2 else 0)
+                marginal = vol.sum(axis=other)
+                s_vx[axis] += coords.dot(marginal)
+                s_x[axis] += coords.sum() * vol.size / vol.shape[axis]
+            s_v += float(vol.sum())
+            s_n += vol.size
+            cog_min = min(cog_min, float(vol.min()))
+
+    out = {'mean': every.mean, 'sd': every.sd,
+           'min': vmin if every.n else 0.0, 'max': vmax if every.n else 0.0,
+           'voxels': every.n, 'volume': every.n * voxvol,
+           'mean_nonzero': nonzero.mean, 'sd_nonzero': nonzero.sd,
+           'voxels_nonzero': nonzero.n,
+           'volume_nonzero': nonzero.n * voxvol}
+    if need_cog:
+        # FSL subtracts the minimum before weighting:
+        # sum((v - min) x) = sum(v x) - min sum(x)
+        total = s_v - cog_min * s_n
+        cog = (s_vx - cog_min * s_x) / (total if total else 1.0)
+        out['cog_vox'] = cog
+        out['cog_mm'] = vox2mm[:3, :3].dot(cog) + vox2mm[:3, 3]
+    return {k: out[k] for k in want}
+
+
+def fslstats_many(files, stats=('mean', 'sd', 'min', 'max'), max_workers=None):
+    """
+    Compute several statistics of many images, reading each image once
+
+    Every image is read once, in chunks, and all the requested statistics
+    are accumulated in that single pass (means and standard deviations
+    with Welford's algorithm). Images are spread over a thread pool.
+    Statistics are over the whole image, like fslstats without `-t`.
+
+    Arguments
+    ---------
+    files : list
+        filenames or in-memory (nibabel / ants) images
+
+    stats : list of strings
+        names from MANY_STATS, or fslstats options such as '-m', '-R'
+
+    max_workers : integer
+        number of images processed at once (default: number of cores)
+
+    Returns
+    -------
+    dict mapping 'file' and each statistic to an array with one row per
+    image (CoG statistics have 3 columns)
+
+    Example
+    -------
+    >>> import fsl
+    >>> table = fsl.fslstats_many(['~/desktop/img1.nii.gz', '~/desktop/img2.nii.gz'],
+    ...                           stats=['mean', 'sd', '-R', '-V', 'cog_mm'])
+    >>> table['mean'], table['cog_mm']
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+
+    want = []
+    for stat in stats:
+        for name in STAT_ALIASES.get(stat, (stat,)):
+            if name not in MANY_STATS:
+                raise ValueError('unknown statistic %s' % stat)
+            if name not in want:
+                want.append(name)
+
+    files = list(files)
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as pool:
+        rows = list(pool.map(lambda f: _fused_stats(f, want), files))
+
+    table = {'file': np.array([f if isinstance(f, str) else repr(f) for f in files],
+                              dtype=object)}
+    for name in want:
+        if name.startswith('cog'):
+            table[name] = np.array([r[name] for r in rows]).reshape(-1, 3)
+        elif name.startswith('voxels'):
+            table[name] = np.array([r[name] for r in rows], dtype='int64')
+        else:
+            table[name] = np.array([r[name] for r in rows], dtype='float64')
+    return table
+
+
+def _volume_chunks(img, chunk_volumes=None):
+    """
+    Yield the voxel data of an image as float64 blocks (X, Y, Z, n) of
+    consecutive volumes. Files are read front to back (.gz decompressed
+    as a stream), so only the current block is ever in memory.
+    """
+    import numpy as np
+
+    shape = tuple(img.shape)
+    if len(shape) > 4:
+        raise NotImplementedError('images with more than 4 dimensions')
+    shape = shape + (1,) * (4 - len(shape))
+    volvox = int(np.prod(shape[:3]))
+    if chunk_volumes is None:
+        chunk_volumes = max(1, CHUNK_VOXELS // max(volvox, 1))
+    nvol = shape[3]
+
+    proxy = getattr(img, 'dataobj', None)
+    if (_is_nibabel(img) and hasattr(proxy, 'offset')
+            and isinstance(getattr(proxy, 'file_like', None), str)
+            and getattr(proxy, 'order', 'F') == 'F'):
+        for block in _read_volumes(proxy, shape, chunk_volumes):
+            yield block
+        return
+
+    arr = proxy if _is_nibabel(img) else img.numpy()
+    if len(img.shape) < 4:
+        yield np.asarray(arr, dtype='float64').reshape(shape)
+        return
+    for start in range(0, nvol, chunk_volumes):
+        yield np.asarray(arr[..., start:start + chunk_volumes], dtype='float64')
+
+
+def _read_volumes(proxy, shape, chunk_volumes):
+    import gzip
+    import numpy as np
+
+    path = proxy.file_like
+    dtype = np.dtype(proxy.dtype)
+    slope, inter = getattr(proxy, 'slope', 1.0), getattr(proxy, 'inter', 0.0)
+    volbytes = int(np.prod(shape[:3])) * dtype.itemsize
+    nvol = shape[3]
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        f.seek(proxy.offset)
+        for start in range(0, nvol, chunk_volumes):
+            n = min(chunk_volumes, nvol - start)
+            buf = f.read(n * volbytes)
+            if len(buf) < n * volbytes:
+                raise ValueError('%s is truncated' % path)
+            raw = np.frombuffer(buf, dtype=dtype).reshape(shape[:3] + (n,), order='F')
+            block = raw.astype('float64')
+            del buf, raw
+            if slope != 1 or inter != 0:
+                block *= slope
+                block += inter
+            yield block
+
+
+class _Raised(object):
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+def _prefetched(blocks, depth):
+    """
+    Iterate `blocks` with up to `depth` items read ahead on a thread, so
+    that reading (and decompressing, which releases the GIL) overlaps
+    with the computation on the current item
+    """
+    import queue
+    import threading
+
+    if depth <= 0:
+        for block in blocks:
+            yield block
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for block in blocks:
+                if not put(block):
+                    break
+        except BaseException as e:
+            put(_Raised(e))
+        finally:
+            blocks.close()
+            put(_DONE)
+
+    reader = threading.Thread(target=produce, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Raised):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+
+def fslstats_stream(img, opts, chunk_volumes=None, prefetch=1):
+    """
+    Statistics of every volume of a 4D series, computed while it is read
+
+    Like `fslstats(img, opts, ts=True)`, but the series is read a chunk
+    of volumes at a time and the statistics are yielded volume by volume,
+    so memory stays bounded by a few chunks whatever the length of the
+    series. The next chunk is read (and decompressed) on a background
+    thread while the current one is being computed.
+
+    Arguments
+    ---------
+    img : string | nibabel image | ants image
+        4D image (a filename is streamed from disk)
+
+    opts : string
+        fslstats options (see NATIVE_OPTS). Other options fall back to
+        the fslstats binary (in-memory images are staged for it), which
+        then yields the lines of `fslstats -t` once it has finished
+
+    chunk_volumes : integer
+        volumes per chunk (default: as many as fit in CHUNK_VOXELS voxels)
+
+    prefetch : integer
+        chunks read ahead (0 reads and computes in turn, one chunk in memory)
+
+    Yields
+    ------
+    the statistics of each volume, as `fslstats` returns them
+
+    Example
+    -------
+    >>> import fsl
+    >>> for mean in fsl.fslstats_stream('~/desktop/rest.nii.gz', '-M'):
+    ...     print(mean)
+    """
+    from .fslhd import _parse_stats
+
+    try:
+        tokens = _native_tokens(opts)
+    except NotImplementedError:
+        for line in _binary_lines(img, opts):
+            yield _parse_stats(line)
+        return
+
+    img = _open_image(img)
+    vox2mm, zooms = image_geometry(img)
+    masks = {}
+    first = 0
+    for block in _prefetched(_volume_chunks(img, chunk_volumes), prefetch):
+        out = _native_stats(block, vox2mm, zooms, tokens, True,
+                            masks=masks, first=first)
+        first += block.shape[3]
+        del block
+        for line in out.splitlines():
+            yield _parse_stats(line)
+
+
+def _binary_lines(img, opts):
+    from .environment import get_fsl_env
+    from .fslhd import system_cmd, checkimg, remove_tempfile
+
+    filename, needs_removing = checkimg(img)
+    try:
+        cmd = get_fsl_env().argv('fslstats', '-t', filename,
+                                 *shlex.split(opts or ''))
+        retval, stdout = system_cmd(cmd)
+    finally:
+        if needs_removing:
+            remove_tempfile(filename)
+    return [line for line in stdout.splitlines() if line.strip()]
@@ -0,0 +1,409 @@
+"""
+Supervision of FSL subprocesses
+
+Every FSL command run by the wrappers goes through `run_supervised`
+(via `system_cmd`). Each command runs in its own process group under
+the `Policy` set for its tool with `set_policy`: a wall-clock timeout,
+address-space and CPU-time limits (RLIMIT_AS, RLIMIT_CPU) and a retry
+policy. On timeout or cancellation the whole process group is killed,
+so helpers a tool spawned do not outlive it.
+
+`run_supervised` gives back a `JobResult` with the return code, stdout,
+stderr, peak RSS, CPU time and number of attempts. `system_cmd` keeps
+its (returncode, stdout) interface, passes stderr on to sys.stderr and
+raises TimeoutError / CancelledError; the full result of the last
+command a thread ran is available from `last_job`, the peak RSS and CPU
+time of all its commands since a reset from `job_usage`. Commands can be
+pinned to a set of CPUs per thread with `set_job_cpus` (see
+fsl.scheduler).
+
+Example
+-------
+>>> import fsl
+>>> fsl.set_policy('fnirt', timeout=2 * 3600, max_memory=8 * 1024**3,
+...                retries=1)
+>>> fsl.set_policy('bet2', timeout=300)
+>>> img = fsl.fnirt('~/desktop/img.nii.gz', '~/desktop/template.nii.gz')
+>>> fsl.last_job().maxrss, fsl.last_job().stderr
+"""
+
+__all__ = ['Policy',
+           'JobResult',
+           'set_policy',
+           'get_policy',
+           'clear_policies',
+           'run_supervised',
+           'running_jobs',
+           'cancel_jobs',
+           'last_job',
+           'set_job_cpus',
+           'get_job_cpus',
+           'job_usage']
+
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from functools import partial
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not on Windows
+    resource = None
+
+from . import config
+
+
+Policy = namedtuple('Policy', ['timeout', 'max_memory', 'max_cpu', 'retries',
+                               'retry_on', 'backoff'],
+                    defaults=(None, None, None, 0, ('timeout', 'signal'), 1.0))
+Policy.__doc__ = """
+How a tool's processes are run
+
+timeout : seconds of wall-clock time before the process group is killed
+max_memory : bytes of address space (RLIMIT_AS)
+max_cpu : seconds of CPU time (RLIMIT_CPU)
+retries : attempts made after the first one fails
+retry_on : failures that are retried: 'timeout', 'signal' (killed, e.g.
+    by the OOM killer or a limit) and 'error' (non-zero exit code)
+backoff : seconds before the first retry, doubled for each next one
+"""
+
+JobResult = namedtuple('JobResult', ['cmd', 'returncode', 'stdout', 'stderr',
+                                     'maxrss', 'cpu_user', 'cpu_sys', 'wall',
+                                     'attempts', 'timed_out', 'cancelled'])
+JobResult.__doc__ = """
+Outcome of a supervised command: stdout and stderr as text, maxrss in
+bytes (None where unknown), CPU and wall times in seconds, of the last
+attempt
+"""
+
+# tool name -> Policy; None holds the default for other tools
+_policies = {None: Policy()}
+_policies_lock = threading.Lock()
+
+_running = set()
+_running_lock = threading.Lock()
+
+# last result, usage totals and CPU set of the running thread
+_last = threading.local()
+
+
+def set_policy(tool=None, **fields):
+    """
+    Set the supervision policy of a tool (e.g. 'fnirt'; None sets the
+    default of tools without one). Fields not given keep the tool's
+    current values, see `Policy`.
+    """
+    with _policies_lock:
+        policy = _policies.get(tool, _policies[None])
+        _policies[tool] = policy._replace(**fields)
+
+
+def get_policy(tool=None):
+    """
+    Supervision policy of a tool
+    """
+    with _policies_lock:
+        return _policies.get(tool, _policies[None])
+
+
+def clear_policies():
+    """
+    Drop every tool policy and reset the default
+    """
+    with _policies_lock:
+        _policies.clear()
+        _policies[None] = Policy()
+
+
+def cmd_tool(cmd):
+    """
+    Tool name of a command (binary name without FSL prefix)
+    """
+    argv = shlex.split(cmd) if isinstance(cmd, str) else cmd
+    if not argv:
+        return None
+    name = os.path.basename(argv[0])
+    prefix = config.FSL_PRE
+    if prefix and name.startswith(str(prefix)):
+        name = name[len(str(prefix)):]
+    return name
+
+
+def last_job():
+    """
+    JobResult of the last command run by the calling thread, or None
+    """
+    return getattr(_last, 'result', None)
+
+
+def job_usage(reset=False):
+    """
+    Peak RSS (bytes) and CPU seconds (user + system) of the commands run
+    by the calling thread since the last reset, as a (maxrss, cpu) tuple.
+    reset=True starts counting afresh (after giving back the totals).
+    """
+    usage = (getattr(_last, 'maxrss', 0), getattr(_last, 'cpu', 0.0))
+    if reset:
+        _last.maxrss, _last.cpu = 0, 0.0
+    return usage
+
+
+def _add_usage(result):
+    if result.maxrss is not None:
+        _last.maxrss = max(getattr(_last, 'maxrss', 0), result.maxrss)
+        _last.cpu = getattr(_last, 'cpu', 0.0) + result.cpu_user + result.cpu_sys
+
+
+def set_job_cpus(cpus):
+    """
+    Pin the commands launched from the calling thread to a set of CPU
+    ids (where the platform supports affinity). Pass None to clear it.
+    """
+    _last.cpus = frozenset(cpus) if cpus else None
+
+
+def get_job_cpus():
+    """
+    CPU set the calling thread's commands are pinned to, or None
+    """
+    return getattr(_last, 'cpus', None)
+
+
+def running_jobs():
+    """
+    Commands being run right now, as (tool, cmd, pid) tuples
+    """
+    with _running_lock:
+        return [(job.tool, job.cmd, job.pid) for job in _running]
+
+
+def cancel_jobs(tool=None):
+    """
+    Kill the process groups of the running commands (of one tool, or
+    all); the threads running them raise CancelledError. Gives back the
+    number of commands cancelled.
+    """
+    with _running_lock:
+        jobs = [job for job in _running if tool is None or job.tool == tool]
+    for job in jobs:
+        job.cancel()
+    return len(jobs)
+
+
+def _limits(policy):
+    limits = []
+    if resource is None:
+        return limits
+    if policy.max_memory is not None:
+        limits.append((resource.RLIMIT_AS, int(policy.max_memory)))
+    if policy.max_cpu is not None:
+        limits.append((resource.RLIMIT_CPU, int(policy.max_cpu)))
+    return limits
+
+
+def _set_limits(limits):
+    for which, value in limits:
+        resource.setrlimit(which, (value, value))
+
+
+class _Job(object):
+    """
+    One attempt at running a command
+    """
+    def __init__(self, cmd, env, policy, tool, cpus=None):
+        self.cmd = cmd
+        self.env = env
+        self.policy = policy
+        self.tool = tool
+        self.cpus = cpus
+        self.pid = None
+        self.proc = None
+        self.timed_out = False
+        self.cancelled = False
+        # set once the child is about to be reaped: its pid (and process
+        # group id) may then be reused and must not be signalled
+        self.reaped = False
+        self._lock = threading.Lock()
+
+    def _kill(self):
+        with self._lock:
+            if (self.proc is None or self.reaped
+                    or self.proc.returncode is not None):
+                return
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError, AttributeError):
+                try:
+                    self.proc.kill()
+                except OSError:
+                    pass
+
+    def cancel(self):
+        self.cancelled = True
+        self._kill()
+
+    def _expire(self):
+        with self._lock:
+            if self.reaped or self.proc.returncode is not None:
+                return
+            self.timed_out = True
+        self._kill()
+
+    def _start(self):
+        limits = _limits(self.policy)
+        preexec = None
+        if limits and not hasattr(resource, 'prlimit'):
+            preexec = partial(_set_limits, limits)
+        pinned = None
+        if self.cpus and hasattr(os, 'sched_setaffinity'):
+            # the child inherits the affinity of the thread that forks it
+            pinned = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, self.cpus)
+        try:
+            self.proc = subprocess.Popen(self.cmd, shell=isinstance(self.cmd, str),
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, env=self.env,
+                                         start_new_session=os.name == 'posix',
+                                         preexec_fn=preexec)
+        finally:
+            if pinned is not None:
+                os.sched_setaffinity(0, pinned)
+        self.pid = self.proc.pid
+        if self.cancelled:
+            # cancelled while starting
+            self._kill()
+        if limits and preexec is None:
+            for which, value in limits:
+                try:
+                    resource.prlimit(self.proc.pid, which, (value, value))
+                except (ProcessLookupError, PermissionError):
+                    pass
+
+    def run(self):
+        """
+        Run to completion, gives back (stdout, stderr, rusage or None)
+        """
+        self._start()
+        timer = None
+        if self.policy.timeout is not None:
+            timer = threading.Timer(self.policy.timeout, self._expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            if not hasattr(os, 'wait4') or not hasattr(os, 'waitid'):
+                stdout, stderr = self.proc.communicate()
+                return stdout, stderr, None
+            stdout, stderr = _read_pipes(self.proc)
+            # wait for the exit without reaping: until the child is
+            # reaped its pid cannot be reused, so a timeout or cancel
+            # meanwhile still signals the right process group
+            os.waitid(os.P_PID, self.proc.pid, os.WEXITED | os.WNOWAIT)
+            with self._lock:
+                self.reaped = True
+                pid, status, usage = os.wait4(self.proc.pid, 0)
+                if os.WIFSIGNALED(status):
+                    self.proc.returncode = -os.WTERMSIG(status)
+                else:
+                    self.proc.returncode = os.WEXITSTATUS(status)
+        except BaseException:
+            self._kill()
+            self.proc.wait()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return stdout, stderr, usage
+
+
+def _read_pipes(proc):
+    """
+    Read stdout and stderr of a process until both are closed
+    """
+    import selectors
+
+    chunks = {proc.stdout: [], proc.stderr: []}
+    with selectors.DefaultSelector() as sel:
+        for f in chunks:
+            sel.register(f, selectors.EVENT_READ)
+        while sel.get_map():
+            for key, _ in sel.select():
+                data = os.read(key.fd, 1 << 16)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+                else:
+                    chunks[key.fileobj].append(data)
+    return b''.join(chunks[proc.stdout]), b''.join(chunks[proc.stderr])
+
+
+def _failure(result):
+    if result.timed_out:
+        return 'timeout'
+    if result.returncode < 0:
+        return 'signal'
+    if result.returncode > 0:
+        return 'error'
+    return None
+
+
+def run_supervised(cmd, env=None, policy=None, tool=None):
+    """
+    Run a command under a supervision policy
+
+    Arguments
+    ---------
+    cmd : list of strings | string
+        argument list, or a shell command line
+
+    env : dict
+        complete environment of the command (default: inherited)
+
+    policy : Policy
+        default: the policy set for the command's tool
+
+    tool : string
+        tool whose policy applies (default: from the command's binary)
+
+    Returns
+    -------
+    JobResult
+    """
+    if tool is None:
+        tool = cmd_tool(cmd)
+    if policy is None:
+        policy = get_policy(tool)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        job = _Job(cmd, env, policy, tool, get_job_cpus())
+        start = time.perf_counter()
+        with _running_lock:
+            _running.add(job)
+        try:
+            stdout, stderr, usage = job.run()
+        finally:
+            with _running_lock:
+                _running.discard(job)
+        result = JobResult(
+            cmd=cmd, returncode=job.proc.returncode,
+            stdout=stdout.decode('unicode_escape'),
+            stderr=stderr.decode('utf-8', 'replace'),
+            maxrss=usage.ru_maxrss * 1024 if usage is not None else None,
+            cpu_user=usage.ru_utime if usage is not None else None,
+            cpu_sys=usage.ru_stime if usage is not None else None,
+            wall=time.perf_counter() - start, attempts=attempt,
+            timed_out=job.timed_out, cancelled=job.cancelled)
+        _last.result = result
+        _add_usage(result)
+
+        failure = _failure(result)
+        if (job.cancelled or failure is None or failure not in policy.retry_on
+                or attempt > policy.retries):
+            return result
+        time.sleep(policy.backoff * 2 ** (attempt - 1))
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+nib = pytest.importorskip('nibabel')
+
+from fsl import config
+from fsl.environment import reset_fsl_env
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+from stub_fsl import make_fsldir
+
+
+@pytest.fixture(autouse=True)
+def nibabel_package(monkeypatch):
+    monkeypatch.setattr(config, 'PYPACKAGE', 'nibabel')
+    monkeypatch.setattr(config, 'FSL_CACHE', None)
+    monkeypatch.setattr(config, 'FSL_STAGING', None)
+
+
+@pytest.fixture
+def stub_fsl(tmp_path, monkeypatch):
+    """
+    A fake FSL installation (see benchmarks/stub_fsl.py)
+    """
+    monkeypatch.delenv('FSLDIR', raising=False)
+    monkeypatch.delenv('FSLOUTPUTTYPE', raising=False)
+    monkeypatch.setattr(config, 'FSL_PATH', make_fsldir(str(tmp_path / 'fsl')))
+    reset_fsl_env()
+    yield config.FSL_PATH
+    reset_fsl_env()
+
+
+@pytest.fixture
+def make_image(tmp_path):
+    """
+    Write a random float32 image, gives back its filename
+    """
+    def make(name='img.nii.gz', shape=(8, 9, 7), affine=None, seed=0):
+        rng = np.random.RandomState(seed)
+        if affine is None:
+            affine = np.diag([-2.0, 2.0, 2.0, 1.0])
+        path = str(tmp_path / name)
+        nib.save(nib.Nifti1Image(rng.rand(*shape).astype('float32'), affine), path)
+        return path
+    return make
+
+
+@pytest.fixture
+def count_runs(stub_fsl, tmp_path):
+    """
+    Wrap a stub tool so that each run is logged (and optionally slowed
+    down), gives back a function counting the runs so far
+    """
+    def wrap(tool, delay=0.0):
+        path = os.path.join(stub_fsl, 'bin', tool)
+        log = str(tmp_path / ('%s.runs' % tool))
+        os.rename(path, path + '.real')
+        with open(path, 'w') as f:
+            f.write('#!%s -S\nimport os, sys, time\n' % sys.executable)
+            f.write('with open(%r, "a") as f:\n    f.write("run\\n")\n' % log)
+            f.write('time.sleep(%r)\n' % delay)
+            f.write('os.execv(%r, sys.argv)\n' % (path + '.real'))
+        os.chmod(path, 0o755)
+
+        def count():
+            if not os.path.exists(log):
+                return 0
+            with open(log) as f:
+                return len(f.readlines())
+        return count
+    return wrap
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import fsl
+from fsl import aio, staging
+
+
+@pytest.fixture
+def concurrency():
+    default = aio.MAX_CONCURRENCY
+    yield fsl.set_max_concurrency
+    fsl.set_max_concurrency(default)
+
+
+def _log_runs(stub_fsl, tool, log, delay):
+    # log the start and end of each run of the stub tool
+    path = os.path.join(stub_fsl, 'bin', tool)
+    os.rename(path, path + '.real')
+    with open(path, 'w') as f:
+        f.write('#!%s -S\nimport os, subprocess, sys, time\n' % sys.executable)
+        f.write('def log(what):\n    with open(%r, "a") as f:\n'
+                '        f.write("%%s %%d\\n" %% (what, os.getpid()))\n' % log)
+        f.write('log("start")\ntime.sleep(%r)\n' % delay)
+        f.write('code = subprocess.call([%r] + sys.argv[1:])\n' % (path + '.real'))
+        f.write('log("end")\nsys.exit(code)\n')
+    os.chmod(path, 0o755)
+
+
+def _read_log(log):
+    with open(log) as f:
+        return [line.split() for line in f]
+
+
+def test_same_result_as_blocking(stub_fsl, make_image):
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+
+    async def main():
+        return await asyncio.gather(fsl.afslbet(infile, verbose=False),
+                                    fsl.aflirt(infile, reffile),
+                                    fsl.afslstats(infile, opts='-M'))
+
+    bet, warped, mean = asyncio.run(main())
+    np.testing.assert_array_equal(bet.get_fdata(),
+                                  fsl.fslbet(infile, verbose=False).get_fdata())
+    np.testing.assert_array_equal(warped.get_fdata(), nib.load(reffile).get_fdata())
+    assert mean == fsl.fslstats(infile, opts='-M')
+
+
+def test_max_concurrency(stub_fsl, make_image, tmp_path, concurrency):
+    log = str(tmp_path / 'bet.log')
+    _log_runs(stub_fsl, 'bet2', log, 0.2)
+    files = [make_image('img%d.nii.gz' % i, seed=i) for i in range(3)]
+    concurrency(1)
+
+    async def main():
+        return await asyncio.gather(*[fsl.afslbet(f, verbose=False) for f in files])
+
+    assert len(asyncio.run(main())) == 3
+    # one run at a time: every start is followed by its end
+    events = [what for what, pid in _read_log(log)]
+    assert events == ['start', 'end'] * 3
+
+    with pytest.raises(ValueError):
+        concurrency(0)
+
+
+def test_cancel_kills_the_process(stub_fsl, make_image, tmp_path):
+    log = str(tmp_path / 'fnirt.log')
+    _log_runs(stub_fsl, 'fnirt', log, 30)
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+
+    async def main():
+        task = asyncio.ensure_future(fsl.afnirt(infile, reffile, verbose=False))
+        while not os.path.exists(log):
+            await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return time.perf_counter() - start
+
+    assert asyncio.run(main()) < 10
+    (what, pid), = _read_log(log)
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid), 0)
+    assert staging._temp_outputs == set()
+
+
+def test_steps_do_not_block_the_loop(stub_fsl, make_image, monkeypatch):
+    # a slow step between commands (e.g. staging a large image) runs in a
+    # thread, other tasks keep running meanwhile
+    infile = make_image()
+    ticks = []
+
+    def slow_bet(*args, **kwargs):
+        time.sleep(0.5)
+        return (yield from fsl.fslhd._fslbet(*args, **kwargs))
+
+    monkeypatch.setattr(aio, '_fslbet', slow_bet)
+
+    async def ticker():
+        for _ in range(5):
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.05)
+
+    async def main():
+        await asyncio.gather(aio.afslbet(infile, verbose=False), ticker())
+
+    asyncio.run(main())
+    assert ticks[-1] - ticks[0] < 0.45
+
+
+def test_fnirt_with_affine_stops_when_flirt_fails(stub_fsl, count_runs,
+                                                  make_image, tmp_path):
+    runs = count_runs('fnirt')
+    flirt = os.path.join(stub_fsl, 'bin', 'flirt')
+    with open(flirt, 'w') as f:
+        f.write('#!/bin/sh\nexit 3\n')
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+    out = str(tmp_path / 'out.nii.gz')
+    assert fsl.fnirt_with_affine(infile, reffile, outfile=out, retimg=False,
+                                 verbose=False) == 3
+    with pytest.raises(ValueError):
+        asyncio.run(fsl.afnirt_with_affine(infile, reffile, verbose=False))
+    assert runs() == 0
@@ -0,0 +1,22 @@
+import pytest
+
+import fsl
+
+
+def test_batch_keeps_job_order(stub_fsl, make_image):
+    files = [make_image('img%d.nii.gz' % i, shape=(4 + i, 5, 6), seed=i)
+             for i in range(4)]
+    results = fsl.batch(fsl.fslbet, [dict(infile=f, verbose=False) for f in files],
+                        max_workers=3)
+    assert [r.error for r in results] == [None] * 4
+    assert [r.value.shape for r in results] == [(4 + i, 5, 6) for i in range(4)]
+
+
+def test_batch_errors(stub_fsl, make_image, tmp_path):
+    good = make_image()
+    jobs = [dict(infile=good, verbose=False),
+            dict(infile=str(tmp_path / 'missing.nii.gz'), verbose=False)]
+    results = fsl.batch(fsl.fslbet, jobs)
+    assert results[0].error is None and results[1].error is not None
+    with pytest.raises(Exception):
+        fsl.batch(fsl.fslbet, jobs, raise_errors=True)
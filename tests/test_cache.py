@@ -0,0 +1,99 @@
+import asyncio
+import glob
+import json
+import os
+import threading
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import fsl
+from fsl import config
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    root = str(tmp_path / 'cache')
+    os.makedirs(root)
+    monkeypatch.setattr(config, 'FSL_CACHE', root)
+    return root
+
+
+def test_hit_restores_outputs(cache_dir, count_runs, make_image, tmp_path):
+    runs = count_runs('flirt')
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+    outs = [str(tmp_path / ('out%d.nii.gz' % i)) for i in range(2)]
+    mats = [str(tmp_path / ('out%d.mat' % i)) for i in range(2)]
+    for out, omat in zip(outs, mats):
+        assert fsl.flirt(infile, reffile, omat=omat, outfile=out, retimg=False) == 0
+    assert runs() == 1
+    with open(mats[0]) as f0, open(mats[1]) as f1:
+        assert f0.read() == f1.read()
+    np.testing.assert_array_equal(nib.load(outs[1]).get_fdata(),
+                                  nib.load(reffile).get_fdata())
+
+
+def test_key_follows_inputs_and_options(cache_dir, count_runs, make_image):
+    runs = count_runs('flirt')
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+    fsl.flirt(infile, reffile)
+    fsl.flirt(infile, reffile, dof=12)
+    fsl.flirt(infile, reffile, opts='-cost corratio')
+    fsl.flirt(infile, reffile, opts='-cost  corratio')
+    assert runs() == 3
+    # in-memory inputs are keyed by their contents
+    fsl.flirt(nib.load(infile), nib.load(reffile))
+    fsl.flirt(nib.load(infile), nib.load(reffile))
+    assert runs() == 4
+    fsl.flirt(make_image('in.nii.gz', seed=2), reffile)
+    assert runs() == 5
+
+
+def test_only_outputs_of_the_call_are_cached(cache_dir, stub_fsl, make_image,
+                                              tmp_path):
+    infile = make_image('sub1.nii.gz')
+    stub = str(tmp_path / 'out' / 'sub1')
+    os.makedirs(os.path.dirname(stub))
+    # files sharing the output prefix that bet does not write
+    for name in ('sub10.nii.gz', 'sub1_notes.txt'):
+        with open(os.path.join(os.path.dirname(stub), name), 'w') as f:
+            f.write(name)
+    fsl.fslbet(infile, outfile=stub, retimg=False, opts='-m')
+    manifests = glob.glob(os.path.join(cache_dir, '??', '*', 'manifest.json'))
+    assert len(manifests) == 1
+    with open(manifests[0]) as f:
+        # bet runs uncompressed, the final outputs are compressed after
+        assert sorted(json.load(f)['stubs']['out']) == ['.nii', '_mask.nii']
+
+
+def test_concurrent_calls_run_once(cache_dir, count_runs, make_image, tmp_path):
+    runs = count_runs('flirt', delay=0.5)
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+    outs = [str(tmp_path / ('out%d.nii.gz' % i)) for i in range(3)]
+    threads = [threading.Thread(target=fsl.flirt, args=(infile, reffile),
+                                kwargs=dict(outfile=out, retimg=False))
+               for out in outs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert runs() == 1
+    assert all(os.path.exists(out) for out in outs)
+
+
+def test_concurrent_aio_calls_run_once(cache_dir, count_runs, make_image):
+    runs = count_runs('flirt', delay=0.5)
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+
+    # more calls than threads in the loop's default executor: the waiting
+    # ones must not hold the threads the running one needs
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(
+            *[fsl.aflirt(infile, reffile) for _ in range(40)]), timeout=30)
+
+    imgs = asyncio.run(main())
+    assert runs() == 1
+    for img in imgs:
+        np.testing.assert_array_equal(img.get_fdata(),
+                                      nib.load(reffile).get_fdata())
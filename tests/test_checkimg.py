@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import nibabel as nib
+
+import fsl
+from fsl import staging
+from fsl.fslhd import checkimg
+
+
+def test_unchanged_image_passes_its_file(make_image):
+    path = make_image()
+    img = nib.load(path)
+    assert staging.backing_file(img) == path
+    assert checkimg(img) == (path, False)
+    # reading the voxel data does not change the image
+    img.get_fdata()
+    assert checkimg(img) == (path, False)
+
+
+def test_changed_images_are_staged(make_image):
+    path = make_image()
+
+    # new voxel data
+    img = nib.load(path)
+    changed = nib.Nifti1Image(img.get_fdata() + 1, img.affine, img.header)
+    assert staging.backing_file(changed) is None
+
+    # new header
+    img = nib.load(path)
+    img.header['descrip'] = b'edited'
+    assert staging.backing_file(img) is None
+
+    # new affine
+    img = nib.load(path)
+    img.set_sform(np.eye(4))
+    assert staging.backing_file(img) is None
+    staged, remove = checkimg(img)
+    assert remove and staged != path
+    np.testing.assert_array_equal(nib.load(staged).affine, np.eye(4))
+    fsl.remove_tempfile(staged)
+
+
+def test_removed_or_unreadable_files_are_staged(make_image, tmp_path):
+    path = make_image()
+    img = nib.load(path)
+    img.get_fdata()
+    os.remove(path)
+    assert staging.backing_file(img) is None
+
+    # a format FSL cannot read
+    mgh = str(tmp_path / 'img.mgz')
+    nib.save(nib.MGHImage(np.zeros((4, 4, 4), 'float32'), np.eye(4)), mgh)
+    assert staging.backing_file(nib.load(mgh)) is None
+
+
+def test_wrapper_runs_on_the_original_file(stub_fsl, make_image):
+    path = make_image()
+    fsl.fslbet(nib.load(path), verbose=False)
+    assert fsl.last_job().cmd[1] == path
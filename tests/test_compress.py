@@ -0,0 +1,184 @@
+import gzip
+import os
+import threading
+import time
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import fsl
+from fsl import compress, config
+from fsl.compress import GzipWriter, compress_outputs, write_type
+from fsl.staging import resolve_output_type
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+@pytest.mark.parametrize('size', [0, 1000, 3 * 4096 + 17])
+def test_gzip_writer_round_trip(tmp_path, threads, size):
+    data = np.random.RandomState(0).bytes(size)
+    path = str(tmp_path / 'data.gz')
+    with GzipWriter(path, level=1, threads=threads, block_size=4096) as f:
+        # uneven writes across block boundaries
+        f.write(data[:100])
+        f.write(data[100:])
+    with open(path, 'rb') as f:
+        assert gzip.decompress(f.read()) == data
+
+
+def test_gzip_writer_seek_writes_zeros(tmp_path):
+    path = str(tmp_path / 'data.gz')
+    with GzipWriter(path, threads=2, block_size=16) as f:
+        f.write(b'head')
+        f.seek(40)
+        f.write(b'tail')
+        assert f.tell() == 44
+        with pytest.raises(IOError):
+            f.seek(0)
+    with open(path, 'rb') as f:
+        assert gzip.decompress(f.read()) == b'head' + bytes(36) + b'tail'
+
+
+def test_writers_share_the_deflate_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'FSL_GZIP_THREADS', 3)
+    deflate, deflating = compress._deflate, set()
+
+    def record(block, level):
+        deflating.add(threading.get_ident())
+        return deflate(block, level)
+
+    monkeypatch.setattr(compress, '_deflate', record)
+    data = np.random.RandomState(3).bytes(40 * 4096)
+    paths = [str(tmp_path / ('data%d.gz' % i)) for i in range(6)]
+
+    def write(path):
+        with GzipWriter(path, threads=4, block_size=4096) as f:
+            f.write(data)
+
+    writers = [threading.Thread(target=write, args=(p,)) for p in paths]
+    for t in writers:
+        t.start()
+    for t in writers:
+        t.join()
+    assert 0 < len(deflating) <= 3
+    for path in paths:
+        with open(path, 'rb') as f:
+            assert gzip.decompress(f.read()) == data
+
+
+def test_gzip_file(tmp_path):
+    src = str(tmp_path / 'data.bin')
+    data = np.random.RandomState(1).bytes(100000)
+    with open(src, 'wb') as f:
+        f.write(data)
+    fsl.gzip_file(src, src + '.gz', level=6, threads=3)
+    with gzip.open(src + '.gz', 'rb') as f:
+        assert f.read() == data
+
+
+def test_save_image_gz(tmp_path):
+    data = np.random.RandomState(2).rand(10, 11, 12).astype('float32')
+    img = nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0]))
+    path = fsl.save_image_gz(img, str(tmp_path / 'img.nii.gz'), threads=2)
+    loaded = nib.load(path)
+    np.testing.assert_array_equal(loaded.get_fdata(), data)
+    np.testing.assert_allclose(loaded.affine, img.affine)
+
+
+def test_write_type():
+    # final gzipped outputs are written plain and compressed afterwards
+    assert write_type('NIFTI_GZ') == 'NIFTI'
+    assert write_type('NIFTI_GZ', temporary=True) == 'NIFTI_GZ'
+    assert write_type('NIFTI_PAIR') == 'NIFTI_PAIR'
+    # unless the options name outputs we would not know to compress
+    assert write_type('NIFTI_GZ', tool='flirt', opts='-dof 6') == 'NIFTI'
+    assert write_type('NIFTI_GZ', tool='fnirt', opts='--cout=coef') == 'NIFTI_GZ'
+    assert write_type('NIFTI_GZ', tool='fast', opts=['-o', 'seg']) == 'NIFTI_GZ'
+
+
+def test_resolve_output_type(monkeypatch):
+    monkeypatch.setattr(config, 'FSL_OUTPUTTYPE', 'NIFTI_GZ')
+    assert resolve_output_type(False) == 'NIFTI_GZ'
+    assert resolve_output_type(True) == 'NIFTI'
+    assert resolve_output_type(True, 'NIFTI_GZ') == 'NIFTI_GZ'
+    with pytest.raises(ValueError):
+        resolve_output_type(False, 'MINC')
+
+
+def test_compress_outputs_only_given_files(tmp_path):
+    stub = str(tmp_path / 'sub1')
+    for name in ('sub1.nii', 'sub1_mask.nii', 'sub10.nii', 'sub1_other.nii'):
+        with open(str(tmp_path / name), 'wb') as f:
+            f.write(name.encode())
+    compress_outputs([stub + '.nii', stub + '_mask.nii', stub + '_missing.nii'])
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'sub1.nii.gz', 'sub10.nii', 'sub1_mask.nii.gz', 'sub1_other.nii']
+    with gzip.open(stub + '_mask.nii.gz') as f:
+        assert f.read() == b'sub1_mask.nii'
+
+
+@pytest.fixture
+def background(monkeypatch):
+    monkeypatch.setattr(config, 'FSL_COMPRESS_BACKGROUND', True)
+    yield
+    fsl.wait_outputs()
+
+
+def test_final_outputs_compressed(stub_fsl, make_image, tmp_path,
+                                  monkeypatch):
+    gzipped = []
+    gzip_file = compress._gzip_file
+
+    def counting(src, dst):
+        gzipped.append(os.path.basename(src))
+        gzip_file(src, dst)
+
+    monkeypatch.setattr(compress, '_gzip_file', counting)
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    fsl.fslbet(make_image(), outfile=str(outdir / 'brain.nii.gz'),
+               retimg=False, opts='-m', verbose=False)
+    assert fsl.last_job().cmd[-1] == '-m'
+    # written plain by FSL, then gzipped, the mask too
+    assert sorted(os.listdir(str(outdir))) == ['brain.nii.gz',
+                                                'brain_mask.nii.gz']
+    assert sorted(gzipped) == ['brain.nii', 'brain_mask.nii']
+
+    plain = str(tmp_path / 'plain')
+    fsl.fslbet(make_image(), outfile=plain, retimg=False, output_type='NIFTI',
+               verbose=False)
+    assert os.path.exists(plain + '.nii')
+
+
+def test_compressed_in_the_background(stub_fsl, make_image, tmp_path,
+                                      background, monkeypatch):
+    gzip_file = compress._gzip_file
+
+    def slow(src, dst):
+        time.sleep(0.3)
+        gzip_file(src, dst)
+
+    monkeypatch.setattr(compress, '_gzip_file', slow)
+    out = str(tmp_path / 'brain.nii.gz')
+    fsl.fslbet(make_image(), outfile=out, retimg=False, verbose=False)
+    assert fsl.pending_outputs() == [out]
+    # reading (or writing) the output waits for its compression
+    img = fsl.readnii(out)
+    assert img.shape == (8, 9, 7)
+    assert fsl.pending_outputs() == []
+    assert not os.path.exists(str(tmp_path / 'brain.nii'))
+
+
+def test_failed_compression_is_raised(tmp_path, background, monkeypatch):
+    def broken(src, dst):
+        raise IOError('disk full')
+
+    monkeypatch.setattr(compress, '_gzip_file', broken)
+    src = str(tmp_path / 'out.nii')
+    with open(src, 'wb') as f:
+        f.write(b'x')
+    dst, = compress_outputs([src])
+    with pytest.raises(IOError):
+        fsl.wait_output(dst)
+    # once
+    fsl.wait_output(dst)
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import fsl
+from fsl import config, environment
+
+
+def test_probed_once(stub_fsl, monkeypatch):
+    probes = []
+    probe = environment._probe
+
+    def counting(*args):
+        probes.append(args)
+        return probe(*args)
+
+    monkeypatch.setattr(environment, '_probe', counting)
+    fslenv = fsl.get_fsl_env()
+    assert fsl.get_fsl_env() is fslenv
+    assert len(probes) == 1
+    assert fslenv.fsldir == stub_fsl
+    assert fslenv.version == '6.0.7.4'
+    assert fslenv.env['FSLDIR'] == stub_fsl
+
+
+def test_reprobed_when_the_configuration_changes(stub_fsl, monkeypatch):
+    fslenv = fsl.get_fsl_env()
+    assert fslenv.env['FSLOUTPUTTYPE'] == 'NIFTI_GZ'
+    monkeypatch.setattr(config, 'FSL_OUTPUTTYPE', 'NIFTI')
+    changed = fsl.get_fsl_env()
+    assert changed is not fslenv
+    assert changed.env['FSLOUTPUTTYPE'] == 'NIFTI'
+    fsl.reset_fsl_env()
+    assert fsl.get_fsl_env() is not changed
+
+
+def test_fsl_sh_is_sourced(stub_fsl):
+    with open(os.path.join(stub_fsl, 'etc', 'fslconf', 'fsl.sh'), 'a') as f:
+        f.write('FSL_STUB_SETTING=sourced\nexport FSL_STUB_SETTING\n')
+    fslenv = fsl.get_fsl_env()
+    assert fslenv.env['FSL_STUB_SETTING'] == 'sourced'
+    assert fslenv.environ({'EXTRA': '1'})['EXTRA'] == '1'
+    assert fslenv.environ()['PATH'].split(os.pathsep)[0] == fslenv.bindir
+
+
+def test_binaries_are_resolved(stub_fsl, monkeypatch):
+    fslenv = fsl.get_fsl_env()
+    flirt = os.path.join(stub_fsl, 'bin', 'flirt')
+    assert fslenv.which('flirt') == flirt
+    assert fslenv.argv('flirt', '-dof', 6) == [flirt, '-dof', '6']
+    with pytest.raises(ValueError):
+        fslenv.which('no_such_tool')
+
+    os.rename(flirt, os.path.join(stub_fsl, 'bin', 'fsl5.0-flirt'))
+    monkeypatch.setattr(config, 'FSL_PRE', 'fsl5.0-')
+    prefixed = fsl.get_fsl_env()
+    assert prefixed.which('flirt') == os.path.join(stub_fsl, 'bin', 'fsl5.0-flirt')
+
+
+def test_missing_installation(stub_fsl, monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'FSL_PATH', str(tmp_path / 'missing'))
+    with pytest.raises(ValueError):
+        fsl.get_fsl_env()
+
+
+def test_tools_run_without_a_shell(stub_fsl, make_image):
+    fsl.fslbet(make_image(), verbose=False)
+    cmd = fsl.last_job().cmd
+    assert isinstance(cmd, list)
+    assert cmd[0] == os.path.join(stub_fsl, 'bin', 'bet2')
@@ -0,0 +1,154 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import fsl
+from fsl import executors
+
+
+@pytest.fixture(autouse=True)
+def inline_executor():
+    yield
+    fsl.set_executor(None)
+    fsl.clear_policies()
+
+
+def _fake_submit(tmp_path, run=True):
+    # prints a job id like fsl_sub; runs the script unless run=False
+    path = str(tmp_path / 'fake_sub')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n')
+        if run:
+            f.write('sh "$1" >/dev/null 2>&1 &\n')
+        f.write('echo 4242\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def test_set_executor():
+    assert isinstance(fsl.get_executor(), fsl.InlineExecutor)
+    pool = fsl.PoolExecutor(max_jobs=2)
+    fsl.set_executor(pool)
+    assert fsl.get_executor() is pool
+    with pytest.raises(ValueError):
+        fsl.set_executor(object())
+
+
+def test_pool_executor_limits_running_jobs(tmp_path):
+    log = str(tmp_path / 'log')
+    cmd = 'echo start >> %s; sleep 0.2; echo end >> %s' % (log, log)
+    pool = fsl.PoolExecutor(max_jobs=1)
+    threads = [threading.Thread(target=pool.run, args=(cmd,)) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(log) as f:
+        assert f.read().split() == ['start', 'end'] * 3
+
+
+def test_wrappers_run_through_the_executor(stub_fsl, make_image):
+    runs = []
+
+    class Recording(fsl.InlineExecutor):
+        def run(self, cmd, env=None):
+            runs.append(cmd)
+            return fsl.InlineExecutor.run(self, cmd, env=env)
+
+    fsl.set_executor(Recording())
+    img = fsl.fslbet(make_image(), verbose=False)
+    assert img.shape == (8, 9, 7)
+    assert os.path.basename(runs[0][0]) == 'bet2'
+
+
+def test_cluster_executor(stub_fsl, make_image, tmp_path):
+    executor = fsl.ClusterExecutor(str(tmp_path / 'jobs'),
+                                   submit=_fake_submit(tmp_path),
+                                   submit_args=(), poll=0.05)
+    fsl.set_executor(executor)
+    # the job script gets the FSL environment
+    img = fsl.fslbet(make_image(), verbose=False)
+    assert img.shape == (8, 9, 7)
+
+    result = executor.run('echo out; echo err >&2; exit 3')
+    assert (result.returncode, result.stdout, result.stderr) == (3, 'out\n', 'err\n')
+    # job directories are removed once read back
+    assert os.listdir(executor.workdir) == []
+
+
+def test_cluster_job_lost_without_exit_code(tmp_path, monkeypatch):
+    # the batch system no longer knows the job, which never wrote its
+    # exit code (e.g. killed with its node)
+    monkeypatch.setattr(fsl.ClusterExecutor, 'lost_after', 0.2)
+    executor = fsl.ClusterExecutor(str(tmp_path / 'jobs'),
+                                   submit=_fake_submit(tmp_path, run=False),
+                                   submit_args=(), poll=0.05, status='false')
+    start = time.perf_counter()
+    result = executor.run('true')
+    assert time.perf_counter() - start < 5
+    assert result.returncode == -signal.SIGKILL
+    assert 'job 4242 ended without an exit code' in result.stderr
+    assert not result.timed_out
+
+
+def test_cluster_job_timeout(tmp_path):
+    cancelled = str(tmp_path / 'cancelled')
+    cancel = str(tmp_path / 'fake_del')
+    with open(cancel, 'w') as f:
+        f.write('#!/bin/sh\necho "$1" > %s\n' % cancelled)
+    os.chmod(cancel, 0o755)
+    executor = fsl.ClusterExecutor(str(tmp_path / 'jobs'),
+                                   submit=_fake_submit(tmp_path, run=False),
+                                   submit_args=(), cancel=cancel, poll=0.05)
+    fsl.set_policy('sleep', timeout=0.3)
+    result = executor.run(['sleep', '30'])
+    assert result.timed_out and result.returncode is None
+    with open(cancelled) as f:
+        assert f.read().strip() == '4242'
+
+
+def test_queue_executor(stub_fsl, make_image, tmp_path):
+    with fsl.QueueExecutor(str(tmp_path / 'queue'), workers=2) as executor:
+        fsl.set_executor(executor)
+        jobs = [dict(infile=make_image('img%d.nii.gz' % i, seed=i),
+                     verbose=False) for i in range(4)]
+        results = fsl.batch(fsl.fslbet, jobs, raise_errors=True)
+        assert [r.value.shape for r in results] == [(8, 9, 7)] * 4
+        assert executor.run('exit 5').returncode == 5
+    assert executor.workers == []
+    assert not os.path.exists(os.path.join(executor.queue_dir, 'stop'))
+
+
+def test_queue_workers_started_separately(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    executor = fsl.QueueExecutor(queue_dir)
+    workers = fsl.start_queue_workers(queue_dir, 1)
+    try:
+        assert executor.run('echo queued').stdout == 'queued\n'
+    finally:
+        open(os.path.join(queue_dir, 'stop'), 'w').close()
+        for proc in workers:
+            proc.wait()
+
+
+def test_queue_job_lost_by_its_worker(tmp_path):
+    executor = fsl.QueueExecutor(str(tmp_path / 'queue'))
+    pending = os.path.join(executor.queue_dir, 'pending')
+
+    def claim_and_die():
+        # a worker takes the job and dies before it writes the exit code
+        while not executors._claim(executor.queue_dir):
+            time.sleep(0.01)
+        for name in os.listdir(os.path.join(executor.queue_dir, 'running')):
+            os.remove(os.path.join(executor.queue_dir, 'running', name))
+
+    worker = threading.Thread(target=claim_and_die)
+    worker.start()
+    result = executor.run('true')
+    worker.join()
+    assert result.returncode == -signal.SIGKILL
+    assert 'ended without an exit code' in result.stderr
+    assert os.listdir(pending) == []
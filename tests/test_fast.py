@@ -0,0 +1,84 @@
+import gc
+import os
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import fsl
+from fsl import LazyImage
+
+
+@pytest.fixture
+def outdir(tmp_path):
+    path = tmp_path / 'out'
+    path.mkdir()
+    return path
+
+
+def test_default_outputs(stub_fsl, make_image):
+    infile = make_image()
+    images = fsl.fast(infile, verbose=False)
+    assert sorted(images) == ['pve_0', 'pve_1', 'pve_2', 'restore', 'seg']
+    assert all(isinstance(img, LazyImage) for img in images.values())
+    np.testing.assert_array_equal(images['restore'].get_fdata(),
+                                  nib.load(infile).get_fdata())
+    cmd = fsl.last_job().cmd
+    assert '-B' in cmd and '--nopve' not in cmd and '-b' not in cmd
+
+
+def test_only_the_needed_flags(stub_fsl, make_image, outdir):
+    stub = str(outdir / 'sub')
+    files = fsl.fast(make_image(), outputs=['bias', 'seg_'], outfile=stub,
+                     nclass=2, retimg=False, verbose=False)
+    cmd = fsl.last_job().cmd
+    assert '-b' in cmd and '-g' in cmd and '--nopve' in cmd
+    assert '-B' not in cmd and '-p' not in cmd
+    assert files == {'bias': stub + '_bias.nii.gz',
+                     'seg_0': stub + '_seg_0.nii.gz',
+                     'seg_1': stub + '_seg_1.nii.gz'}
+    # FAST always writes seg, it was not asked for
+    assert sorted(os.listdir(str(outdir))) == ['sub_bias.nii.gz',
+                                               'sub_seg_0.nii.gz',
+                                               'sub_seg_1.nii.gz']
+
+
+def test_other_files_are_kept(stub_fsl, make_image, outdir):
+    # files sharing the prefix that FAST did not write stay
+    for name in ('sub_seg_old.nii.gz', 'sub10_seg.nii.gz', 'sub_pveseg.txt'):
+        (outdir / name).write_bytes(b'x')
+    fsl.fast(make_image(), outputs=['restore'], outfile=str(outdir / 'sub'),
+             retimg=False, verbose=False)
+    assert sorted(os.listdir(str(outdir))) == [
+        'sub10_seg.nii.gz', 'sub_pveseg.txt', 'sub_restore.nii.gz',
+        'sub_seg_old.nii.gz']
+
+
+def test_invalid_outputs(stub_fsl, make_image):
+    infile = make_image()
+    with pytest.raises(ValueError):
+        fsl.fast(infile, outputs=['csf'], verbose=False)
+    with pytest.raises(ValueError):
+        fsl.fast(infile, outputs=['pve_3'], nclass=3, verbose=False)
+
+
+def test_failure_raises(stub_fsl, tmp_path):
+    with pytest.raises(ValueError):
+        fsl.fast(str(tmp_path / 'missing.nii.gz'), verbose=False)
+
+
+def test_temporary_files_go_with_their_images(stub_fsl, make_image):
+    images = fsl.fast(make_image(), outputs=['restore', 'seg'], verbose=False)
+    paths = [img.filename for img in images.values()]
+    assert all(os.path.exists(p) for p in paths)
+    del images
+    gc.collect()
+    assert not any(os.path.exists(p) for p in paths)
+
+
+def test_biascorrect_keeps_only_the_restored_image(stub_fsl, make_image,
+                                                   outdir):
+    stub = str(outdir / 'sub')
+    assert fsl.fsl_biascorrect(make_image(), outfile=stub, retimg=False,
+                               verbose=False) == 0
+    assert os.listdir(str(outdir)) == ['sub.nii.gz']
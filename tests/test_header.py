@@ -0,0 +1,155 @@
+import math
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import fsl
+from fsl.header import qform_matrix, qform_fields, sform_matrix
+
+
+def _rotation(angle, axis):
+    c, s = math.cos(angle), math.sin(angle)
+    i, j = [k for k in range(3) if k != axis]
+    rot = np.eye(4)
+    rot[i, i], rot[i, j], rot[j, i], rot[j, j] = c, -s, s, c
+    return rot
+
+
+def _affine(zooms=(2.0, 1.5, 3.0), flip=False):
+    affine = _rotation(0.3, 0).dot(_rotation(-0.7, 2)).dot(np.diag(list(zooms) + [1.0]))
+    if flip:
+        affine = affine.dot(np.diag([-1.0, 1.0, 1.0, 1.0]))
+    affine[:3, 3] = [10.0, -20.0, 5.5]
+    return affine
+
+
+@pytest.mark.parametrize('name', ['img.nii', 'img.nii.gz'])
+@pytest.mark.parametrize('cls', [nib.Nifti1Image, nib.Nifti2Image])
+def test_read_header_matches_nibabel(tmp_path, name, cls):
+    path = str(tmp_path / name)
+    img = cls(np.zeros((5, 6, 7, 2), dtype='int16'), _affine())
+    img.header['descrip'] = b'test image'
+    nib.save(img, path)
+
+    hdr = fsl.read_header(path)
+    ref = nib.load(path).header
+    assert hdr['format'] == ('NIFTI-2' if cls is nib.Nifti2Image else 'NIFTI-1')
+    assert hdr['compressed'] == name.endswith('.gz')
+    assert list(hdr['dim']) == list(ref['dim'])
+    np.testing.assert_allclose(hdr['pixdim'], ref['pixdim'], rtol=1e-6)
+    assert hdr['datatype'] == int(ref['datatype'])
+    assert hdr['descrip'] == 'test image'
+    np.testing.assert_allclose(sform_matrix(hdr), ref.get_sform(), atol=1e-5)
+
+
+@pytest.mark.parametrize('flip', [False, True])
+def test_qform_matrix_matches_nibabel(tmp_path, flip):
+    path = str(tmp_path / 'img.nii.gz')
+    img = nib.Nifti1Image(np.zeros((4, 4, 4), dtype='uint8'), None)
+    img.set_qform(_affine(flip=flip), code=1)
+    nib.save(img, path)
+    np.testing.assert_allclose(qform_matrix(fsl.read_header(path)),
+                               nib.load(path).get_qform(), atol=1e-5)
+
+
+@pytest.mark.parametrize('flip', [False, True])
+def test_qform_fields_round_trip(flip):
+    mat = _affine(flip=flip)
+    hdr = dict(qform_fields(mat.tolist()), qform_code=1)
+    np.testing.assert_allclose(qform_matrix(hdr), mat, atol=1e-6)
+
+
+def test_qform_fields_drops_shears():
+    # the polar decomposition gives the nearest rotation
+    mat = _affine()
+    mat[0, 1] += 0.01
+    hdr = dict(qform_fields(mat.tolist()), qform_code=1)
+    rot = np.asarray(qform_matrix(hdr))[:3, :3] / np.asarray(hdr['pixdim'][1:4])
+    rot[:, 2] *= hdr['pixdim'][0]
+    np.testing.assert_allclose(rot.T.dot(rot), np.eye(3), atol=1e-6)
+    np.testing.assert_allclose(qform_matrix(hdr), mat, atol=0.02)
+
+
+def test_fslval_and_get_fslhd(tmp_path):
+    path = str(tmp_path / 'img.nii.gz')
+    nib.save(nib.Nifti1Image(np.zeros((5, 6, 7), dtype='float32'),
+                             np.diag([2.0, 3.0, 4.0, 1.0])), path)
+    assert float(fsl.fslval(path, 'dim2')) == 6
+    assert float(fsl.fslval(path, 'pixdim3')) == 4.0
+    assert fsl.get_fslhd(path)['datatype'] in (16, '16')
+
+
+@pytest.mark.parametrize('name', ['img.nii', 'img.nii.gz'])
+def test_native_fslorient(tmp_path, name):
+    path = str(tmp_path / name)
+    data = np.random.RandomState(0).rand(4, 5, 6).astype('float32')
+    nib.save(nib.Nifti1Image(data, np.diag([-2.0, 2.0, 2.0, 1.0])), path)
+    assert fsl.native_fslorient(path, '-getorient') == 'RADIOLOGICAL'
+
+    mat = _affine(flip=True)
+    fsl.native_fslorient(path, ['-setqform'] + ['%.10f' % v for v in mat.ravel()])
+    fsl.native_fslorient(path, '-setqformcode 1')
+    img = nib.load(path)
+    np.testing.assert_allclose(img.get_qform(), mat, atol=1e-5)
+    assert int(img.header['qform_code']) == 1
+    # the voxel data is untouched
+    np.testing.assert_array_equal(img.get_fdata(), data)
+
+    fsl.native_fslorient(path, '-deleteorient')
+    assert fsl.native_fslorient(path, '-getsformcode') == 0
+    assert fsl.native_fslorient(path, '-getqformcode') == 0
+
+
+def test_fslorient_getters(tmp_path):
+    path = str(tmp_path / 'img.nii.gz')
+    img = nib.Nifti1Image(np.zeros((4, 5, 6), dtype='float32'), _affine())
+    img.set_qform(_affine(), code=2)
+    nib.save(img, path)
+    assert fsl.fslorient(path, opts='-getorient') == 'NEUROLOGICAL'
+    assert fsl.fslorient(path, opts='-getqformcode') == 2
+    np.testing.assert_allclose(fsl.fslorient(path, opts='-getsform'),
+                               _affine().ravel(), atol=1e-5)
+
+
+def test_fslorient_copies_in_memory_images(tmp_path):
+    path = str(tmp_path / 'img.nii.gz')
+    img = nib.Nifti1Image(np.zeros((4, 5, 6), dtype='float32'), _affine())
+    nib.save(img, path)
+    img = nib.load(path)
+    out = fsl.fslorient(img, opts='-deleteorient')
+    assert int(out.header['sform_code']) == 0
+    assert int(out.header['qform_code']) == 0
+    # neither the image nor the file it was read from changed
+    assert int(img.header['sform_code']) == 2
+    assert fsl.fslorient(path, opts='-getsformcode') == 2
+
+
+def test_fslorient_copy_and_swap(tmp_path):
+    path = str(tmp_path / 'img.nii')
+    nib.save(nib.Nifti1Image(np.zeros((4, 5, 6), dtype='float32'),
+                             _affine(flip=True)), path)
+    fsl.fslorient(path, retimg=False, opts='-copysform2qform')
+    img = nib.load(path)
+    np.testing.assert_allclose(img.get_qform(), img.get_sform(), atol=1e-5)
+    assert int(img.header['qform_code']) == int(img.header['sform_code'])
+
+    fsl.fslorient(path, retimg=False, opts='-swaporient')
+    assert fsl.fslorient(path, opts='-getorient') == 'NEUROLOGICAL'
+    # voxel 0 is now where the last voxel along x was
+    swapped = nib.load(path).get_sform()
+    np.testing.assert_allclose(swapped.dot([0, 0, 0, 1]),
+                               _affine(flip=True).dot([3, 0, 0, 1]), atol=1e-5)
+
+
+def test_fslorient_binary_fallback(stub_fsl, tmp_path):
+    path = str(tmp_path / 'img.nii.gz')
+    nib.save(nib.Nifti1Image(np.zeros((4, 5, 6), dtype='float32'),
+                             _affine(flip=True)), path)
+    with pytest.raises(NotImplementedError):
+        fsl.native_fslorient(path, '-forceradiological')
+    # not done natively: runs the stub fslorient
+    assert fsl.fslorient(path, retimg=False, opts='-forceradiological') == 0
+    # the stub answers NEUROLOGICAL whatever the image
+    assert fsl.fslorient(path, opts='-getorient', native=False) == 'NEUROLOGICAL'
+    assert fsl.fslorient(path, opts='-getorient') == 'RADIOLOGICAL'
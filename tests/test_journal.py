@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+
+import fsl
+
+
+def _attempts(journal, path):
+    return [job['attempts'] for job in fsl.Journal(journal).jobs('done')
+            if job['job']['args']['infile']['file'] == os.path.abspath(path)]
+
+
+def test_journal_resume(stub_fsl, make_image, tmp_path):
+    files = [make_image('img%d.nii.gz' % i, seed=i) for i in range(3)]
+    outs = [str(tmp_path / ('out%d.nii.gz' % i)) for i in range(3)]
+    journal = str(tmp_path / 'batch.journal')
+    jobs = [dict(infile=f, outfile=o, verbose=False) for f, o in zip(files, outs)]
+    # the last job fails: its input is missing
+    os.rename(files[2], files[2] + '.away')
+
+    first = fsl.batch(fsl.fslbet, jobs, journal=journal)
+    assert [r.error is None for r in first] == [True, True, False]
+    assert fsl.Journal(journal).summary() == {'done': 2, 'failed': 1}
+    written = [os.stat(o).st_mtime_ns for o in outs[:2]]
+
+    # done jobs are skipped and give back their output, the failed one runs
+    os.rename(files[2] + '.away', files[2])
+    second = fsl.batch(fsl.fslbet, jobs, journal=journal)
+    assert [r.error for r in second] == [None] * 3
+    np.testing.assert_array_equal(second[0].value.numpy(), first[0].value.get_fdata())
+    assert [os.stat(o).st_mtime_ns for o in outs[:2]] == written
+    assert os.path.exists(outs[2])
+
+    # a deleted output makes its job run again
+    os.remove(outs[1])
+    fsl.batch(fsl.fslbet, jobs, journal=journal)
+    assert os.path.exists(outs[1])
+    assert _attempts(journal, files[0]) == [1]
+    assert _attempts(journal, files[1]) == [2]
+
+
+def test_journal_positional_outputs(stub_fsl, make_image, tmp_path):
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+    out, omat = str(tmp_path / 'out.nii.gz'), str(tmp_path / 'out.mat')
+    journal = str(tmp_path / 'batch.journal')
+    fsl.batch(fsl.flirt, [(infile, reffile, omat, 6, out, False)], journal=journal)
+    # the same call with keywords is the same job, and it is done
+    fsl.batch(fsl.flirt, [dict(infile=infile, reffile=reffile, omat=omat,
+                               outfile=out, retimg=False)], journal=journal)
+    jobs = fsl.Journal(journal).jobs()
+    assert len(jobs) == 1 and jobs[0]['attempts'] == 1
+    assert sorted(jobs[0]['outputs']) == sorted([omat, out])
+
+    os.remove(out)
+    fsl.batch(fsl.flirt, [(infile, reffile, omat, 6, out, False)], journal=journal)
+    assert fsl.Journal(journal).jobs()[0]['attempts'] == 2
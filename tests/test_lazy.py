@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import fsl
+from fsl import LazyImage
+from fsl.fslhd import checkimg
+
+
+@pytest.fixture
+def int_image(tmp_path):
+    # uncompressed, flipped in x, scaled integers on disk
+    data = np.arange(4 * 5 * 6, dtype='int16').reshape(4, 5, 6)
+    img = nib.Nifti1Image(data, np.diag([-2.0, 2.0, 2.0, 1.0]))
+    img.header.set_slope_inter(0.5, 1.0)
+    path = str(tmp_path / 'int.nii')
+    nib.save(img, path)
+    return path, data * 0.5 + 1.0
+
+
+def test_header_without_voxel_data(int_image):
+    path, data = int_image
+    img = fsl.readnii(path, lazy=True)
+    assert isinstance(img, LazyImage)
+    assert img.shape == data.shape
+    assert not img.loaded
+    # a slice is read from the file, the image is still not loaded
+    np.testing.assert_array_equal(img[:, :, 2], data[:, :, 2])
+    assert not img.loaded
+
+
+def test_voxel_data_is_memory_mapped(int_image, tmp_path):
+    path = str(tmp_path / 'float.nii')
+    data = np.random.RandomState(0).rand(4, 5, 6).astype('float32')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    img = fsl.readnii(path, lazy=True)
+    assert isinstance(img.numpy(), np.memmap)
+    np.testing.assert_array_equal(img.numpy(), data)
+
+
+def test_dtype_cast_when_read(int_image):
+    path, data = int_image
+    img = fsl.readnii(path, lazy=True, dtype='float32')
+    assert img.numpy().dtype == np.float32
+    assert img[0].dtype == np.float32
+    np.testing.assert_allclose(img.numpy(), data)
+    assert img.image.get_data_dtype() == np.float32
+
+
+def test_get_fdata_gives_floats(int_image):
+    path, data = int_image
+    img = fsl.readnii(path, lazy=True, dtype='int16')
+    assert img.get_fdata().dtype == np.float64
+    assert img.get_fdata('float32').dtype == np.float32
+
+
+def test_reorient_applied_when_loaded(int_image):
+    path, data = int_image
+    img = fsl.readnii(path, lazy=True, reorient=True)
+    assert not img.loaded
+    np.testing.assert_array_equal(img.numpy(), data[::-1])
+    assert img.loaded
+    assert nib.aff2axcodes(img.affine) == ('R', 'A', 'S')
+    np.testing.assert_array_equal(img[0], data[-1])
+
+
+def test_pinned_data_outlives_the_file(int_image):
+    path, data = int_image
+    img = fsl.readnii(path, lazy=True).pin()
+    os.remove(path)
+    np.testing.assert_array_equal(img.get_fdata(), data)
+
+
+def test_checkimg_passes_the_file_of_a_plain_lazy_image(int_image):
+    path, data = int_image
+    assert checkimg(fsl.readnii(path, lazy=True)) == (path, False)
+
+
+@pytest.mark.parametrize('kwargs', [{'reorient': True}, {'dtype': 'float32'}])
+def test_checkimg_stages_transformed_lazy_images(int_image, kwargs):
+    # FSL must see the image as read, not as on disk
+    path, data = int_image
+    img = fsl.readnii(path, lazy=True, **kwargs)
+    staged, remove = checkimg(img)
+    assert remove and staged != path
+    # (nibabel may rescale integer data when it writes the copy)
+    np.testing.assert_allclose(nib.load(staged).get_fdata(), img.get_fdata(),
+                               rtol=1e-3)
+    fsl.remove_tempfile(staged)
+
+
+def test_wrappers_return_lazy_images(stub_fsl, make_image):
+    img = fsl.fslbet(make_image(), verbose=False, lazy=True, dtype='float32')
+    assert isinstance(img, LazyImage)
+    assert img.numpy().dtype == np.float32
+    assert img.shape == (8, 9, 7)
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+import fsl
+from fsl import config
+
+
+def test_pipeline(stub_fsl, make_image):
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+    p = fsl.Pipeline()
+    brain = p.add(fsl.fslbet, infile, verbose=False)
+    warped = p.add(fsl.flirt, brain, reffile, name='warped')
+    mean = p.add(fsl.fslstats, warped, opts='-M', name='mean')
+    res = p.run(outputs=[warped, mean])
+    assert res['warped'].shape == (8, 9, 7)
+    assert res['mean'] == 1.0
+    with pytest.raises(ValueError):
+        p.add(fsl.fast, brain)
+
+
+def test_side_outputs_of_intermediates_removed(stub_fsl, make_image, tmp_path,
+                                               monkeypatch):
+    ram = str(tmp_path / 'shm')
+    os.makedirs(ram)
+    monkeypatch.setattr(config, 'FSL_STAGING', ram)
+    monkeypatch.setattr(config, 'FSL_STAGING_BUDGET', 10 * 1024 ** 2)
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+    p = fsl.Pipeline()
+    # bet -m writes a mask next to its (scratch) output
+    brain = p.add(fsl.fslbet, infile, opts='-m', verbose=False)
+    warped = p.add(fsl.flirt, brain, reffile, name='warped')
+    res = p.run(outputs=[warped])
+    assert res['warped'].shape == (8, 9, 7)
+    assert os.listdir(ram) == []
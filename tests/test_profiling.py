@@ -0,0 +1,90 @@
+import json
+
+import nibabel as nib
+import pytest
+
+import fsl
+from fsl import profiling
+from fsl.profiling import span
+
+
+def test_no_spans_without_listeners():
+    with span('call', tool='flirt') as s:
+        assert s is None
+
+
+def test_spans_nest_and_inherit_the_tool():
+    seen = []
+    fsl.add_listener(seen.append)
+    try:
+        with span('call', tool='flirt') as call:
+            with span('stage') as stage:
+                profiling.annotate(bytes=10)
+    finally:
+        fsl.remove_listener(seen.append)
+    # listeners are given each span as it ends
+    assert seen == [stage, call]
+    assert stage.parent is call and stage.tool == 'flirt'
+    assert stage.attrs == {'bytes': 10}
+    assert call.start <= stage.start <= stage.end <= call.end
+
+
+def test_errors_are_recorded():
+    with fsl.Profiler() as prof:
+        with pytest.raises(ValueError):
+            with span('call', tool='fast'):
+                raise ValueError('failed')
+    s, = prof.spans
+    assert 'failed' in s.attrs['error']
+
+
+def test_failing_listener_does_not_fail_the_call():
+    def broken(s):
+        raise RuntimeError('broken')
+
+    fsl.add_listener(broken)
+    try:
+        with pytest.warns(UserWarning):
+            with span('call', tool='bet'):
+                pass
+    finally:
+        fsl.remove_listener(broken)
+
+
+def test_wrapper_phases(stub_fsl, make_image):
+    img = nib.load(make_image())
+    img.header['descrip'] = b'in memory'
+    with fsl.Profiler() as prof:
+        fsl.fslbet(img, verbose=False)
+    names = [s.name for s in prof.spans]
+    for phase in ('call', 'env', 'stage', 'subprocess', 'read', 'cleanup'):
+        assert phase in names
+    assert all(s.tool == 'fslbet' for s in prof.spans)
+    call = prof.spans[names.index('call')]
+    assert all(s.parent is not None for s in prof.spans if s is not call)
+
+    summary = prof.summary()
+    assert summary[('fslbet', 'call')]['count'] == 1
+    assert summary[('fslbet', 'stage')]['bytes'] > 0
+    assert 'cpu_user' in summary[('fslbet', 'subprocess')]
+    stats = summary[('fslbet', 'subprocess')]
+    assert stats['p50'] <= stats['p90'] <= stats['p99'] <= stats['max']
+
+
+def test_profiler_stops_listening(stub_fsl, make_image):
+    prof = fsl.Profiler().start()
+    prof.stop()
+    fsl.fslbet(make_image(), verbose=False)
+    assert prof.spans == []
+
+
+def test_chrome_trace(stub_fsl, make_image, tmp_path):
+    with fsl.Profiler() as prof:
+        fsl.fslbet(make_image(), verbose=False)
+    path = str(tmp_path / 'trace.json')
+    prof.write_trace(path)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    assert len(events) == len(prof.spans)
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in events)
+    assert 'fslbet' in [e['name'] for e in events]
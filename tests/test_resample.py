@@ -0,0 +1,129 @@
+import math
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import fsl
+
+RADIOLOGICAL = np.diag([-2.0, 2.0, 2.0, 1.0])
+NEUROLOGICAL = np.diag([2.0, 2.0, 2.0, 1.0])
+
+
+def _image(data, affine=RADIOLOGICAL):
+    return nib.Nifti1Image(np.asarray(data, dtype='float32'), affine)
+
+
+def _translation(x=0.0, y=0.0, z=0.0):
+    mat = np.eye(4)
+    mat[:3, 3] = [x, y, z]
+    return mat
+
+
+def _ramp(axis, shape=(6, 7, 5)):
+    return np.indices(shape)[axis].astype('float32')
+
+
+def test_identity_nearest_reproduces_input():
+    data = np.random.RandomState(0).rand(6, 7, 5)
+    out = fsl.apply_flirt_matrix(_image(data), _image(data), np.eye(4),
+                                 interp='nearestneighbour')
+    np.testing.assert_array_equal(out.get_fdata(), data.astype('float32'))
+    np.testing.assert_allclose(out.affine, RADIOLOGICAL)
+
+
+def test_translation_radiological():
+    # one 2 mm voxel along y: output[j] = input[j - 1]
+    img = _image(_ramp(1))
+    out = fsl.apply_flirt_matrix(img, img, _translation(y=2.0)).get_fdata()
+    np.testing.assert_allclose(out[:, 1:], _ramp(1)[:, :-1])
+    np.testing.assert_array_equal(out[:, 0], 0)
+
+
+def test_translation_neurological_flips_x():
+    # scaled voxel x runs the other way in neurological images
+    img = _image(_ramp(0), NEUROLOGICAL)
+    out = fsl.apply_flirt_matrix(img, img, _translation(x=2.0)).get_fdata()
+    np.testing.assert_allclose(out[:-1], _ramp(0)[1:])
+    np.testing.assert_array_equal(out[-1], 0)
+
+
+def test_half_voxel_trilinear():
+    img = _image(_ramp(2))
+    out = fsl.apply_flirt_matrix(img, img, _translation(z=-1.0)).get_fdata()
+    np.testing.assert_allclose(out[..., :-1], _ramp(2)[..., :-1] + 0.5, atol=1e-6)
+
+
+@pytest.mark.parametrize('interp, order', [('trilinear', 1),
+                                           ('nearestneighbour', 0),
+                                           ('spline', 3)])
+@pytest.mark.parametrize('affine', [RADIOLOGICAL, NEUROLOGICAL])
+def test_matches_scipy(interp, order, affine):
+    ndimage = pytest.importorskip('scipy.ndimage')
+    rng = np.random.RandomState(1)
+    data = rng.rand(12, 10, 9)
+    c, s = math.cos(0.2), math.sin(0.2)
+    mat = np.array([[c, -s, 0, 1.3], [s, c, 0, -0.7], [0, 0, 1, 0.4],
+                    [0, 0, 0, 1.0]])
+    ref = _image(np.zeros((11, 12, 8)), affine)
+    out = fsl.apply_flirt_matrix(_image(data, affine), ref, mat,
+                                 interp=interp, block=200, threads=3)
+
+    # the same voxel map, written out for scipy
+    scale = np.diag([2.0, 2.0, 2.0, 1.0])
+    if np.linalg.det(affine) > 0:
+        flip = np.diag([-1.0, 1.0, 1.0, 1.0])
+        scale_in, scale_ref = scale.dot(flip), scale.dot(flip)
+        scale_in[0, 3], scale_ref[0, 3] = 2.0 * 11, 2.0 * 10
+    else:
+        scale_in = scale_ref = scale
+    vox = np.linalg.inv(scale_in).dot(np.linalg.inv(mat)).dot(scale_ref)
+    # the spline extends the image by its edge values
+    expected = ndimage.affine_transform(data.astype('float32'), vox,
+                                        output_shape=(11, 12, 8), order=order,
+                                        mode='nearest' if order == 3 else 'constant')
+    inside = ndimage.affine_transform(np.ones_like(data), vox,
+                                      output_shape=(11, 12, 8), order=0,
+                                      mode='constant', cval=0.0) > 0
+    np.testing.assert_allclose(out.get_fdata()[inside], expected[inside],
+                               atol=1e-4 if order == 3 else 1e-5)
+
+
+def test_4d_matches_batch_and_blocks(tmp_path):
+    rng = np.random.RandomState(2)
+    data = rng.rand(6, 7, 5, 3).astype('float32')
+    mat = _translation(0.5, -1.0, 0.3)
+    ref = _image(np.zeros((6, 7, 5)))
+    series = fsl.apply_flirt_matrix(_image(data), ref, mat)
+    batch = fsl.apply_flirt_matrix([_image(data[..., t]) for t in range(3)],
+                                   ref, mat, block=10, threads=2)
+    assert series.shape == (6, 7, 5, 3)
+    for t, out in enumerate(batch):
+        np.testing.assert_allclose(series.get_fdata()[..., t], out.get_fdata())
+
+
+def test_files_and_matrix_file(tmp_path):
+    data = np.random.RandomState(3).rand(6, 7, 5)
+    imgfile, reffile = str(tmp_path / 'img.nii.gz'), str(tmp_path / 'ref.nii.gz')
+    nib.save(_image(data), imgfile)
+    ref = _image(np.zeros((5, 5, 5)), np.diag([-3.0, 3.0, 3.0, 1.0]))
+    nib.save(ref, reffile)
+    matfile = str(tmp_path / 'img.mat')
+    mat = _translation(1.0, 2.0, -0.5)
+    np.savetxt(matfile, mat)
+
+    from_files = fsl.apply_flirt_matrix(imgfile, reffile, matfile)
+    in_memory = fsl.apply_flirt_matrix(_image(data), ref, mat)
+    np.testing.assert_allclose(from_files.get_fdata(), in_memory.get_fdata())
+    np.testing.assert_allclose(from_files.affine, ref.affine)
+    assert from_files.shape == (5, 5, 5)
+
+
+def test_errors():
+    img = _image(np.zeros((4, 4, 4)))
+    with pytest.raises(ValueError):
+        fsl.apply_flirt_matrix(img, img, np.eye(4), interp='sinc')
+    with pytest.raises(ValueError):
+        fsl.apply_flirt_matrix(img, img, np.eye(3))
+    with pytest.raises(ValueError):
+        fsl.apply_flirt_matrix([img, _image(np.zeros((5, 4, 4)))], img, np.eye(4))
@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import nibabel as nib
+
+import fsl
+from fsl.scheduler import Scheduler, Estimate, MB, MIN_SAMPLES, TOOL_MODELS
+
+
+def _hold(scheduler, estimate, started, release, given):
+    with scheduler.admit(estimate) as cpus:
+        given.append(cpus)
+        started.set()
+        release.wait(10)
+
+
+def _start(scheduler, estimate, given):
+    started, release = threading.Event(), threading.Event()
+    t = threading.Thread(target=_hold,
+                         args=(scheduler, estimate, started, release, given))
+    t.start()
+    return t, started, release
+
+
+def test_estimate_from_image_sizes():
+    sched = Scheduler(memory=10 ** 12, cores=[0, 1])
+    ref = nib.Nifti1Image(np.zeros((10, 10, 10), dtype='float32'), np.eye(4))
+    est = sched.estimate(fsl.fnirt, ('input.nii.gz',), {'reffile': ref})
+    # the input file does not exist: only the reference counts
+    assert est.model == TOOL_MODELS['fnirt'].base + 60 * 4000
+    assert est.memory == est.model and est.threads == 1
+    # threads are capped to the cores of the scheduler
+    assert sched.estimate('fnirt', threads=8).threads == 2
+
+
+def test_admission_waits_for_memory():
+    sched = Scheduler(memory=100, cores=[0, 1, 2, 3])
+    given = []
+    first, started, release = _start(sched, Estimate('a', 60, 1, 60), given)
+    assert started.wait(10)
+    second, started2, release2 = _start(sched, Estimate('b', 60, 1, 60), given)
+    time.sleep(0.2)
+    assert not started2.is_set()
+    assert sched.usage() == {'running': 1, 'memory': 60, 'cores': 1, 'waiting': 1}
+    release.set()
+    assert started2.wait(10)
+    release2.set()
+    first.join()
+    second.join()
+    assert sched.usage()['running'] == 0
+
+
+def test_disjoint_cpus_and_oversized_calls():
+    sched = Scheduler(memory=100, cores=[0, 1, 2, 3])
+    given = []
+    runs = [_start(sched, Estimate('a', 10, 2, 10), given) for _ in range(2)]
+    for _, started, _ in runs:
+        assert started.wait(10)
+    assert sorted(given[0] + given[1]) == [0, 1, 2, 3]
+    for t, _, release in runs:
+        release.set()
+        t.join()
+    # more than the whole budget: admitted once nothing else runs
+    with sched.admit(Estimate('big', 1000, 1, 1000)) as cpus:
+        assert len(cpus) == 1
+
+
+def test_record_learns_ratios():
+    sched = Scheduler(memory=10 ** 12, cores=[0])
+    est = sched.estimate('fslstats')
+    sched.record(est, est.model // 2)
+    # too few samples to go below the model
+    assert sched.estimate('fslstats').memory == est.model
+    for _ in range(MIN_SAMPLES):
+        sched.record(est, est.model // 2)
+    assert sched.estimate('fslstats').memory == int(est.model * 0.5 * 1.2)
+    assert sched.learned() == {'fslstats': 0.5}
+
+
+def test_history_in_home_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    sched = Scheduler(memory=10 ** 12, cores=[0], history='~/sched.json')
+    est = Estimate('flirt', 64 * MB, 1, 64 * MB)
+    sched.record(est, 128 * MB)
+    with open(str(tmp_path / 'sched.json')) as f:
+        assert json.load(f) == {'flirt': [2.0]}
+    again = Scheduler(memory=10 ** 12, cores=[0], history='~/sched.json')
+    assert again.learned() == {'flirt': 2.0}
+
+
+def test_unwritable_history_does_not_fail_jobs(stub_fsl, make_image, tmp_path):
+    history = str(tmp_path / 'missing' / 'sched.json')
+    sched = Scheduler(memory=10 ** 12, cores=[0], history=history)
+    sched.record(Estimate('flirt', 64 * MB, 1, 64 * MB), 128 * MB)
+    assert sched.learned() == {'flirt': 2.0}
+    assert not os.path.exists(os.path.dirname(history))
+
+    files = [make_image('img%d.nii.gz' % i, seed=i) for i in range(2)]
+    results = fsl.batch(fsl.fslbet, [dict(infile=f, verbose=False) for f in files],
+                        scheduler=sched)
+    assert [r.error for r in results] == [None, None]
@@ -0,0 +1,211 @@
+import gc
+import os
+import threading
+import time
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import fsl
+from fsl import config, staging
+
+
+@pytest.fixture
+def ram_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / 'shm')
+    os.makedirs(path)
+    monkeypatch.setattr(config, 'FSL_STAGING', path)
+    monkeypatch.setattr(config, 'FSL_STAGING_BUDGET', 10 * 1024 ** 2)
+    monkeypatch.setattr(config, 'FSL_STAGE_CACHE', 8)
+    yield path
+    staging.clear_staged()
+
+
+def _image(seed=0, shape=(6, 7, 8)):
+    data = np.random.RandomState(seed).rand(*shape).astype('float32')
+    return nib.Nifti1Image(data, np.eye(4))
+
+
+def _refs(path):
+    return staging._image_paths[path].refs
+
+
+def test_same_image_is_staged_once(ram_dir):
+    img = _image()
+    path = staging.stage_image(img)
+    assert os.path.dirname(path) == ram_dir and path.endswith('.nii')
+    assert staging.stage_image(img) == path
+    assert _refs(path) == 2
+    staging.release(path)
+    staging.release(path)
+    # idle, kept for the next call
+    assert _refs(path) == 0 and os.path.exists(path)
+    assert staging.stage_image(img) == path
+    staging.release(path)
+
+
+def test_mutated_image_is_staged_again(ram_dir):
+    img = _image()
+    path = staging.stage_image(img)
+    img.get_fdata()[0, 0, 0] = 42.0
+    img = nib.Nifti1Image(img.get_fdata(), img.affine)
+    other = staging.stage_image(img)
+    assert other != path
+    np.testing.assert_array_equal(nib.load(other).get_fdata()[0, 0, 0], 42.0)
+    staging.release(other)
+
+
+def test_stale_file_goes_once_released(ram_dir):
+    img = _image()
+    data = np.asanyarray(img.dataobj)
+    path = staging.stage_image(img)
+    data[0, 0, 0] = 42.0
+    other = staging.stage_image(img)
+    assert other != path
+    # still in use by the first call
+    assert os.path.exists(path)
+    staging.release(path)
+    assert not os.path.exists(path)
+    staging.release(other)
+
+
+def test_idle_images_evicted_least_recently_used(ram_dir, monkeypatch):
+    monkeypatch.setattr(config, 'FSL_STAGE_CACHE', 2)
+    imgs = [_image(seed) for seed in range(3)]
+    paths = []
+    for img in imgs:
+        paths.append(staging.stage_image(img))
+        staging.release(paths[-1])
+    assert [os.path.exists(p) for p in paths] == [False, True, True]
+
+
+def test_collected_image_drops_its_file(ram_dir):
+    img = _image()
+    path = staging.stage_image(img)
+    staging.release(path)
+    del img
+    gc.collect()
+    assert not os.path.exists(path)
+    assert path not in staging._image_paths
+
+
+def test_concurrent_staging_writes_one_entry(ram_dir, monkeypatch):
+    write = staging._write_image
+
+    def slow_write(img):
+        time.sleep(0.1)
+        return write(img)
+
+    monkeypatch.setattr(staging, '_write_image', slow_write)
+    img = _image()
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(staging.stage_image(img)))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(paths)) == 1
+    assert _refs(paths[0]) == 4
+    # the copies written by the threads that lost the race are gone
+    assert os.listdir(ram_dir) == [os.path.basename(paths[0])]
+    for path in paths:
+        staging.release(path)
+    assert _refs(paths[0]) == 0
+
+
+@pytest.mark.parametrize('tool', ['flirt', 'fnirt'])
+def test_inputs_released_without_retimg(stub_fsl, ram_dir, tool, tmp_path):
+    infile, reffile = _image(0), _image(1)
+    out = str(tmp_path / 'out.nii.gz')
+    func = getattr(fsl, tool)
+    assert func(infile, reffile, outfile=out, retimg=False, verbose=False) == 0
+    assert os.path.exists(out)
+    assert [e.refs for e in staging._images.values()] == [0, 0]
+
+
+def test_inputs_released_when_the_command_fails(stub_fsl, ram_dir, tmp_path):
+    os.remove(os.path.join(stub_fsl, 'bin', 'flirt'))
+    with pytest.raises(Exception):
+        fsl.flirt(_image(0), _image(1), outfile=str(tmp_path / 'out.nii.gz'),
+                  retimg=False)
+    assert all(e.refs == 0 for e in staging._images.values())
+
+
+@pytest.mark.parametrize('tool', ['fslbet', 'flirt', 'fnirt',
+                                  'fnirt_with_affine', 'fsl_biascorrect',
+                                  'fast'])
+def test_interrupted_calls_release_their_files(stub_fsl, ram_dir, count_runs,
+                                               tool):
+    # a timed out command: the staged inputs and the temporary outputs go
+    cmd = {'fslbet': 'bet2', 'fsl_biascorrect': 'fast'}.get(tool, tool)
+    if tool == 'fnirt_with_affine':
+        cmd = 'flirt'
+    count_runs(cmd, delay=30)
+    fsl.set_policy(cmd, timeout=0.3)
+    try:
+        args = (_image(0), _image(1)) if 'irt' in tool else (_image(0),)
+        with pytest.raises(TimeoutError):
+            getattr(fsl, tool)(*args, verbose=False)
+    finally:
+        fsl.clear_policies()
+    assert all(e.refs == 0 for e in staging._images.values())
+    # nothing reserved in the RAM directory but the cached inputs
+    assert set(staging._staged) <= set(staging._image_paths)
+    assert staging._temp_outputs == set()
+
+
+def test_over_budget_falls_back_to_disk(ram_dir, monkeypatch):
+    img = _image(shape=(20, 20, 20))
+    monkeypatch.setattr(config, 'FSL_STAGING_BUDGET', staging.image_nbytes(img) - 1)
+    path = staging.stage_image(img)
+    assert path.endswith('.nii.gz') and os.path.dirname(path) != ram_dir
+    np.testing.assert_array_equal(nib.load(path).get_fdata(), img.get_fdata())
+    staging.release(path)
+
+
+def test_temp_outputs(ram_dir):
+    stub = staging.temp_output()
+    assert os.path.dirname(stub) == ram_dir
+    assert staging.is_temp_output(stub) and staging.is_temp_output(stub + '.nii')
+    with open(stub + '.nii', 'wb') as f:
+        f.write(b'x')
+    staging.release(stub + '.nii')
+    assert not os.path.exists(stub + '.nii')
+    assert not staging.is_temp_output(stub)
+
+
+def test_temp_outputs_on_disk_are_forgotten(stub_fsl, make_image, tmp_path):
+    # staging disabled: temporary outputs go to the default temporary
+    # directory, and are not tracked once the call is done
+    assert not staging.staging_enabled()
+    stub = staging.temp_output()
+    assert staging.is_temp_output(stub + '.nii.gz')
+    staging.release(stub + '.nii.gz')
+    assert not staging.is_temp_output(stub)
+
+    infile, reffile = make_image('in.nii.gz'), make_image('ref.nii.gz', seed=1)
+    fsl.fslbet(infile, verbose=False)
+    fsl.flirt(infile, reffile)
+    fsl.fnirt(infile, reffile, verbose=False)
+    fsl.fsl_biascorrect(infile, verbose=False)
+    out = fsl.fnirt_with_affine(infile, reffile, verbose=False)
+    assert out.shape == (8, 9, 7)
+    # nor after a failed run
+    missing = str(tmp_path / 'missing.nii.gz')
+    with pytest.raises(Exception):
+        fsl.fslbet(missing, verbose=False)
+    with pytest.raises(ValueError):
+        fsl.fast(missing, verbose=False)
+    assert staging._temp_outputs == set()
+
+
+@pytest.mark.parametrize('tool', ['fslbet', 'fsl_biascorrect'])
+def test_temporary_outputs_leave_the_ram_directory(stub_fsl, ram_dir,
+                                                   make_image, tool):
+    img = getattr(fsl, tool)(nib.load(make_image()), verbose=False)
+    staging.clear_staged()
+    assert os.listdir(ram_dir) == []
+    # the image was read into memory before its file went
+    assert img.get_fdata().shape == (8, 9, 7)
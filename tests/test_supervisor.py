@@ -0,0 +1,128 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+import fsl
+from fsl import supervisor
+from fsl.supervisor import Policy, run_supervised
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='POSIX processes')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+@pytest.fixture(autouse=True)
+def policies():
+    yield
+    fsl.clear_policies()
+
+
+def test_output_and_usage():
+    result = run_supervised([sys.executable, '-c',
+                             'import sys; print("out"); sys.stderr.write("err")'])
+    assert result.returncode == 0
+    assert result.stdout.strip() == 'out' and result.stderr == 'err'
+    assert result.maxrss > 0 and result.attempts == 1
+    assert not result.timed_out and not result.cancelled
+
+
+def test_timeout_kills_the_process_group(tmp_path):
+    pidfile = str(tmp_path / 'helper.pid')
+    # a helper in the background, as some tools start
+    cmd = 'sleep 30 & echo $! > %s; wait' % pidfile
+    start = time.perf_counter()
+    result = run_supervised(cmd, policy=Policy(timeout=0.5))
+    assert time.perf_counter() - start < 10
+    assert result.timed_out and result.returncode < 0
+    with open(pidfile) as f:
+        helper = int(f.read())
+    for _ in range(50):
+        if not _alive(helper):
+            break
+        time.sleep(0.1)
+    assert not _alive(helper)
+
+
+def test_system_cmd_raises_on_timeout():
+    fsl.set_policy('sleep', timeout=0.3)
+    with pytest.raises(TimeoutError):
+        fsl.system_cmd('sleep 30')
+    assert fsl.last_job().timed_out
+
+
+def test_cancel_jobs():
+    errors = []
+
+    def run():
+        try:
+            fsl.system_cmd('sleep 30')
+        except CancelledError as e:
+            errors.append(e)
+
+    t = threading.Thread(target=run)
+    t.start()
+    for _ in range(100):
+        if fsl.running_jobs():
+            break
+        time.sleep(0.05)
+    assert [job[0] for job in fsl.running_jobs()] == ['sleep']
+    assert fsl.cancel_jobs('bet') == 0
+    assert fsl.cancel_jobs('sleep') == 1
+    t.join(10)
+    assert len(errors) == 1 and fsl.running_jobs() == []
+
+
+def test_retries(tmp_path):
+    counter = str(tmp_path / 'attempts')
+    cmd = 'echo x >> %s; exit 3' % counter
+    result = run_supervised(cmd, policy=Policy(retries=2, retry_on=('error',),
+                                               backoff=0.01))
+    assert result.returncode == 3 and result.attempts == 3
+    with open(counter) as f:
+        assert len(f.readlines()) == 3
+    # errors are not retried by default
+    assert run_supervised(cmd, policy=Policy(retries=2)).attempts == 1
+
+
+def test_memory_limit():
+    pytest.importorskip('resource')
+    code = 'x = bytearray(512 * 1024 ** 2)'
+    result = run_supervised([sys.executable, '-c', code],
+                            policy=Policy(max_memory=256 * 1024 ** 2))
+    assert result.returncode != 0
+    assert 'MemoryError' in result.stderr
+
+
+def test_no_signal_after_the_child_is_reaped(monkeypatch):
+    killed, timers = [], []
+    monkeypatch.setattr(supervisor.os, 'killpg',
+                        lambda pid, sig: killed.append(pid))
+    job = supervisor._Job(['true'], None, Policy(timeout=60), 'true')
+    wait4 = os.wait4
+
+    def reap_then_expire(pid, options):
+        # the timeout fires right as the child is reaped: its pid may
+        # already belong to another process
+        status = wait4(pid, options)
+        timer = threading.Thread(target=job._expire)
+        timer.start()
+        timer.join(0.2)
+        timers.append(timer)
+        return status
+
+    monkeypatch.setattr(supervisor.os, 'wait4', reap_then_expire)
+    job.run()
+    timers[0].join()
+    job.cancel()
+    assert job.proc.returncode == 0
+    assert killed == [] and not job.timed_out